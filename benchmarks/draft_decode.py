@@ -0,0 +1,94 @@
+"""
+Compare producing downscaled jpgs/thumbnails from a large master with and
+without reduced resolution decoding.
+
+Each measurement runs in a fresh interpreter, so that peak RSS is
+attributable to that measurement alone.
+
+    python -m benchmarks.draft_decode [--width 9000] [--height 12000]
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join
+
+from PIL import Image
+
+from digcollretriever.blueprint import lib
+
+
+def make_master(path, width, height, fmt):
+    Image.linear_gradient("L").resize((width, height)).convert("RGB").save(path, fmt)
+
+
+def peak_rss():
+    # VmHWM is reset on exec, unlike ru_maxrss which a child may
+    # inherit from its parent
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def child(path, mode, size, draft):
+    if not draft:
+        # Disable reduced resolution decoding
+        lib.reduced_decode = lambda master, size, reducing_gap=None: master
+    args = {'width': size, 'height': size, 'scale': None, 'quality': None,
+            'cropstartx': None, 'cropstarty': None, 'cropendx': None, 'cropendy': None}
+    start = time.perf_counter()
+    data = lib.render_derivative(path, args, "jpg", thumbnail=(mode == "thumb"))
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"seconds": elapsed, "peak_rss": peak_rss(), "bytes": len(data)}))
+
+
+def run(width=9000, height=12000, size=200, report=print):
+    """
+    Run every measurement, each in a child process
+
+    __Return Values__
+    * (list[dict]) The measurements
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt, ext in (("JPEG", "jpg"), ("TIFF", "tif")):
+            path = join(tmp, "master." + ext)
+            make_master(path, width, height, fmt)
+            for mode in ("thumb", "resize"):
+                for draft in ("0", "1"):
+                    out = subprocess.check_output(
+                        [sys.executable, "-m", "benchmarks.draft_decode", "--child", path, mode, str(size), draft]
+                    )
+                    r = json.loads(out.decode())
+                    r.update({"format": fmt, "mode": mode, "draft": draft == "1"})
+                    results.append(r)
+                    report("{format:5} {mode:6} draft={draft!s:5} {seconds:8.3f}s "
+                           "peak_rss={peak_rss:>12,}".format(**r))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=9000)
+    parser.add_argument("--height", type=int, default=12000)
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--child", nargs=4)
+    args = parser.parse_args()
+    if args.child:
+        path, mode, size, draft = args.child
+        child(path, mode, int(size), draft == "1")
+        return
+    return run(args.width, args.height, args.size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Latency, throughput and memory benchmarks of the API's endpoints against
+synthetic masters of realistic sizes.
+
+Masters are generated in a temporary mvol layout. Each scenario (an
+endpoint, or a mix of transformations) is then driven through either the
+Flask test client or a real threaded WSGI server, in a fresh interpreter
+so that peak RSS is attributable to that scenario alone.
+
+    python -m benchmarks.endpoints [--pages 8] [--width 2550] [--height 3300]
+        [--driver client --driver wsgi] [--scenario jpg_thumb ...]
+        [--requests 40] [--concurrency 4] [--env TRANSFORM_WORKERS=2]
+        [--output results.json] [--compare baseline.json] [--draft-decode]
+
+Results are written as JSON. When --compare is given each result is
+compared with the matching result of the baseline, and the exit status is
+non-zero if any regressed by more than --threshold.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+from urllib.parse import quote
+
+from PIL import Image
+
+from .draft_decode import peak_rss
+
+
+# name: [(weight, path template)], {id} is replaced with a page identifier
+SCENARIOS = {
+    "stat": [(1, "/{id}/stat")],
+    "tif": [(1, "/{id}/tif")],
+    "tif_techmd": [(1, "/{id}/tif/technical_metadata")],
+    "jpg": [(1, "/{id}/jpg")],
+    "jpg_scaled": [(1, "/{id}/jpg?scale=0.25")],
+    "jpg_cropped": [(1, "/{id}/jpg?width=1200&height=1553&cropstartx=200&cropstarty=200"
+                        "&cropendx=712&cropendy=712")],
+    "jpg_thumb": [(1, "/{id}/jpg/thumb?width=200&height=200")],
+    "iiif_tile": [(1, "/iiif/{id}/0,0,1024,1024/512,/0/default.jpg")],
+    # Roughly what a page turning viewer asks of us
+    "viewer_mix": [(6, "/{id}/jpg/thumb?width=200&height=200"),
+                   (2, "/{id}/jpg?width=1200&height=1553"),
+                   (1, "/{id}/tif/technical_metadata"),
+                   (1, "/{id}/stat")]
+}
+
+DRIVERS = ("client", "wsgi")
+
+# Compared between runs, and whether larger values are better
+METRICS = {"p50": False, "p99": False, "throughput": True, "peak_rss": False}
+
+
+def page_identifier(i):
+    return "mvol-0001-0002-0003_{:04d}".format(i + 1)
+
+
+def make_mvol(root, pages, width, height):
+    """
+    Write synthetic, uncompressed tif masters into an mvol layout
+
+    Masters are a gradient overlaid with noise, so that they neither
+    compress trivially nor entirely fail to.
+
+    __Return Values__
+    * (list[str]) The identifiers of the pages
+    """
+    tiff_dir = join(root, "mvol", "0001", "0002", "0003", "TIFF")
+    os.makedirs(tiff_dir)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    master = Image.merge("RGB", (gradient, noise, Image.blend(gradient, noise, .5)))
+    identifiers = [page_identifier(i) for i in range(pages)]
+    for identifier in identifiers:
+        master.save(join(tiff_dir, identifier + ".tif"), "TIFF")
+    return identifiers
+
+
+def request_paths(scenario, identifiers, count, seed=0):
+    """
+    The request paths of a scenario, cycling through the pages. Mixes are
+    sampled by weight, reproducibly.
+    """
+    rng = random.Random(seed)
+    weights, templates = zip(*SCENARIOS[scenario])
+    return [rng.choices(templates, weights)[0].format(id=quote(identifiers[i % len(identifiers)]))
+            for i in range(count)]
+
+
+def percentile(values, pct):
+    """
+    The nearest rank percentile of some values
+    """
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(pct / 100 * len(values))) - 1))]
+
+
+def summarize(latencies, statuses, elapsed):
+    return {
+        "requests": len(latencies),
+        "errors": sum(1 for x in statuses if x >= 400),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "mean": sum(latencies) / len(latencies),
+        "throughput": len(latencies) / elapsed,
+    }
+
+
+def drive_client(paths, warmup):
+    """
+    Issue requests, one at a time, through the Flask test client
+    """
+    import digcollretriever
+    client = digcollretriever.app.test_client()
+    for path in paths[:warmup]:
+        client.get(path)
+    latencies, statuses = [], []
+    start = time.perf_counter()
+    for path in paths:
+        t = time.perf_counter()
+        rv = client.get(path)
+        rv.get_data()
+        latencies.append(time.perf_counter() - t)
+        statuses.append(rv.status_code)
+    return summarize(latencies, statuses, time.perf_counter() - start)
+
+
+def drive_wsgi(paths, warmup, concurrency):
+    """
+    Issue requests, concurrency at a time, to a threaded WSGI server over
+    persistent HTTP connections
+    """
+    from werkzeug.serving import make_server
+    import digcollretriever
+    # Don't time the access log
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, digcollretriever.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    local = threading.local()
+
+    def get(path):
+        if getattr(local, "conn", None) is None:
+            local.conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=300)
+        t = time.perf_counter()
+        try:
+            local.conn.request("GET", path)
+            response = local.conn.getresponse()
+            response.read()
+            status = response.status
+        except (http.client.HTTPException, OSError):
+            local.conn.close()
+            local.conn = None
+            status = 599
+        return time.perf_counter() - t, status
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(get, paths[:warmup]))
+            start = time.perf_counter()
+            results = list(executor.map(get, paths))
+            elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+    latencies, statuses = zip(*results)
+    return summarize(latencies, statuses, elapsed)
+
+
+def child(spec):
+    """
+    Run a single scenario, in this (fresh) interpreter, and print its result
+    """
+    paths = request_paths(spec["scenario"], spec["identifiers"], spec["requests"], spec["seed"])
+    if spec["driver"] == "client":
+        result = drive_client(paths, spec["warmup"])
+    else:
+        result = drive_wsgi(paths, spec["warmup"], spec["concurrency"])
+    result["peak_rss"] = peak_rss()
+    print(json.dumps(result))
+
+
+def run(args, report=print):
+    """
+    Generate masters and run every requested scenario with every requested driver
+
+    __Return Values__
+    * (dict) The parameters of the run, and its results
+    """
+    env = dict(x.split("=", 1) for x in args.env)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        report("Generating {} {}x{} masters".format(args.pages, args.width, args.height))
+        identifiers = make_mvol(tmp, args.pages, args.width, args.height)
+        env.setdefault("MVOL_ROOT", tmp)
+        for driver in args.driver or DRIVERS:
+            for scenario in args.scenario or SCENARIOS:
+                spec = {"driver": driver, "scenario": scenario, "identifiers": identifiers,
+                        "requests": args.requests, "warmup": args.warmup, "seed": args.seed,
+                        "concurrency": 1 if driver == "client" else args.concurrency}
+                # The API reads its configuration from the environment on import
+                child_env = dict(os.environ, **{"DIGCOLLRETRIEVER_" + k: v for k, v in env.items()})
+                out = subprocess.check_output(
+                    [sys.executable, "-m", "benchmarks.endpoints", "--child", json.dumps(spec)],
+                    env=child_env
+                )
+                r = json.loads(out.decode().strip().splitlines()[-1])
+                r.update({"driver": driver, "scenario": scenario, "concurrency": spec["concurrency"]})
+                results.append(r)
+                report("{driver:6} {scenario:12} p50={p50:8.4f}s p99={p99:8.4f}s "
+                       "{throughput:8.2f} req/s errors={errors} peak_rss={peak_rss:>12,}".format(**r))
+    env.pop("MVOL_ROOT")
+    return {
+        "parameters": {"pages": args.pages, "width": args.width, "height": args.height,
+                       "requests": args.requests, "warmup": args.warmup,
+                       "concurrency": args.concurrency, "seed": args.seed, "env": env},
+        "platform": {"python": platform.python_version(), "pillow": Image.__version__,
+                     "machine": platform.machine(), "cpus": os.cpu_count()},
+        "results": results
+    }
+
+
+def compare(baseline, current, threshold, report=print):
+    """
+    Compare the results of two runs
+
+    __Args__
+    1) baseline (dict): An earlier run
+    2) current (dict): This run
+    3) threshold (float): The fraction by which a metric may worsen before
+        it is considered a regression
+
+    __Return Values__
+    * (list[tuple]) (driver, scenario, metric, baseline value, current value)
+        of each regression
+    """
+    before = {(r["driver"], r["scenario"]): r for r in baseline["results"]}
+    regressions = []
+    for r in current["results"]:
+        b = before.get((r["driver"], r["scenario"]))
+        if b is None:
+            continue
+        for metric, larger_is_better in METRICS.items():
+            if not b[metric]:
+                continue
+            change = (r[metric] - b[metric]) / b[metric]
+            worse = -change if larger_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append((r["driver"], r["scenario"], metric, b[metric], r[metric]))
+            report("{:6} {:12} {:10} {:+7.1%}{}".format(r["driver"], r["scenario"], metric, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, default=8)
+    parser.add_argument("--width", type=int, default=2550)
+    parser.add_argument("--height", type=int, default=3300)
+    parser.add_argument("--driver", action="append", choices=DRIVERS)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Concurrent connections to the WSGI server")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Configure the API, eg TRANSFORM_WORKERS=2 (DIGCOLLRETRIEVER_ is implied)")
+    parser.add_argument("--output", help="Write the results, as JSON, here")
+    parser.add_argument("--compare", metavar="BASELINE", help="A previous --output to compare with")
+    parser.add_argument("--threshold", type=float, default=.10)
+    parser.add_argument("--draft-decode", action="store_true",
+                        help="Also run benchmarks.draft_decode")
+    parser.add_argument("--child")
+    args = parser.parse_args()
+    if args.child:
+        child(json.loads(args.child))
+        return
+
+    current = run(args)
+    if args.draft_decode:
+        from . import draft_decode
+        current["draft_decode"] = draft_decode.run()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["parameters"] != current["parameters"]:
+            print("Warning: the baseline was run with different parameters")
+        if compare(baseline, current, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compare the time and output quality of resampling policies when
+downscaling a large master.
+
+Each policy is measured against the original path, Lanczos over the whole
+image, which is also the reference its output is compared to. Quality is
+reported as PSNR in dB, higher is closer to the reference, and identical
+output is reported as inf.
+
+    python -m benchmarks.resampling [--width 6000] [--height 8000] [--size 1000]
+"""
+import argparse
+import math
+import time
+
+from PIL import Image, ImageChops, ImageStat
+
+from digcollretriever.blueprint import lib
+
+
+# (filter, reducing gap), the first is the reference
+POLICIES = [
+    ("lanczos", None),
+    ("lanczos", 3.0),
+    ("lanczos", 2.0),
+    ("bicubic", None),
+    ("bicubic", 3.0),
+    ("bicubic", 2.0),
+    ("bilinear", 2.0),
+    ("box", None)
+]
+
+
+def make_master(width, height):
+    # Fine detail, which poor resampling aliases, over a gradient
+    detail = Image.effect_mandelbrot((width, height), (-0.75, -0.1, -0.7, -0.05), 256)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    return Image.merge("RGB", (detail, gradient, ImageChops.invert(detail)))
+
+
+def psnr(a, b):
+    """
+    The peak signal to noise ratio of an 8 bit image against a reference
+    """
+    stat = ImageStat.Stat(ImageChops.difference(a, b))
+    mse = sum(stat.sum2) / (stat.count[0] * len(stat.count))
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def run(width=6000, height=8000, size=1000, repeat=3, report=print):
+    """
+    Run every measurement
+
+    __Return Values__
+    * (list[dict]) The measurements
+    """
+    master = make_master(width, height)
+    target = lib.thumbnail_size(width, height, (size, size))
+    reference = None
+    results = []
+    for resample, reducing_gap in POLICIES:
+        args = {'resample': resample, 'reducing_gap': reducing_gap}
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = lib.resize(master, target, args)
+            timings.append(time.perf_counter() - start)
+        if reference is None:
+            reference = out
+        r = {"resample": resample, "reducing_gap": reducing_gap, "seconds": min(timings),
+             "psnr": psnr(out, reference)}
+        results.append(r)
+        report("{resample:8} reducing_gap={reducing_gap!s:5} {seconds:8.3f}s "
+               "psnr={psnr:6.1f}dB".format(**r))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=8000)
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    return run(args.width, args.height, args.size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
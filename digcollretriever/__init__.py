@@ -7,6 +7,57 @@ class Configuration(metaclass=MetaFlaskEnv):
     ENV_PREFIX = 'DIGCOLLRETRIEVER_'
     DEBUG = False
     DEFER_CONFIG = False
+    MVOL_ROOT = None
+    DERIVATIVE_CACHE_DIR = None
+    DERIVATIVE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+    IDENTIFIER_CACHE_SIZE = 4096
+    DERIVATIVE_ROOT = None
+    REMOTE_STORAGE_URL = None
+    REMOTE_BLOCK_SIZE = 64 * 1024
+    REMOTE_READ_AHEAD = 4
+    REMOTE_MAX_CONNECTIONS = 16
+    REMOTE_TIMEOUT = 30
+    REMOTE_BLOCK_CACHE_BYTES = 256 * 1024 * 1024
+    TECHMD_INDEX = None
+    OCR_INDEX = None
+    OCR_INDEX_CHECK_TTL = 300
+    BATCH_WORKERS = 4
+    BATCH_MAX_IDENTIFIERS = 500
+    TRANSFORM_WORKERS = 0
+    TRANSFORM_QUEUE_SIZE = 16
+    TRANSFORM_TIMEOUT = 60
+    COALESCE_LOCK_DIR = None
+    IIIF_TILE_SIZE = 512
+    IIIF_MAX_WIDTH = None
+    IIIF_MAX_HEIGHT = None
+    IIIF_MAX_AREA = None
+    CACHE_CONTROL_IMAGE = None
+    CACHE_CONTROL_DOCUMENT = None
+    CACHE_CONTROL_METADATA = None
+    METRICS_ENABLED = False
+    PIXEL_BUDGET = 256 * 1024 * 1024
+    PIXEL_BUDGET_TIMEOUT = 30
+    MAX_OUTPUT_PIXELS = 64 * 1024 * 1024
+    MAX_IMAGE_PIXELS = None
+    NEGOTIATE_FORMATS = False
+    TIFF_COMPRESSION = None
+    RESAMPLE = "lanczos"
+    RESAMPLE_THUMBNAIL = "bicubic"
+    RESIZE_REDUCING_GAP = 3.0
+    EXISTENCE_CACHE_TTL = 60
+    EXISTENCE_CACHE_SIZE = 65536
+    DIRECTORY_SCAN_TTL = 5
+    WATCH = False
+    WATCH_BACKEND = None
+    WATCH_POLL_INTERVAL = 30
+    WATCH_BATCH_SIZE = 1000
+    WATCH_WARMUP = False
+    PDF_RASTERIZER = None
+    PDF_WRITER = None
+    PDF_LINEARIZE = False
+    ASGI_THREADS = 32
+    ASGI_IO_THREADS = 8
+    ASGI_CHUNK_SIZE = 256 * 1024
 
 
 app = Flask(__name__)
@@ -0,0 +1,238 @@
+"""
+An ASGI entry point serving the same routes as the WSGI app
+
+    uvicorn digcollretriever.asgi:application
+
+Requests are handled by the (unchanged) Flask app on a bounded pool of
+threads, so image work never blocks the event loop. Response bodies, and
+in particular files sent with send_file(), are then streamed from a
+separate, small pool of I/O threads one chunk at a time, awaiting the
+client between chunks. A slow download therefore holds a coroutine and an
+open file rather than a thread, and a single process can serve thousands
+of them concurrently.
+"""
+import asyncio
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from werkzeug.wsgi import FileWrapper
+
+from . import app
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 32
+
+DEFAULT_IO_THREADS = 8
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+
+class ChunkedFileWrapper(FileWrapper):
+    """
+    A wsgi.file_wrapper which reads files in chunks of at least chunk_size
+    """
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    def __init__(self, file, buffer_size=8192):
+        super().__init__(file, max(buffer_size, self.chunk_size))
+
+
+def build_environ(scope, body, file_wrapper):
+    """
+    Build a WSGI environ from the scope of an ASGI http connection
+
+    __Args__
+    1) scope (dict): The ASGI connection scope
+    2) body (bytes): The complete request body
+    3) file_wrapper (callable): The wsgi.file_wrapper
+
+    __Return Values__
+    * (dict) The environ
+    """
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf8").decode("latin1"),
+        "PATH_INFO": path.encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": file_wrapper
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+class ASGIApplication:
+    """
+    Adapts a WSGI application to ASGI, streaming its response bodies
+
+    Executors are created on first use, so that the application may be
+    imported before an ASGI server forks its workers.
+    """
+    def __init__(self, wsgi_app, threads=DEFAULT_THREADS, io_threads=DEFAULT_IO_THREADS,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        __Args__
+        1) wsgi_app (callable): The WSGI application
+
+        __KWArgs__
+        * threads (int): The number of requests handled by the WSGI
+            application at once
+        * io_threads (int): The number of threads reading response bodies
+        * chunk_size (int): The minimum number of bytes to read from files
+            at a time
+        """
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.io_threads = io_threads
+        self.file_wrapper = type("FileWrapper", (ChunkedFileWrapper,), {"chunk_size": chunk_size})
+        self._app_executor = None
+        self._io_executor = None
+
+    @property
+    def app_executor(self):
+        if self._app_executor is None:
+            self._app_executor = ThreadPoolExecutor(self.threads, thread_name_prefix="asgi-app")
+        return self._app_executor
+
+    @property
+    def io_executor(self):
+        if self._io_executor is None:
+            self._io_executor = ThreadPoolExecutor(self.io_threads, thread_name_prefix="asgi-io")
+        return self._io_executor
+
+    def shutdown(self):
+        for executor in (self._app_executor, self._io_executor):
+            if executor is not None:
+                executor.shutdown(wait=False)
+        self._app_executor = self._io_executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        else:
+            raise ValueError("Unsupported ASGI scope type: {}".format(scope["type"]))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def start(self, environ):
+        """
+        Call the WSGI application, and read the first chunk of its response
+
+        Most responses are a single chunk, and are complete after a single
+        trip to the thread pool.
+
+        __Return Values__
+        * (tuple) The status, headers, iterable, an iterator over it and
+            the first chunk (or None if the body is empty) of the response
+        """
+        started = []
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+            return written.append
+
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            iterator = iter(iterable)
+            first = next(iterator, None)
+        except BaseException:
+            self.close(iterable)
+            raise
+        if written:
+            first = b"".join(written) + (first or b"")
+        return started[0], started[1], iterable, iterator, first
+
+    @staticmethod
+    def close(iterable):
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+    async def http(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, b"".join(body), self.file_wrapper)
+        status, headers, iterable, iterator, chunk = await loop.run_in_executor(
+            self.app_executor, self.start, environ
+        )
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers]
+            })
+            while chunk is not None and not disconnected.is_set():
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(self.io_executor, next, iterator, None)
+            if not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except OSError:
+            # The client went away mid response
+            log.debug("Client disconnected from {}".format(scope["path"]))
+        finally:
+            watcher.cancel()
+            await loop.run_in_executor(self.io_executor, self.close, iterable)
+
+
+application = ASGIApplication(
+    app,
+    threads=int(app.config.get("ASGI_THREADS") or DEFAULT_THREADS),
+    io_threads=int(app.config.get("ASGI_IO_THREADS") or DEFAULT_IO_THREADS),
+    chunk_size=int(app.config.get("ASGI_CHUNK_SIZE") or DEFAULT_CHUNK_SIZE)
+)
@@ -1,19 +1,48 @@
 """
 digcollretriever
 """
+import json
 import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
 from urllib.parse import unquote
-from io import BytesIO
+from io import BufferedReader, BytesIO
+from math import ceil
+from os.path import join
+from tempfile import TemporaryDirectory
 
-from PIL import Image
-
-from flask import Blueprint, jsonify, send_file
+from flask import Blueprint, Response, current_app, g, jsonify, request, send_file
 from flask_restful import Resource, Api, reqparse
+from PIL import Image
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import http_date
 
 from .lib.storageinterfaces import StorageInterface
-from .lib import determine_identifier_type, sane_transform_args, \
-    should_transform, general_transform
-from .exceptions import Error, Omitted
+from .lib import determine_identifier_type, should_transform, \
+    resolve_source, render_derivative, prefer_derivative, prefer_pyramid, output_size, \
+    decode_target, decode_size, pixel_cost, resample_policy, REGISTRY, RESIZE_REDUCING_GAP
+from .lib.cache import DerivativeCache, source_signature
+from .lib.techmd import get_index
+from .lib.conditional import DEFAULT_CACHE_CONTROL, make_etag, last_modified, \
+    is_not_modified
+from .lib.executor import TransformExecutor
+from .lib.coalesce import SingleFlight
+from .lib.existence import ExistenceCache
+from .lib.budget import PixelBudget
+from .lib import iiif
+from .lib.encoders import ENCODERS, select_format, tiff_compression
+from .lib.techmd import image_dimensions
+from .lib.batch import iter_batch, multipart_stream
+from .lib import metrics
+from .lib import pdf
+from .lib import ocr
+from .lib import remote
+from .lib.listing import get_scan_cache
+from .lib import watch
+from .exceptions import Error, Omitted, BatchSizeError, MissingParametersError, \
+    PDFWriterUnavailableError, InvalidRegionError, ImageTooLargeError, UnsupportedContextError
 
 __author__ = "Brian Balsamo"
 __email__ = "balsamo@uchicago.edu"
@@ -24,10 +53,70 @@ BLUEPRINT = Blueprint('digcollretriever', __name__)
 
 BLUEPRINT.config = {}
 
-API = Api(BLUEPRINT)
+
+class DigCollRetrieverApi(Api):
+    # flask_restful otherwise converts any exception raised in a Resource
+    # which isn't an HTTPException into a generic 500, preempting the
+    # blueprint's error handler
+    def handle_error(self, e):
+        if isinstance(e, Error):
+            return handle_errors(e)
+        if isinstance(e, Image.DecompressionBombError):
+            return handle_errors(ImageTooLargeError(str(e)))
+        return super().handle_error(e)
+
+
+API = DigCollRetrieverApi(BLUEPRINT)
 
 log = logging.getLogger(__name__)
 
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+DEFAULT_BATCH_WORKERS = 4
+
+DEFAULT_TRANSFORM_QUEUE_SIZE = 16
+
+DEFAULT_IIIF_TILE_SIZE = 512
+
+DEFAULT_TRANSFORM_TIMEOUT = 60
+
+DEFAULT_BATCH_MAX_IDENTIFIERS = 500
+
+DEFAULT_EXISTENCE_CACHE_TTL = 60
+
+DEFAULT_EXISTENCE_CACHE_SIZE = 65536
+
+DEFAULT_OCR_SEARCH_LIMIT = 20
+
+DEFAULT_DESCENDANTS_LIMIT = 100
+
+MAX_DESCENDANTS_LIMIT = 1000
+
+# Stands in for the identifier in memoized URL templates
+URL_PLACEHOLDER = "IDENTIFIER"
+
+DEFAULT_PIXEL_BUDGET = 256 * 1024 * 1024
+
+DEFAULT_PIXEL_BUDGET_TIMEOUT = 30
+
+DEFAULT_MAX_OUTPUT_PIXELS = 64 * 1024 * 1024
+
+_CACHES = {}
+
+_EXECUTORS = {}
+
+_COALESCERS = {}
+
+_EXISTENCE_CACHES = {}
+
+_BUDGETS = {}
+
+_URL_TEMPLATES = {}
+
+_WATCHERS = {}
+
+_WATCHERS_LOCK = threading.Lock()
+
 
 @BLUEPRINT.errorhandler(Error)
 def handle_errors(error):
@@ -36,30 +125,646 @@ def handle_errors(error):
     return response
 
 
-def statter(storageKls, identifier):
-    # TODO
-    # Without more class introspection this gets a little wonky if classes
-    # are making their own decisions about whether or not to let dynamic
-    # derivatives be created.
-    log.debug("Statting storage class for functionalities implementation")
+@BLUEPRINT.before_request
+def begin_metrics():
+    if BLUEPRINT.config.get("METRICS_ENABLED"):
+        metrics.begin()
+        g.metrics_start = time.perf_counter()
+
+
+@BLUEPRINT.before_request
+def start_watcher():
+    if BLUEPRINT.config.get("WATCH"):
+        watcher()
+
+
+@BLUEPRINT.after_request
+def record_metrics(response):
+    collector = metrics.end()
+    if collector is not None:
+        # Streamed responses of unknown length don't count towards bytes served
+        metrics.METRICS.record(collector, request.endpoint or "", response.status_code,
+                               time.perf_counter() - g.metrics_start, response.content_length)
+    return response
+
+
+def context_url(resource, identifier):
+    """
+    Return the URL of a resource for an identifier, as API.url_for() would,
+    from a memoized template
+    """
+    key = (resource, request.script_root)
+    template = _URL_TEMPLATES.get(key)
+    if template is None:
+        template = API.url_for(resource, identifier=URL_PLACEHOLDER)
+        _URL_TEMPLATES[key] = template
+    to_url = current_app.url_map.converters["path"](current_app.url_map).to_url
+    return template.replace(URL_PLACEHOLDER, to_url(identifier), 1)
+
+
+def statter(storage_instance, identifier, existence=None):
+    """
+    Return the URLs of the contexts available for an identifier, and the
+    formats which actually exist for it
+
+    Tifs and jpgs may each be produced from the other, so either
+    provides both.
+
+    __KWArgs__
+    * existence (ExistenceCache): Judges which formats exist, defaults to
+        the shared existence cache
+    """
+    log.debug("Statting storage instance for existing formats")
+    existence = existence or existence_cache()
+    formats = [x for x in ("tif", "jpg", "pdf", "limb_ocr", "descriptive_metadata")
+               if existence.exists(storage_instance, identifier, x)]
     contexts = []
-    if storageKls.get_tif != StorageInterface.get_tif:
-        # Take into account dynamic jpg generation
-        contexts.append(API.url_for(GetTif, identifier=identifier))
-        contexts.append(API.url_for(GetJpg, identifier=identifier))
-    if storageKls.get_tif_techmd != StorageInterface.get_tif_techmd:
-        contexts.append(API.url_for(GetTifTechnicalMetadata, identifier=identifier))
-    if storageKls.get_pdf != StorageInterface.get_pdf:
-        contexts.append(API.url_for(GetPdf, identifier=identifier))
-    if storageKls.get_jpg != StorageInterface.get_jpg:
-        # Take into account dynamic tif generation
-        contexts.append(API.url_for(GetJpg, identifier=identifier))
-        contexts.append(API.url_for(GetTif, identifier=identifier))
-    if storageKls.get_jpg_techmd != StorageInterface.get_jpg_techmd:
-        contexts.append(API.url_for(GetJpgTechnicalMetadata, identifier=identifier))
-    if storageKls.get_limb_ocr != StorageInterface.get_limb_ocr:
-        contexts.append(API.url_for(GetLimbOcr, identifier=identifier))
-    return contexts
+    if "tif" in formats:
+        contexts.extend([GetTif, GetJpg])
+        if type(storage_instance).get_tif_techmd != StorageInterface.get_tif_techmd:
+            contexts.append(GetTifTechnicalMetadata)
+    if "jpg" in formats:
+        contexts.extend([GetJpg, GetTif])
+        if type(storage_instance).get_jpg_techmd != StorageInterface.get_jpg_techmd:
+            contexts.append(GetJpgTechnicalMetadata)
+    if "pdf" in formats:
+        contexts.append(GetPdf)
+        if pdf.available(BLUEPRINT.config.get("PDF_RASTERIZER")):
+            contexts.extend([GetJpg, GetTif])
+    if "limb_ocr" in formats:
+        contexts.extend([GetLimbOcr, GetOcrText, GetOcrWords])
+    if type(storage_instance).get_limb_ocr_pages != StorageInterface.get_limb_ocr_pages:
+        contexts.append(GetOcrSearch)
+    if "descriptive_metadata" in formats:
+        contexts.append(GetMetadata)
+    if type(storage_instance).list_children != StorageInterface.list_children:
+        contexts.append(StatDescendants)
+    # Deduplicated, in order
+    contexts = [context_url(x, identifier) for x in dict.fromkeys(contexts)]
+    return contexts, formats
+
+
+def iter_descendants(storage_instance, identifier, instances=None):
+    """
+    Yield the descendants of an identifier, depth first, each followed by
+    its own descendants
+
+    __Return Values__
+    * (generator) (identifier, parent identifier, storage instance) tuples
+    """
+    if instances is None:
+        instances = {}
+    try:
+        children = storage_instance.list_children(identifier)
+    except Omitted:
+        return
+    for child in children:
+        storage_kls = determine_identifier_type(child)
+        if storage_kls not in instances:
+            instances[storage_kls] = storage_kls(BLUEPRINT.config)
+        yield child, identifier, instances[storage_kls]
+        yield from iter_descendants(instances[storage_kls], child, instances)
+
+
+def cached_dimensions(storage_instance, identifier, formats):
+    """
+    Return the dimensions of an identifier's master as recorded in the
+    technical metadata index, without touching the master, or None
+    """
+    index = get_index(BLUEPRINT.config.get("TECHMD_INDEX"))
+    for fmt in ("tif", "jpg"):
+        if fmt not in formats:
+            continue
+        source = getattr(storage_instance, "get_" + fmt)(identifier)
+        if isinstance(source, str):
+            record = index.lookup(source)
+            if record is not None:
+                return {"width": record['width'], "height": record['height']}
+    return None
+
+
+def derivative_cache():
+    """
+    Return the configured DerivativeCache, or None if caching is disabled
+    """
+    root = BLUEPRINT.config.get("DERIVATIVE_CACHE_DIR")
+    if not root:
+        return None
+    max_bytes = int(BLUEPRINT.config.get("DERIVATIVE_CACHE_MAX_BYTES") or DEFAULT_CACHE_MAX_BYTES)
+    cache = _CACHES.get((root, max_bytes))
+    if cache is None:
+        log.debug("Initializing derivative cache at {}".format(root))
+        cache = DerivativeCache(root, max_bytes)
+        _CACHES[(root, max_bytes)] = cache
+    return cache
+
+
+def transform_executor():
+    """
+    Return the configured TransformExecutor
+    """
+    workers = int(BLUEPRINT.config.get("TRANSFORM_WORKERS") or 0)
+    queue_size = BLUEPRINT.config.get("TRANSFORM_QUEUE_SIZE")
+    queue_size = int(queue_size if queue_size is not None else DEFAULT_TRANSFORM_QUEUE_SIZE)
+    timeout = float(BLUEPRINT.config.get("TRANSFORM_TIMEOUT") or DEFAULT_TRANSFORM_TIMEOUT)
+    executor = _EXECUTORS.get((workers, queue_size, timeout))
+    if executor is None:
+        log.debug("Initializing transform executor with {} workers".format(workers))
+        executor = TransformExecutor(workers, queue_size, timeout)
+        _EXECUTORS[(workers, queue_size, timeout)] = executor
+    return executor
+
+
+def existence_cache():
+    """
+    Return the ExistenceCache remembering which formats exist for identifiers
+    """
+    ttl = BLUEPRINT.config.get("EXISTENCE_CACHE_TTL")
+    ttl = float(DEFAULT_EXISTENCE_CACHE_TTL if ttl is None else ttl)
+    size = int(BLUEPRINT.config.get("EXISTENCE_CACHE_SIZE") or DEFAULT_EXISTENCE_CACHE_SIZE)
+    if (ttl, size) not in _EXISTENCE_CACHES:
+        _EXISTENCE_CACHES[(ttl, size)] = ExistenceCache(ttl, size)
+    return _EXISTENCE_CACHES[(ttl, size)]
+
+
+def pixel_budget():
+    """
+    Return the PixelBudget of this process
+    """
+    max_pixels = int(BLUEPRINT.config.get("PIXEL_BUDGET") or DEFAULT_PIXEL_BUDGET)
+    timeout = BLUEPRINT.config.get("PIXEL_BUDGET_TIMEOUT")
+    timeout = float(DEFAULT_PIXEL_BUDGET_TIMEOUT if timeout is None else timeout)
+    if (max_pixels, timeout) not in _BUDGETS:
+        _BUDGETS[(max_pixels, timeout)] = PixelBudget(max_pixels, timeout)
+    return _BUDGETS[(max_pixels, timeout)]
+
+
+@contextmanager
+def admitted(o_size, size, decoded=None):
+    """
+    Check an image job against the configured limits, and hold its
+    reservation in the pixel budget for the duration of a with block
+
+    __Args__
+    1) o_size (tuple): The (width, height) of the image to be decoded
+    2) size (tuple): The (width, height) of the result
+
+    __KWArgs__
+    * decoded (tuple): The (width, height) the image will actually be
+        decoded at, if at a reduced resolution (see decode_size())
+    """
+    max_image = BLUEPRINT.config.get("MAX_IMAGE_PIXELS")
+    if max_image and o_size[0] * o_size[1] > int(max_image):
+        # Refused before anything is decoded
+        raise ImageTooLargeError("The source image has {} pixels, more than the {} allowed".format(
+            o_size[0] * o_size[1], max_image))
+    max_output = int(BLUEPRINT.config.get("MAX_OUTPUT_PIXELS") or DEFAULT_MAX_OUTPUT_PIXELS)
+    if size[0] * size[1] > max_output:
+        raise ImageTooLargeError("The requested image has {} pixels, more than the {} allowed".format(
+            size[0] * size[1], max_output))
+    budget = pixel_budget()
+    cost = pixel_cost(decoded or o_size, size)
+    with metrics.stage("admission"):
+        budget.acquire(cost)
+    try:
+        yield
+    finally:
+        budget.release(cost)
+
+
+def ocr_index():
+    """
+    Return the configured OcrIndex
+    """
+    return ocr.get_index(BLUEPRINT.config.get("OCR_INDEX"))
+
+
+def watcher():
+    """
+    Return the Watcher invalidating this process' caches as masters
+    change, starting it if need be, or None if watching is disabled
+    """
+    if not BLUEPRINT.config.get("WATCH"):
+        return None
+    conf = BLUEPRINT.config
+    roots = tuple(x for x in (conf.get("MVOL_ROOT") and join(conf["MVOL_ROOT"], "mvol"),
+                              conf.get("FLAT_TIF_DIR_ROOT"), conf.get("FLAT_JPG_DIR_ROOT")) if x)
+    # Threads don't survive a fork, so each worker process watches for itself
+    key = (os.getpid(), roots)
+    with _WATCHERS_LOCK:
+        if key not in _WATCHERS:
+            techmd = get_index(conf.get("TECHMD_INDEX"))
+            warmup = None
+            # Every worker invalidates its own caches, but only one warms up
+            if conf.get("WATCH_WARMUP") and conf.get("MVOL_ROOT") and \
+                    watch.claim_warmup(watch.warmup_lock_path(conf)):
+                warmup = watch.WarmupQueue(conf, techmd=techmd)
+            handler = watch.Invalidator(
+                conf, derivative_cache=derivative_cache(), techmd=techmd,
+                existence=existence_cache(), scans=get_scan_cache(conf.get("DIRECTORY_SCAN_TTL")),
+                ocr=ocr_index(), warmup=warmup
+            )
+            interval = conf.get("WATCH_POLL_INTERVAL")
+            batch_size = conf.get("WATCH_BATCH_SIZE")
+            source = watch.open_watcher(
+                roots, conf.get("WATCH_BACKEND") or None,
+                float(watch.DEFAULT_POLL_INTERVAL if interval is None else interval),
+                int(batch_size or watch.DEFAULT_BATCH_SIZE)
+            )
+            _WATCHERS[key] = watch.Watcher(source, handler).start()
+        return _WATCHERS[key]
+
+
+def coalescer():
+    """
+    Return the SingleFlight used to deduplicate concurrent derivative requests
+    """
+    lock_dir = BLUEPRINT.config.get("COALESCE_LOCK_DIR") or None
+    if lock_dir not in _COALESCERS:
+        _COALESCERS[lock_dir] = SingleFlight(lock_dir)
+    return _COALESCERS[lock_dir]
+
+
+def validator_headers(etag, modified, cache_class):
+    """
+    Build the validator and Cache-Control headers for a response
+
+    __Args__
+    1) etag (str): The ETag of the response, or None
+    2) modified (datetime): The Last-Modified of the response, or None
+    3) cache_class (str): The class of endpoint, a key of DEFAULT_CACHE_CONTROL
+    """
+    headers = {"Cache-Control": BLUEPRINT.config.get("CACHE_CONTROL_" + cache_class) or
+               DEFAULT_CACHE_CONTROL[cache_class]}
+    if etag is not None:
+        headers["ETag"] = '"{}"'.format(etag)
+    if modified is not None:
+        headers["Last-Modified"] = http_date(modified)
+    return headers
+
+
+def not_modified(etag, modified, cache_class):
+    """
+    Return a 304 response if the request's validators match, otherwise None
+    """
+    if etag is None and modified is None:
+        return None
+    if not is_not_modified(request.if_none_match, request.if_modified_since, etag, modified):
+        return None
+    log.info("Validators matched, responding 304 Not Modified")
+    return Response(status=304, headers=validator_headers(etag, modified, cache_class))
+
+
+def send(source, mimetype, etag):
+    """
+    send_file(), supporting byte ranges of open files (eg, hits in the
+    derivative cache) as it does those of paths and BytesIOs
+
+    __Args__
+    1) source (str/file like object): The file
+    2) mimetype (str): Its mimetype
+    3) etag (str/bool): As for send_file()
+    """
+    if not isinstance(source, BufferedReader):
+        return send_file(source, mimetype=mimetype, conditional=True, etag=etag)
+    size = os.fstat(source.fileno()).st_size
+    response = send_file(source, mimetype=mimetype, conditional=False, etag=etag)
+    response.content_length = size
+    try:
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+    except RequestedRangeNotSatisfiable:
+        source.close()
+        raise
+
+
+def serve_file(source, mimetype, cache_class, *parts, signature=None):
+    """
+    Send a file, with validators derived from its stat signature
+
+    __KWArgs__
+    * signature (tuple): The stat signature of the master the file was
+        derived from, if the validators shouldn't be derived from the file
+    """
+    if isinstance(source, bytes):
+        # Possibly shared between coalesced requests, each of which has to
+        # read (and close) a file of its own
+        source = BytesIO(source)
+    if signature is None:
+        signature = source_signature(source)
+    etag = make_etag(signature, *parts) if signature else None
+    modified = last_modified(signature)
+    response = not_modified(etag, modified, cache_class)
+    if response is not None:
+        return response
+    response = send(source, mimetype, etag if etag is not None else True)
+    response.headers.update(validator_headers(etag, modified, cache_class))
+    return response
+
+
+def serve_json(data, cache_class, etag=None, modified=None):
+    """
+    Return JSON data from a Resource, with validators. If no ETag is
+    provided one is derived from the data itself.
+    """
+    if etag is None:
+        etag = make_etag(None, json.dumps(data, sort_keys=True))
+    response = not_modified(etag, modified, cache_class)
+    if response is not None:
+        return response
+    return data, 200, validator_headers(etag, modified, cache_class)
+
+
+def master_signature(storage_instance, identifier, fmt):
+    """
+    Return the stat signature of a master, or None if it isn't available
+    """
+    try:
+        return source_signature(existence_cache().lookup(storage_instance, identifier, fmt))
+    except Omitted:
+        return None
+
+
+def serve_techmd(storage_instance, identifier, fmt):
+    """
+    Return the technical metadata of a master, answering 304 from the
+    master's stat signature where possible
+    """
+    signature = master_signature(storage_instance, identifier, fmt)
+    etag = modified = None
+    if signature is not None:
+        etag = make_etag(signature, identifier, fmt + "_techmd")
+        modified = last_modified(signature)
+        response = not_modified(etag, modified, "METADATA")
+        if response is not None:
+            return response
+    techmd = getattr(storage_instance, "get_{}_techmd".format(fmt))(identifier)
+    return serve_json(techmd, "METADATA", etag=etag, modified=modified)
+
+
+def resolve_resampling(args, thumbnail=False):
+    """
+    Resolve the resampling policy of a request against the configured
+    defaults, recording it in args so that it is a part of the cache keys
+    and ETags of the derivative
+    """
+    if thumbnail:
+        default = BLUEPRINT.config.get("RESAMPLE_THUMBNAIL") or "bicubic"
+    else:
+        default = BLUEPRINT.config.get("RESAMPLE") or "lanczos"
+    args['resample'], args['reducing_gap'] = resample_policy(
+        args.get('resample'), default,
+        BLUEPRINT.config.get("RESIZE_REDUCING_GAP", RESIZE_REDUCING_GAP)
+    )
+
+
+def serve_derivative(identifier, args, source_formats, output_format, thumbnail=False,
+                     passthrough=None):
+    """
+    Produce (or retrieve from the derivative cache) a derivative image
+    and return it as a response
+
+    __Args__
+    1) identifier (str): The (quoted) identifier from the URL
+    2) args (dict): The parsed request arguments
+    3) source_formats (list[str]): The fallback chain to walk for a master
+    4) output_format (str): The format to encode to, a key of encoders.ENCODERS
+
+    __KWArgs__
+    * thumbnail (bool): Whether to thumbnail, rather than transform, the master
+    * passthrough (str): A source format which, when it is also the output
+        format and no transformations are requested, is sent as is rather
+        than decoded and re-encoded
+    """
+    mimetype = ENCODERS[output_format].mimetype
+    identifier = unquote(identifier)
+    page = args.pop('page', None)
+    resolve_resampling(args, thumbnail)
+    with metrics.stage("resolve"):
+        storage_kls = determine_identifier_type(identifier)
+        storage_instance = storage_kls(BLUEPRINT.config)
+        source, source_format = resolve_source(storage_instance, identifier, source_formats,
+                                               existence=existence_cache())
+    if source_format == "pdf":
+        # Each page of a pdf is a distinct image
+        args['page'] = page or 1
+
+    if source_format == passthrough == output_format and not thumbnail and \
+            not should_transform(args) and not args.get('compression'):
+        log.info("No transformations requested, sending the native {}".format(source_format))
+        # Streamed from disk, with validators and byte range support
+        return serve_file(source, mimetype, "IMAGE", identifier, source_format)
+
+    # Everything below is derived from the master, so if the client's copy
+    # is current we can say so without decoding anything
+    signature = source_signature(source)
+    etag = modified = None
+    if signature is not None:
+        etag = make_etag(signature, identifier, output_format, thumbnail, args=args)
+        modified = last_modified(signature)
+        response = not_modified(etag, modified, "IMAGE")
+        if response is not None:
+            return response
+
+    cached, data = produce_derivative(storage_instance, identifier, source, signature, args,
+                                      output_format, thumbnail=thumbnail, source_format=source_format)
+    return derivative_response(cached, data, mimetype, etag, modified)
+
+
+def derivative_response(cached, data, mimetype, etag, modified):
+    """
+    Send a derivative, either from the derivative cache or from RAM
+    """
+    if cached is not None:
+        response = send(cached, mimetype, etag or False)
+    else:
+        log.debug("Returning result image")
+        response = send_file(BytesIO(data), mimetype=mimetype)
+    response.headers.update(validator_headers(etag, modified, "IMAGE"))
+    return response
+
+
+def cached_render(identifier, signature, args, variant, render):
+    """
+    Retrieve a derivative from the derivative cache, or render (and cache) it
+
+    __Args__
+    1) identifier (str): The (unquoted) identifier
+    2) signature (tuple): The stat signature of the master, or None
+    3) args (dict): The arguments which determine the derivative
+    4) variant: Anything else (JSON serializable) which determines the derivative
+    5) render (callable): Produces the encoded derivative
+
+    __Return Values__
+    * (tuple) The cached derivative, opened for reading, and None, or None
+        and the encoded derivative
+    """
+    if signature is None:
+        return None, render()
+    cache = derivative_cache()
+    key = DerivativeCache.make_key(identifier, args, variant, signature)
+    if cache is not None:
+        with metrics.stage("cache_lookup"):
+            cached = cache.get(key)
+        if cached is not None:
+            log.info("Serving derivative from cache")
+            metrics.count("derivative_cache_requests_total", result="hit")
+            return cached, None
+        metrics.count("derivative_cache_requests_total", result="miss")
+
+    def produce():
+        if cache is not None:
+            # Leaders in other processes wait for ours, see SingleFlight
+            cached = cache.get(key, count=False)
+            if cached is not None:
+                with cached:
+                    return cached.read()
+        data = render()
+        if cache is not None:
+            cache.put(key, data)
+        return data
+
+    # Identical requests which arrive while this one is rendering share
+    # its result, which (unlike a file) each may read for itself
+    return None, coalescer().do(key, produce)
+
+
+def run_render(fn, source, *args):
+    """
+    Run a rendering function, in a transform worker process if the
+    master can be handed off to one
+    """
+    if isinstance(source, str):
+        # Picklable, so may be handed off to a worker process
+        collector = metrics.current()
+        if collector is None:
+            return transform_executor().run(fn, source, *args)
+        # Bring the stage timings back from the worker process
+        result, stages, counts = transform_executor().run(metrics.call_collecting, fn, source, *args)
+        collector.merge(stages, counts)
+        return result
+    return fn(source, *args)
+
+
+def produce_derivative(storage_instance, identifier, source, signature, args, output_format,
+                       thumbnail=False, source_format=None):
+    """
+    Retrieve a derivative from the derivative cache, or render (and cache) it
+
+    __Args__
+    1) storage_instance (StorageInterface): The storage instance
+    2) identifier (str): The (unquoted) identifier
+    3) source (str/file like object): The master
+    4) signature (tuple): The stat signature of the master, or None
+    5) args (dict): The parsed request arguments
+    6) output_format (str): The format to encode to, a key of encoders.ENCODERS
+
+    __KWArgs__
+    * thumbnail (bool): Whether to thumbnail, rather than transform, the master
+    * source_format (str): The format of the master, pdfs are rasterized
+
+    __Return Values__
+    * (tuple) The cached derivative, opened for reading, and None, or None
+        and the encoded derivative
+    """
+    if source_format == "pdf":
+        return produce_page_derivative(identifier, source, signature, args, output_format,
+                                       thumbnail=thumbnail)
+
+    def render():
+        render_source, render_args, render_thumbnail = source, args, thumbnail
+        if ENCODERS[output_format].quality is not None:
+            # Lossy outputs may as well start from lossy derivatives
+            render_source, render_args, render_thumbnail = prefer_derivative(
+                storage_instance, identifier, source, args, thumbnail,
+                index=get_index(BLUEPRINT.config.get("TECHMD_INDEX"))
+            )
+        # Pre-built derivatives are jpgs
+        render_format, pyramid = "jpg", False
+        if render_source is source:
+            render_source = prefer_pyramid(storage_instance, identifier, source)
+            render_format, pyramid = source_format, render_source is not source
+        o_size = image_dimensions(render_source, get_index(BLUEPRINT.config.get("TECHMD_INDEX")))
+        decoded = decode_size(o_size, decode_target(render_args, *o_size, thumbnail=render_thumbnail),
+                              render_format, pyramid)
+        with admitted(o_size, output_size(render_args, *o_size, thumbnail=render_thumbnail),
+                      decoded=decoded):
+            return run_render(render_derivative, render_source, dict(render_args), output_format,
+                              render_thumbnail)
+
+    return cached_render(identifier, signature, args, (output_format, thumbnail), render)
+
+
+def produce_page_derivative(identifier, source, signature, args, output_format, thumbnail=False):
+    """
+    Retrieve a derivative of a page of a pdf from the derivative cache, or
+    rasterize the page (or retrieve its rasterization from the cache) and
+    render (and cache) it
+
+    __Args__
+    1) identifier (str): The (unquoted) identifier
+    2) source (str): The pdf
+    3) signature (tuple): The stat signature of the pdf, or None
+    4) args (dict): The parsed request arguments, including the page
+    5) output_format (str): The format to encode to, a key of encoders.ENCODERS
+
+    __KWArgs__
+    * thumbnail (bool): Whether to thumbnail, rather than transform, the page
+
+    __Return Values__
+    * (tuple) The cached derivative, opened for reading, and None, or None
+        and the encoded derivative
+    """
+    rasterizer = pdf.get_rasterizer(BLUEPRINT.config.get("PDF_RASTERIZER"))
+    page = args['page']
+
+    def render():
+        _, page_size = pdf.page_info(rasterizer, source, page, signature)
+        render_args = {k: v for k, v in args.items() if k != 'page'}
+        dpi, render_args = pdf.page_render_args(page_size, render_args, thumbnail)
+        rendered_size = pdf.rendered_size(page_size, dpi)
+        with admitted(rendered_size, (render_args['width'], render_args['height'])):
+            # Renderings are shared by every request for the page which they cover
+            cached, data = cached_render(
+                identifier, signature, {"page": page, "dpi": dpi}, ("pdf_page", rasterizer.name),
+                lambda: run_render(pdf.rasterize_page, source, rasterizer.name, page, dpi)
+            )
+            with cached or BytesIO(data) as rendering:
+                return run_render(render_derivative, rendering, render_args, output_format)
+
+    return cached_render(identifier, signature, args, (output_format, thumbnail), render)
+
+
+def derivative_bytes(identifier, args, source_formats, output_format, thumbnail=False):
+    """
+    Produce a derivative image outside of the context of a single
+    image request, eg for batches
+
+    __Args__
+    1) identifier (str): The (unquoted) identifier
+    2) args (dict): The transformation arguments
+    3) source_formats (list[str]): The fallback chain to walk for a master
+    4) output_format (str): The format to encode to, a key of encoders.ENCODERS
+
+    __KWArgs__
+    * thumbnail (bool): Whether to thumbnail, rather than transform, the master
+
+    __Return Values__
+    * (bytes) The encoded derivative
+    """
+    resolve_resampling(args, thumbnail)
+    storage_kls = determine_identifier_type(identifier)
+    storage_instance = storage_kls(BLUEPRINT.config)
+    source, source_format = resolve_source(storage_instance, identifier, source_formats,
+                                           existence=existence_cache())
+    if source_format == "pdf":
+        args['page'] = args.get('page') or 1
+    cached, data = produce_derivative(storage_instance, identifier, source, source_signature(source),
+                                      args, output_format, thumbnail=thumbnail,
+                                      source_format=source_format)
+    if cached is not None:
+        with cached:
+            data = cached.read()
+    return data
 
 
 class Root(Resource):
@@ -69,8 +774,51 @@ class Root(Resource):
 
 class Stat(Resource):
     def get(self, identifier):
-        return {"identifier": unquote(identifier),
-                "contexts_available": statter(determine_identifier_type(identifier), identifier)}
+        storage_kls = determine_identifier_type(unquote(identifier))
+        storage_instance = storage_kls(BLUEPRINT.config)
+        contexts, formats = statter(storage_instance, unquote(identifier))
+        return serve_json({"identifier": unquote(identifier),
+                           "contexts_available": contexts,
+                           "formats_available": formats},
+                          "METADATA")
+
+
+class StatDescendants(Resource):
+    def get(self, identifier):
+        parser = reqparse.RequestParser()
+        parser.add_argument('offset', type=int, location='args')
+        parser.add_argument('limit', type=int, location='args')
+        args = parser.parse_args()
+        offset = max(args['offset'] or 0, 0)
+        limit = min(max(args['limit'] or DEFAULT_DESCENDANTS_LIMIT, 1), MAX_DESCENDANTS_LIMIT)
+        identifier = unquote(identifier)
+        storage_kls = determine_identifier_type(identifier)
+        storage_instance = storage_kls(BLUEPRINT.config)
+        # Listing is cheap, so the whole tree is enumerated to count it,
+        # but only the requested page of it is statted
+        descendants = list(iter_descendants(storage_instance, identifier))
+        # Existence is judged from directory listings, rather than a stat per file
+        existence = ExistenceCache(ttl=0, exists=get_scan_cache(
+            BLUEPRINT.config.get("DIRECTORY_SCAN_TTL")).exists)
+        results = []
+        for child, parent, child_instance in descendants[offset:offset + limit]:
+            contexts, formats = statter(child_instance, child, existence=existence)
+            results.append({"identifier": child,
+                            "parent": parent,
+                            "contexts_available": contexts,
+                            "formats_available": formats,
+                            "dimensions": cached_dimensions(child_instance, child, formats)})
+        next_url = None
+        if offset + limit < len(descendants):
+            next_url = API.url_for(StatDescendants, identifier=identifier,
+                                   offset=offset + limit, limit=limit)
+        return serve_json({"identifier": identifier,
+                           "total": len(descendants),
+                           "offset": offset,
+                           "limit": limit,
+                           "next": next_url,
+                           "descendants": results},
+                          "METADATA")
 
 
 class GetTif(Resource):
@@ -83,62 +831,34 @@ class GetTif(Resource):
         parser.add_argument('cropstarty', type=int, location='args')
         parser.add_argument('cropendx', type=int, location='args')
         parser.add_argument('cropendy', type=int, location='args')
+        parser.add_argument('page', type=int, location='args')
+        parser.add_argument('compression', type=str, location='args')
+        parser.add_argument('resample', type=str, location='args')
         args = parser.parse_args()
+        args['compression'] = tiff_compression(args['compression'],
+                                               BLUEPRINT.config.get("TIFF_COMPRESSION"))
+        if args['compression'] is None:
+            # Uncompressed, as ever
+            del args['compression']
 
-        storage_kls = determine_identifier_type(unquote(identifier))
-        storage_instance = storage_kls(BLUEPRINT.config)
-        try:
-            # Explicit implementation
-            master = Image.open(storage_instance.get_tif(unquote(identifier)))
-            log.info("Utilized explicit tif retrieval implementation")
-        except Omitted:
-            # Produce a derivative, try from pdf first, then jpg
-            try:
-                master = Image.open(storage_instance.get_pdf(unquote(identifier)))
-                log.info("Explicit functionality omitted, created derivative tif from pdf")
-            except Omitted:
-                master = Image.open(storage_instance.get_jpg(unquote(identifier)))
-                log.info("Explicit functionality omitted, created derivative tif from jpg")
-
-        # Transformations
-        if should_transform(args):
-            master = general_transform(master, args)
-
-        tif = BytesIO()
-        log.debug("Saving result to RAM object")
-        # Some tifs make PIL explode,
+        # Some tifs make PIL explode when rewritten without alteration,
         # see here: https://github.com/python-pillow/Pillow/issues/2278
-        # Luckily, it is _usually_ the case that people want tifs
-        # at native sizes, so I'm going to try and catch it and just
-        # throw back the tif, if this looks like the case, bypassing PIL
-        # It also appears as though this is the only case if you attempt
-        # to rewrite the tif without altering it to a BytesIO instance.
-        # Transformations followed by rewriting the tif appear to be
-        # fine, even if trying to write out the original "native" tif
-        # would cause an error.
-        try:
-            master.save(tif, "TIFF")
-            tif.seek(0)
-            log.debug("Returning result image")
-            return send_file(
-                tif,
-                mimetype="image/tif"
-            )
-        except AttributeError:
-            log.debug("Backup functionality because PIL doesn't like this tif...")
-            # We can't do any transformations
-            # This may be redundant, see above comment about transformations
-            # followed by a rewrite making PIL happy to write the tif to
-            # a BytesIO()
-            if should_transform(args) is True:
-                log.debug("Fallback failed, requester wanted transformations")
-                raise
-            else:
-                log.debug("The requester didn't want any transformations - sending the native tif")
-                return send_file(
-                    storage_instance.get_tif(unquote(identifier)),
-                    mimetype="image/tif"
-                )
+        # Passing through native tifs untouched avoids this, as well as
+        # holding the whole image in RAM.
+        return serve_derivative(identifier, args, ["tif", "pdf", "jpg"], "tif", passthrough="tif")
+
+
+def jpg_format(requested):
+    """
+    Choose the format of a /jpg response, from the format parameter or,
+    if enabled, the Accept header of the request
+
+    __Return Values__
+    * (tuple) The format, and whether it depends on the Accept header
+    """
+    negotiate = requested is None and bool(BLUEPRINT.config.get("NEGOTIATE_FORMATS"))
+    accept = request.accept_mimetypes if negotiate else None
+    return select_format(requested, "jpg", accept=accept), negotiate
 
 
 class GetJpg(Resource):
@@ -152,42 +872,16 @@ class GetJpg(Resource):
         parser.add_argument('cropstarty', type=int, location='args')
         parser.add_argument('cropendx', type=int, location='args')
         parser.add_argument('cropendy', type=int, location='args')
+        parser.add_argument('page', type=int, location='args')
+        parser.add_argument('format', type=str, location='args')
+        parser.add_argument('resample', type=str, location='args')
         args = parser.parse_args()
-
-        storage_kls = determine_identifier_type(unquote(identifier))
-        storage_instance = storage_kls(BLUEPRINT.config)
-
-        try:
-            # Explicit implementation
-            master = Image.open(storage_instance.get_jpg(identifier))
-            log.info("Utilized explicit jpg retrieval implementation")
-        except Omitted:
-            # Produce a derivative, try tif first, then pdf
-            try:
-                log.debug("Explicit functionality omitted, creating derivative jpg from tif")
-                master = Image.open(storage_instance.get_tif(unquote(identifier)))
-                log.info("Explicit functionality omitted, created derivative jpg from tif")
-            except Omitted:
-                log.debug("Explicit functionality omitted, creating derivative jpg from pdf")
-                master = Image.open(storage_instance.get_pdf(unquote(identifier)))
-                log.info("Explicit functionality omitted, created derivative jpg from pdf")
-
-        # Transformations
-        if should_transform(args):
-            master = general_transform(master, args)
-
-        jpg = BytesIO()
-        log.debug("Saving result to RAM object")
-        # JPEG specific
-        if args['quality'] is None:
-            args['quality'] = 95
-        master.save(jpg, "JPEG", quality=args['quality'])
-        jpg.seek(0)
-        log.debug("Returning result image")
-        return send_file(
-            jpg,
-            mimetype="image/jpg"
-        )
+        output_format, negotiated = jpg_format(args.pop('format'))
+        response = serve_derivative(identifier, args, ["jpg", "tif", "pdf"], output_format,
+                                    passthrough="jpg")
+        if negotiated:
+            response.headers["Vary"] = "Accept"
+        return response
 
 
 class GetJpgThumbnail(Resource):
@@ -196,66 +890,244 @@ class GetJpgThumbnail(Resource):
         parser.add_argument('width', type=int, location='args', required=True)
         parser.add_argument('height', type=int, location='args', required=True)
         parser.add_argument('quality', type=int, location='args')
+        parser.add_argument('page', type=int, location='args')
+        parser.add_argument('format', type=str, location='args')
+        parser.add_argument('resample', type=str, location='args')
         args = parser.parse_args()
         # Bandaid
         args['scale'] = None
+        output_format, negotiated = jpg_format(args.pop('format'))
+        response = serve_derivative(identifier, args, ["jpg", "tif", "pdf"], output_format,
+                                    thumbnail=True)
+        if negotiated:
+            response.headers["Vary"] = "Accept"
+        return response
 
-        storage_kls = determine_identifier_type(unquote(identifier))
-        storage_instance = storage_kls(BLUEPRINT.config)
 
+class BatchJpg(Resource):
+    def post(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('identifiers', type=str, action='append', location='json', required=True)
+        parser.add_argument('thumbnail', type=bool, location='json')
+        parser.add_argument('width', type=int, location='json')
+        parser.add_argument('height', type=int, location='json')
+        parser.add_argument('scale', type=float, location='json')
+        parser.add_argument('quality', type=int, location='json')
+        parser.add_argument('cropstartx', type=int, location='json')
+        parser.add_argument('cropstarty', type=int, location='json')
+        parser.add_argument('cropendx', type=int, location='json')
+        parser.add_argument('cropendy', type=int, location='json')
+        parser.add_argument('resample', type=str, location='json')
+        args = parser.parse_args()
+
+        identifiers = [unquote(x) for x in args.pop('identifiers')]
+        max_identifiers = int(BLUEPRINT.config.get("BATCH_MAX_IDENTIFIERS") or DEFAULT_BATCH_MAX_IDENTIFIERS)
+        if len(identifiers) > max_identifiers:
+            raise BatchSizeError("At most {} identifiers may be requested at once".format(max_identifiers))
+        thumbnail = bool(args.pop('thumbnail'))
+        if thumbnail:
+            if not (args['width'] and args['height']):
+                raise MissingParametersError("Thumbnails require a width and height")
+            # Bandaid
+            args['scale'] = None
+
+        def job(identifier):
+            return derivative_bytes(identifier, dict(args), ["jpg", "tif", "pdf"], "jpg",
+                                    thumbnail=thumbnail)
+
+        workers = int(BLUEPRINT.config.get("BATCH_WORKERS") or DEFAULT_BATCH_WORKERS)
+        log.info("Producing a batch of {} jpgs".format(len(identifiers)))
+        boundary, body = multipart_stream(iter_batch(identifiers, job, workers), "image/jpg")
+        return Response(body, content_type="multipart/mixed; boundary=" + boundary)
+
+
+def iiif_limits():
+    return {"max_width": BLUEPRINT.config.get("IIIF_MAX_WIDTH"),
+            "max_height": BLUEPRINT.config.get("IIIF_MAX_HEIGHT"),
+            "max_area": BLUEPRINT.config.get("IIIF_MAX_AREA")}
+
+
+def iiif_headers():
+    return {"Access-Control-Allow-Origin": "*",
+            "Link": '<{}>;rel="profile"'.format(iiif.PROFILE_URI)}
+
+
+def iiif_master(identifier):
+    """
+    Return the storage instance, master, its format and native dimensions
+    for an identifier, preferring tifs as masters
+
+    pdfs, which are only rasterized a page at a time, aren't served
+    """
+    with metrics.stage("resolve"):
+        storage_kls = determine_identifier_type(identifier)
+        storage_instance = storage_kls(BLUEPRINT.config)
         try:
-            # Explicit implementation
-            master = Image.open(storage_instance.get_jpg(identifier))
-            log.info("Utilized explicit jpg retrieval implementation")
+            source, source_format = resolve_source(storage_instance, identifier, ["tif", "jpg"],
+                                                   existence=existence_cache())
         except Omitted:
-            # Produce a derivative, try tif first, then pdf
-            try:
-                log.debug("Explicit functionality omitted, creating derivative jpg from tif")
-                master = Image.open(storage_instance.get_tif(unquote(identifier)))
-                log.info("Explicit functionality omitted, created derivative jpg from tif")
-            except Omitted:
-                log.debug("Explicit functionality omitted, creating derivative jpg from pdf")
-                master = Image.open(storage_instance.get_pdf(unquote(identifier)))
-                log.info("Explicit functionality omitted, created derivative jpg from pdf")
-
-        # Transformations
-        log.info("Performing transformation.")
-        o_width, o_height = master.size
-        args = sane_transform_args(args, o_width, o_height)
-        master.thumbnail((args['width'], args['height']))
-        log.info("Transformation complete")
-        if args['quality'] is None:
-            args['quality'] = 95
-
-        thumb = BytesIO()
-        log.debug("Saving result to RAM object")
-        master.save(thumb, "JPEG", quality=args['quality'])
-        thumb.seek(0)
-        log.debug("Returning result image")
-        return send_file(
-            thumb,
-            mimetype="image/jpg"
-        )
+            raise UnsupportedContextError("{} has no image to serve over IIIF".format(identifier))
+    width, height = image_dimensions(source, get_index(BLUEPRINT.config.get("TECHMD_INDEX")))
+    return storage_instance, source, source_format, width, height
+
+
+class IIIFInfo(Resource):
+    def get(self, identifier):
+        identifier = unquote(identifier)
+        _, source, _, width, height = iiif_master(identifier)
+        base_id = API.url_for(IIIFInfo, identifier=identifier, _external=True)[:-len("/info.json")]
+        tile_size = int(BLUEPRINT.config.get("IIIF_TILE_SIZE") or DEFAULT_IIIF_TILE_SIZE)
+        document = iiif.info(base_id, width, height, tile_size=tile_size, limits=iiif_limits())
+        etag = make_etag(None, json.dumps(document, sort_keys=True))
+        modified = last_modified(source_signature(source))
+        response = not_modified(etag, modified, "METADATA")
+        if response is None:
+            if request.accept_mimetypes.best_match(["application/json", "application/ld+json"]) == \
+                    "application/ld+json":
+                content_type = 'application/ld+json;profile="{}"'.format(iiif.CONTEXT)
+            else:
+                content_type = "application/json"
+            response = Response(json.dumps(document), content_type=content_type)
+            response.headers.update(validator_headers(etag, modified, "METADATA"))
+        response.headers.update(iiif_headers())
+        response.headers["Vary"] = "Accept"
+        return response
+
+
+class IIIFImage(Resource):
+    def get(self, identifier, region, size, rotation, quality, fmt):
+        identifier = unquote(identifier)
+        storage_instance, source, source_format, width, height = iiif_master(identifier)
+        image_request = iiif.parse_request(region, size, rotation, quality, fmt, width, height,
+                                           limits=iiif_limits())
+        args = iiif.canonical_args(image_request)
+
+        signature = source_signature(source)
+        etag = modified = None
+        if signature is not None:
+            etag = make_etag(signature, identifier, "iiif", args=args)
+            modified = last_modified(signature)
+            response = not_modified(etag, modified, "IMAGE")
+            if response is not None:
+                response.headers.update(iiif_headers())
+                return response
+
+        def render():
+            render_source = prefer_pyramid(storage_instance, identifier, source)
+            box = image_request.region
+            # The whole master is decoded at the resolution its region needs
+            target = (ceil(width * image_request.size[0] / (box[2] - box[0])),
+                      ceil(height * image_request.size[1] / (box[3] - box[1])))
+            decoded = decode_size((width, height), target, source_format, render_source is not source)
+            with admitted((width, height), image_request.size, decoded=decoded):
+                return run_render(iiif.render_image_request, render_source, image_request)
+
+        cached, data = cached_render(identifier, signature, args, "iiif", render)
+        response = derivative_response(cached, data, iiif.FORMATS[fmt][1], etag, modified)
+        response.headers.update(iiif_headers())
+        return response
+
+
+def derived_pdf(identifier, source, signature, variant, write):
+    """
+    Retrieve a pdf derived from another from the derivative cache, or
+    write (and cache) it
+
+    __Args__
+    1) identifier (str): The (unquoted) identifier
+    2) source (str): The pdf it is derived from
+    3) signature (tuple): The stat signature of the source, or None
+    4) variant (dict): What determines the derived pdf, eg its pages
+    5) write (callable): Writes the derived pdf to the path it is called with
+
+    __Return Values__
+    * (file/bytes) The cached pdf, opened for reading, or when it isn't
+        cached its content, which (unlike a file) may be served to many
+        requests
+    """
+    def write_uncached():
+        with TemporaryDirectory() as tmp:
+            with metrics.stage("write_pdf"):
+                write(join(tmp, "derived.pdf"))
+            with open(join(tmp, "derived.pdf"), "rb") as f:
+                return f.read()
+
+    if signature is None:
+        return write_uncached()
+    cache = derivative_cache()
+    key = DerivativeCache.make_key(identifier, variant, "pdf", signature)
+    if cache is None:
+        return coalescer().do(key, write_uncached)
+    cached = cache.get(key)
+    if cached is not None:
+        metrics.count("derivative_cache_requests_total", result="hit")
+        return cached
+    metrics.count("derivative_cache_requests_total", result="miss")
+
+    def produce():
+        # Leaders in other processes wait for ours, see SingleFlight
+        cached = cache.get(key, count=False)
+        if cached is not None:
+            cached.close()
+            return
+        with metrics.stage("write_pdf"):
+            cache.put_file(key, write)
+
+    # Identical requests which arrive while this one is writing wait for
+    # it, then each opens the result for itself
+    coalescer().do(key, produce)
+    # Unless it has already been evicted again
+    return cache.get(key, count=False) or write_uncached()
 
 
 class GetPdf(Resource):
     def get(self, identifier):
-        storage_kls = determine_identifier_type(unquote(identifier))
+        parser = reqparse.RequestParser()
+        parser.add_argument('pages', type=str, location='args')
+        args = parser.parse_args()
+        identifier = unquote(identifier)
+        storage_kls = determine_identifier_type(identifier)
         storage_instance = storage_kls(BLUEPRINT.config)
 
-        # PDFs have to be explicit at the moment, and don't
-        # support transformation because of (I believe) the following
-        # issues in Pillow:
-        # https://github.com/python-pillow/Pillow/issues/1630
-        # https://github.com/python-pillow/Pillow/issues/2049
-        #
-        # TODO: When/if the above are fixed follow the same
-        # formula as the tif and jpg endpoints here for dynamic
-        # generation if no explicit option is available
-        # TODO: Test if this effects generating things _from_ pdf
-
+        # PDFs have to be explicit, Pillow can't produce them from
+        # images. Images of their pages are produced by the /jpg and
+        # /tif endpoints (see lib.pdf) rather than here.
         log.info("Utilizing explicit pdf retrieval implementation")
-        return send_file(storage_instance.get_pdf(unquote(identifier)))
+        source = existence_cache().lookup(storage_instance, identifier, "pdf")
+        signature = source_signature(source)
+
+        if args['pages']:
+            writer = pdf.get_writer(BLUEPRINT.config.get("PDF_WRITER"))
+            pages = pdf.parse_pages(args['pages'], pdf.page_count(writer, source, signature))
+            variant = {"pages": pdf.format_pages(pages), "linearized": writer.can_linearize}
+            log.info("Extracting pages {} of the pdf".format(variant["pages"]))
+            derived = derived_pdf(identifier, source, signature, variant,
+                                  lambda out: writer.extract(source, pages, out,
+                                                             linearize=writer.can_linearize))
+            return serve_file(derived, "application/pdf", "DOCUMENT", identifier, "pdf",
+                              variant["pages"], writer.name, signature=signature)
+
+        try:
+            linearized = storage_instance.get_pdf_linearized(identifier)
+        except Omitted:
+            linearized = None
+        if linearized is not None:
+            log.info("Utilizing the pre-built linearized pdf")
+            return serve_file(linearized, "application/pdf", "DOCUMENT", identifier, "pdf_linearized")
+        if BLUEPRINT.config.get("PDF_LINEARIZE") and signature is not None and \
+                derivative_cache() is not None:
+            # Linearizing is an optimization, without qpdf the pdf is sent as is
+            try:
+                writer = pdf.get_writer(BLUEPRINT.config.get("PDF_WRITER"))
+            except PDFWriterUnavailableError:
+                writer = None
+            if writer is not None and writer.can_linearize:
+                variant = {"linearized": True}
+                derived = derived_pdf(identifier, source, signature, variant,
+                                      lambda out: writer.linearize(source, out))
+                return serve_file(derived, "application/pdf", "DOCUMENT", identifier, "pdf_linearized",
+                                  signature=signature)
+        return serve_file(source, "application/pdf", "DOCUMENT", identifier, "pdf")
 
 
 class GetTifTechnicalMetadata(Resource):
@@ -263,7 +1135,7 @@ class GetTifTechnicalMetadata(Resource):
         storage_kls = determine_identifier_type(unquote(identifier))
         storage_instance = storage_kls(BLUEPRINT.config)
         log.info("Attempting to retrieve tif technical metadata")
-        return storage_instance.get_tif_techmd(unquote(identifier))
+        return serve_techmd(storage_instance, unquote(identifier), "tif")
 
 
 class GetJpgTechnicalMetadata(Resource):
@@ -271,7 +1143,7 @@ class GetJpgTechnicalMetadata(Resource):
         storage_kls = determine_identifier_type(unquote(identifier))
         storage_instance = storage_kls(BLUEPRINT.config)
         log.info("Attempting to retrieve jpg technical metadata")
-        return storage_instance.get_jpg_techmd(unquote(identifier))
+        return serve_techmd(storage_instance, unquote(identifier), "jpg")
 
 
 class GetMetadata(Resource):
@@ -279,9 +1151,9 @@ class GetMetadata(Resource):
         storage_kls = determine_identifier_type(unquote(identifier))
         storage_instance = storage_kls(BLUEPRINT.config)
         log.debug("Utilizing explict descriptive metadata retrieval implementation")
-        return send_file(
-            storage_instance.get_descriptive_metadata(unquote(identifier)),
-            mimetype="text/xml"
+        return serve_file(
+            existence_cache().lookup(storage_instance, unquote(identifier), "descriptive_metadata"),
+            "text/xml", "DOCUMENT", unquote(identifier), "metadata"
         )
 
 
@@ -290,12 +1162,109 @@ class GetLimbOcr(Resource):
         storage_kls = determine_identifier_type(unquote(identifier))
         storage_instance = storage_kls(BLUEPRINT.config)
         log.debug("Utilizing explicit limb OCR retreival implementation")
-        return send_file(
-            storage_instance.get_limb_ocr(unquote(identifier)),
-            mimetype="text"
+        return serve_file(
+            existence_cache().lookup(storage_instance, unquote(identifier), "limb_ocr"),
+            "text", "DOCUMENT", unquote(identifier), "limb_ocr"
         )
 
 
+def ocr_record(identifier):
+    """
+    Return the indexed OCR of a page, and the validators derived from its
+    ALTO file
+    """
+    storage_kls = determine_identifier_type(identifier)
+    storage_instance = storage_kls(BLUEPRINT.config)
+    path = existence_cache().lookup(storage_instance, identifier, "limb_ocr")
+    record = ocr_index().get(identifier, path)
+    signature = (record['mtime_ns'], record['bytes'])
+    return record, signature
+
+
+class GetOcrText(Resource):
+    def get(self, identifier):
+        identifier = unquote(identifier)
+        record, signature = ocr_record(identifier)
+        etag = make_etag(signature, identifier, "ocr_text")
+        modified = last_modified(signature)
+        response = not_modified(etag, modified, "DOCUMENT")
+        if response is None:
+            response = Response(record['text'], mimetype="text/plain")
+            response.headers.update(validator_headers(etag, modified, "DOCUMENT"))
+        return response
+
+
+class GetOcrWords(Resource):
+    def get(self, identifier):
+        parser = reqparse.RequestParser()
+        parser.add_argument('region', type=str, location='args')
+        args = parser.parse_args()
+        identifier = unquote(identifier)
+        region = None
+        if args['region']:
+            try:
+                x, y, w, h = (int(v) for v in args['region'].split(","))
+            except ValueError:
+                raise InvalidRegionError("Invalid region: {}".format(args['region']))
+            region = (x, y, x + w, y + h)
+        record, signature = ocr_record(identifier)
+        etag = make_etag(signature, identifier, "ocr_words", args=args)
+        modified = last_modified(signature)
+        response = not_modified(etag, modified, "METADATA")
+        if response is not None:
+            return response
+        words = [{"text": text, "x": box[0], "y": box[1], "width": box[2], "height": box[3]}
+                 for text, box in ocr_index().words(identifier, region)]
+        return serve_json({"identifier": identifier, "width": record['width'],
+                           "height": record['height'], "words": words},
+                          "METADATA", etag=etag, modified=modified)
+
+
+class GetOcrSearch(Resource):
+    def get(self, identifier):
+        parser = reqparse.RequestParser()
+        parser.add_argument('q', type=str, location='args', required=True)
+        parser.add_argument('limit', type=int, location='args')
+        args = parser.parse_args()
+        identifier = unquote(identifier)
+        storage_kls = determine_identifier_type(identifier)
+        storage_instance = storage_kls(BLUEPRINT.config)
+        index = ocr_index()
+        ttl = BLUEPRINT.config.get("OCR_INDEX_CHECK_TTL")
+        # The issue's pages are checked for changes (and only those which
+        # are new or have changed parsed) at most once per ttl, searches
+        # are otherwise answered from the index alone
+        try:
+            index.refresh(identifier, lambda: storage_instance.get_limb_ocr_pages(identifier),
+                          float(ocr.DEFAULT_CHECK_TTL if ttl is None else ttl))
+        except Omitted:
+            raise UnsupportedContextError("{} has no pages to search".format(identifier))
+        hits = index.search(identifier, args['q'], limit=args['limit'] or DEFAULT_OCR_SEARCH_LIMIT)
+        return serve_json({"identifier": identifier, "query": args['q'], "hits": hits}, "METADATA")
+
+
+class Stats(Resource):
+    def get(self):
+        stats = {"coalescing": coalescer().stats(),
+                 "transform_executor": transform_executor().stats(),
+                 "existence_cache": existence_cache().stats(),
+                 "ocr_index": ocr_index().stats(),
+                 "pixel_budget": pixel_budget().stats(),
+                 "remote_storage": remote.stats(),
+                 "directory_scans": get_scan_cache(BLUEPRINT.config.get("DIRECTORY_SCAN_TTL")).stats()}
+        cache = derivative_cache()
+        if cache is not None:
+            stats["derivative_cache"] = cache.stats()
+        if BLUEPRINT.config.get("WATCH"):
+            stats["watch"] = watcher().stats()
+        return stats
+
+
+class Metrics(Resource):
+    def get(self):
+        return Response(metrics.METRICS.expose(), content_type=metrics.CONTENT_TYPE)
+
+
 class Version(Resource):
     def get(self):
         return {"version": __version__}
@@ -316,15 +1285,31 @@ def handle_configs(setup_state):
         log.debug("No verbosity option set, defaulting to WARN")
         logging.basicConfig(level="WARN")
 
+    if BLUEPRINT.config.get("IDENTIFIER_CACHE_SIZE"):
+        REGISTRY.cache_size = int(BLUEPRINT.config['IDENTIFIER_CACHE_SIZE'])
+
+    if BLUEPRINT.config.get("MAX_IMAGE_PIXELS"):
+        # PIL's own decompression bomb check, for images opened in this process
+        Image.MAX_IMAGE_PIXELS = int(BLUEPRINT.config['MAX_IMAGE_PIXELS'])
+
 
 API.add_resource(Root, "/")
 API.add_resource(Version, "/version")
+API.add_resource(Stats, "/stats")
+API.add_resource(Metrics, "/metrics")
+API.add_resource(BatchJpg, "/batch/jpg")
+API.add_resource(IIIFInfo, "/iiif/<path:identifier>/info.json")
+API.add_resource(IIIFImage, "/iiif/<path:identifier>/<region>/<size>/<rotation>/<quality>.<fmt>")
 API.add_resource(Stat, "/<path:identifier>/stat")
+API.add_resource(StatDescendants, "/<path:identifier>/stat/descendants")
 API.add_resource(GetTif, "/<path:identifier>/tif")
 API.add_resource(GetTifTechnicalMetadata, "/<path:identifier>/tif/technical_metadata")
 API.add_resource(GetJpg, "/<path:identifier>/jpg")
 API.add_resource(GetJpgThumbnail, "/<path:identifier>/jpg/thumb")
 API.add_resource(GetJpgTechnicalMetadata, "/<path:identifier>/jpg/technical_metadata")
 API.add_resource(GetLimbOcr, "/<path:identifier>/ocr/limb")
+API.add_resource(GetOcrText, "/<path:identifier>/ocr/text")
+API.add_resource(GetOcrWords, "/<path:identifier>/ocr/words")
+API.add_resource(GetOcrSearch, "/<path:identifier>/ocr/search")
 API.add_resource(GetPdf, "/<path:identifier>/pdf")
 API.add_resource(GetMetadata, "/<path:identifier>/metadata")
@@ -51,6 +51,7 @@ class UnknownIdentifierFormatError(Error):
 
 class UnsupportedContextError(Error):
     err_name = "UnsupportedContextError"
+    status_code = 404
     message = "That context isn't supported for this endpoint!"
 
 
@@ -61,3 +62,93 @@ class ContextError(Error):
 
 class MutuallyExclusiveParametersError(Error):
     err_name = "MutuallyExclusiveParametersError"
+
+
+class BatchSizeError(Error):
+    err_name = "BatchSizeError"
+    status_code = 400
+    message = "Too many identifiers were requested in a single batch"
+
+
+class MissingParametersError(Error):
+    err_name = "MissingParametersError"
+    status_code = 400
+    message = "A required parameter was omitted"
+
+
+class ServiceUnavailableError(Error):
+    err_name = "ServiceUnavailableError"
+    status_code = 503
+    message = "The server is too busy to process this request, try again later"
+
+
+class TransformTimeoutError(Error):
+    err_name = "TransformTimeoutError"
+    status_code = 503
+    message = "Processing the requested image took too long"
+
+
+class IIIFRequestError(Error):
+    err_name = "IIIFRequestError"
+    status_code = 400
+    message = "Invalid IIIF image request"
+
+
+class SourceNotFoundError(Error):
+    err_name = "SourceNotFoundError"
+    status_code = 404
+    message = "The requested file doesn't exist"
+
+
+class InvalidPageError(Error):
+    err_name = "InvalidPageError"
+    status_code = 400
+    message = "The requested page doesn't exist"
+
+
+class PDFRasterizerUnavailableError(Error):
+    err_name = "PDFRasterizerUnavailableError"
+    status_code = 501
+    message = "No pdf rasterizer is installed, images can't be produced from pdfs"
+
+
+class PDFWriterUnavailableError(Error):
+    err_name = "PDFWriterUnavailableError"
+    status_code = 501
+    message = "No pdf writer is installed, pages can't be extracted from pdfs"
+
+
+class InvalidRegionError(Error):
+    err_name = "InvalidRegionError"
+    status_code = 400
+    message = "Regions must be given as x,y,width,height"
+
+
+class InvalidCropError(Error):
+    err_name = "InvalidCropError"
+    status_code = 400
+    message = "Crops must end to the right of and below where they start"
+
+
+class ImageTooLargeError(Error):
+    err_name = "ImageTooLargeError"
+    status_code = 413
+    message = "The requested image is too large to produce"
+
+
+class InvalidFormatError(Error):
+    err_name = "InvalidFormatError"
+    status_code = 400
+    message = "The requested format isn't supported"
+
+
+class InvalidResampleError(Error):
+    err_name = "InvalidResampleError"
+    status_code = 400
+    message = "The requested resampling filter isn't supported"
+
+
+class RemoteStorageError(Error):
+    err_name = "RemoteStorageError"
+    status_code = 502
+    message = "The remote store holding the requested file failed to respond"
@@ -1,14 +1,49 @@
 import logging
 import sys
-import inspect
-from math import floor
-from ..exceptions import MutuallyExclusiveParametersError, UnknownIdentifierFormatError
+from math import floor, ceil
+from ..exceptions import MutuallyExclusiveParametersError, UnknownIdentifierFormatError, \
+    Omitted, SourceNotFoundError, InvalidResampleError, MissingParametersError, InvalidCropError
 from .storageinterfaces import *
+from .registry import IdentifierRegistry
+from .techmd import image_dimensions
+from . import metrics
+from .existence import ExistenceCache
+from .encoders import encode
 from PIL import Image
 
 
 log = logging.getLogger(__name__)
 
+# How much larger than the requested size a reduced resolution decode must
+# be, so that the final resampling step still has real pixels to work with.
+# Mirrors the default reducing_gap of PIL.Image.thumbnail()
+DRAFT_REDUCING_GAP = 2.0
+
+# Resampling filters which may be requested by name
+RESAMPLE_FILTERS = {
+    "nearest": Image.NEAREST,
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS
+}
+
+# Large downscales are first reduced by an integer factor, averaging
+# blocks of pixels, to no less than this many times the requested size,
+# and only then resampled with the requested filter. Pillow documents 3.0
+# as indistinguishable from resampling the whole image. None resamples
+# the whole image.
+RESIZE_REDUCING_GAP = 3.0
+
+# Probes the filesystem every time, for callers without an ExistenceCache
+UNCACHED = ExistenceCache(ttl=0)
+
+# Built once, on import, from the classes in the storageinterfaces module
+REGISTRY = IdentifierRegistry.from_module(
+    sys.modules['digcollretriever.blueprint.lib.storageinterfaces']
+)
+
 
 def sane_transform_args(args, o_width, o_height):
     # Scale and width/height are mutually exclusive
@@ -28,14 +63,12 @@ def sane_transform_args(args, o_width, o_height):
             args['height'] = o_height
             log.debug("Assuming height as default")
     # Quality for jpgs only goes to 95. See Pillow docs
-    # and talk about jpg compression
+    # and talk about jpg compression. Omitted qualities are left to
+    # the default of the output format, see encoders.ENCODERS
     try:
-        if args['quality'] is not None:
-            if args['quality'] > 95:
-                args['quality'] = 95
-                log.info("Quality > 95 passed. Capping value")
-        else:
+        if args['quality'] is not None and args['quality'] > 95:
             args['quality'] = 95
+            log.info("Quality > 95 passed. Capping value")
     except KeyError:
         pass
     # Lets all agree to never make something twice as big
@@ -68,10 +101,15 @@ def sane_transform_args(args, o_width, o_height):
             args['scale'] = .01
             log.info("Scale < .01 passed. Capping value")
     # For cropping you must pass all values
-    if args['cropstartx'] or args['cropstarty'] or args['cropendx'] or args['cropendy']:
-        if not args['cropstartx'] and args['cropstarty'] and args['cropendx'] and args['cropendy']:
-            # TODO make an exception for this
-            raise ValueError()
+    crop = [args.get(x) for x in ('cropstartx', 'cropstarty', 'cropendx', 'cropendy')]
+    if any(x is not None for x in crop) and not all(x is not None for x in crop):
+        raise MissingParametersError(
+            "Cropping requires all of cropstartx, cropstarty, cropendx and cropendy"
+        )
+    if crop[0] is not None and (crop[2] <= crop[0] or crop[3] <= crop[1]):
+        raise InvalidCropError(
+            "cropendx and cropendy must be greater than cropstartx and cropstarty"
+        )
     return args
 
 
@@ -85,19 +123,28 @@ def determine_identifier_type(identifier, omits=[], includes=[]):
 
     Returns: A storage class
     """
-    id_types = [
-        x[1] for x in inspect.getmembers(
-            sys.modules['digcollretriever.blueprint.lib.storageinterfaces'],
-            inspect.isclass
-        )
-    ]
+    if omits or includes:
+        # Uncommon, so don't bother memoizing
+        id_types = [x for x in REGISTRY.classes if x not in omits] + includes
+        for x in id_types:
+            if x.claim_identifier(identifier):
+                metrics.tag(storage=x.__name__)
+                return x
+        raise UnknownIdentifierFormatError()
 
-    id_types = [x for x in id_types if x not in omits] + includes
+    kls = REGISTRY.resolve(identifier)
+    if kls is None:
+        raise UnknownIdentifierFormatError()
+    metrics.tag(storage=kls.__name__)
+    return kls
 
-    for x in id_types:
-        if x.claim_identifier(identifier):
-            return x
-    raise UnknownIdentifierFormatError()
+
+def register_storage_interface(kls):
+    """
+    Register a StorageInterface class which isn't defined in the
+    storageinterfaces module, so that it may claim identifiers
+    """
+    REGISTRY.register(kls)
 
 
 def should_transform(args):
@@ -109,6 +156,202 @@ def should_transform(args):
     return False
 
 
+def target_size(args, o_width, o_height):
+    """
+    Return the (width, height) a set of sane transformation arguments
+    will resize an image to, or None if they don't resize it
+    """
+    if args['width'] and args['height']:
+        return (args['width'], args['height'])
+    if args['scale']:
+        return (floor(o_width * args['scale']), floor(o_height * args['scale']))
+    return None
+
+
+def resample_policy(resample=None, default="lanczos", reducing_gap=RESIZE_REDUCING_GAP):
+    """
+    Validate the resampling policy of a request
+
+    __KWArgs__
+    * resample (str): The filter requested, a key of RESAMPLE_FILTERS, or None
+    * default (str): The filter to use if none was requested
+    * reducing_gap (float): See RESIZE_REDUCING_GAP, falsey values disable
+        the reduction step
+
+    __Return Values__
+    * (tuple) The name of the filter, and the reducing gap
+    """
+    resample = resample or default
+    if resample not in RESAMPLE_FILTERS:
+        raise InvalidResampleError("Unsupported resampling filter: {}".format(resample))
+    # PIL requires a gap of at least 1
+    reducing_gap = float(reducing_gap or 0)
+    return resample, reducing_gap if reducing_gap >= 1 else None
+
+
+def resize(image, size, args, default="lanczos", box=None):
+    """
+    Resize a loaded image according to the resampling policy of a request
+
+    __Args__
+    1) image (PIL.Image.Image): The image
+    2) size (tuple): The (width, height) of the result
+    3) args (dict): The transformation arguments, optionally supplying
+        resample and reducing_gap (see resample_policy())
+
+    __KWArgs__
+    * default (str): The filter to use if args don't name one
+    * box (tuple): The region of the image to resize
+
+    __Return Values__
+    * (PIL.Image.Image) The resized image
+    """
+    resample, reducing_gap = resample_policy(args.get('resample'), default,
+                                             args.get('reducing_gap', RESIZE_REDUCING_GAP))
+    return image.resize(size, resample=RESAMPLE_FILTERS[resample], box=box,
+                        reducing_gap=reducing_gap)
+
+
+def reduced_decode(master, size, reducing_gap=DRAFT_REDUCING_GAP):
+    """
+    Configure a master which hasn't been loaded yet to decode at the
+    smallest available resolution which is still at least reducing_gap
+    times the size requested. The image may then be resized to the
+    requested size as usual.
+
+    Utilizes JPEG DCT scaling and reduced resolution subfiles in TIFFs.
+    """
+    if size is None:
+        return master
+    want = (ceil(size[0] * reducing_gap), ceil(size[1] * reducing_gap))
+    if want[0] >= master.size[0] and want[1] >= master.size[1]:
+        return master
+    if master.format == "JPEG":
+        log.debug("Drafting jpg at reduced scale")
+        master.draft(master.mode, want)
+    elif master.format == "TIFF" and getattr(master, "n_frames", 1) > 1:
+        best = (0, master.size[0] * master.size[1])
+        for i in range(1, master.n_frames):
+            master.seek(i)
+            # NewSubfileType, bit 0 flags a reduced resolution version
+            # of another image in the file
+            if not master.tag_v2.get(254, 0) & 1:
+                continue
+            w, h = master.size
+            if w >= want[0] and h >= want[1] and w * h < best[1]:
+                best = (i, w * h)
+        log.debug("Decoding tif subfile {}".format(best[0]))
+        master.seek(best[0])
+    return master
+
+
+def is_tiled(master):
+    """
+    Whether PIL will decode a master which hasn't been loaded yet a tile
+    at a time, as it does uncompressed tiled tifs (see lib.pyramid), with
+    tiles laid out as decode_tiles() expects. Otherwise masters are
+    decoded whole and cropped.
+    """
+    return len(master.tile) > 1 and hasattr(master, "_size") and all(
+        len(t) == 4 and t[0] == "raw" and len(t[1]) == 4 for t in master.tile
+    )
+
+
+def _with_extents(tile, extents):
+    fields = (tile[0], extents) + tuple(tile[2:])
+    # Tiles are named tuples since Pillow 11, and plain tuples before
+    return type(tile)(*fields) if hasattr(tile, "_fields") else fields
+
+
+def decode_tiles(master, box):
+    """
+    Decode only the tiles of a tiled master which hasn't been loaded yet
+    which intersect a region
+
+    __Args__
+    1) master (PIL.Image.Image): The master
+    2) box (tuple): The (left, upper, right, lower) region
+
+    __Return Values__
+    * (tuple) The loaded image of the intersecting tiles, and the (x, y)
+        position of its upper left corner in the master
+    """
+    hits = [t for t in master.tile
+            if t[1][0] < box[2] and t[1][2] > box[0] and t[1][1] < box[3] and t[1][3] > box[1]]
+    x0, y0 = min(t[1][0] for t in hits), min(t[1][1] for t in hits)
+    x1, y1 = max(t[1][2] for t in hits), max(t[1][3] for t in hits)
+    log.debug("Decoding {} of {} tiles".format(len(hits), len(master.tile)))
+    master.tile = [
+        _with_extents(t, (t[1][0] - x0, t[1][1] - y0, t[1][2] - x0, t[1][3] - y0))
+        for t in hits
+    ]
+    # Decode into an image just large enough for the intersecting tiles
+    master._size = (x1 - x0, y1 - y0)
+    master.load()
+    return master, (x0, y0)
+
+
+def _decode_covering(master, box, size):
+    """
+    Decode the smallest whole-pixel region of a master which hasn't been
+    loaded yet covering box, at the lowest resolution size allows
+
+    __Return Values__
+    * (tuple) The decoded image, and box in its coordinates
+    """
+    o_width, o_height = master.size
+    r_width, r_height = box[2] - box[0], box[3] - box[1]
+    master = reduced_decode(master, (ceil(o_width * size[0] / r_width),
+                                     ceil(o_height * size[1] / r_height)))
+    fx, fy = master.size[0] / o_width, master.size[1] / o_height
+    if (fx, fy) != (1, 1):
+        log.debug("Decoded at reduced resolution {}".format(master.size))
+    box = (box[0] * fx, box[1] * fy, box[2] * fx, box[3] * fy)
+    cover = (floor(box[0]), floor(box[1]),
+             min(ceil(box[2]), master.size[0]), min(ceil(box[3]), master.size[1]))
+    if cover == (0, 0) + master.size:
+        return master, box
+    x0, y0 = 0, 0
+    if is_tiled(master):
+        master, (x0, y0) = decode_tiles(master, cover)
+    cover = (cover[0] - x0, cover[1] - y0, cover[2] - x0, cover[3] - y0)
+    if cover != (0, 0) + master.size:
+        master = master.crop(cover)
+    return master, (box[0] - x0 - cover[0], box[1] - y0 - cover[1],
+                    box[2] - x0 - cover[0], box[3] - y0 - cover[1])
+
+
+def resize_region(master, box, size, resample=Image.LANCZOS, args=None):
+    """
+    Produce a region of a master which hasn't been loaded yet at a given
+    size, decoding as little of it as possible: at the lowest resolution
+    the size allows and, for tiled masters, only the intersecting tiles.
+
+    __Args__
+    1) master (PIL.Image.Image): The master
+    2) box (tuple): The (left, upper, right, lower) region, in native
+        coordinates. These may be fractional.
+    3) size (tuple): The (width, height) of the result
+
+    __KWArgs__
+    * resample (int): The PIL resampling filter
+    * args (dict): Transformation arguments to take the resampling policy
+        from instead, see resize()
+
+    __Return Values__
+    * (PIL.Image.Image) The region, at size
+    """
+    with metrics.stage("decode"):
+        image, box = _decode_covering(master, box, size)
+        image.load()
+    if image.size == tuple(size) and box == (0, 0) + image.size:
+        return image
+    with metrics.stage("resize"):
+        if args is not None:
+            return resize(image, size, args, box=box)
+        return image.resize(size, resample=resample, box=box)
+
+
 def general_transform(master, args):
     """
     Handles resizing, scaling, and cropping
@@ -116,18 +359,302 @@ def general_transform(master, args):
     log.info("Transformation parameter present. Performing transformation.")
     o_width, o_height = master.size
     args = sane_transform_args(args, o_width, o_height)
-    if args['width'] and args['height']:
-        log.debug("Performing transformation according to explicit width/height")
-        master = master.resize((args['width'], args['height']), resample=Image.ANTIALIAS)
-    elif args['scale']:
-        log.debug("Performing transformation according to scaling constant")
-        master = master.resize((floor(o_width * args['scale']),
-                                floor(o_height * args['scale'])), resample=Image.ANTIALIAS)
+    size = target_size(args, o_width, o_height)
     # We can just check for one, sane_args makes sure they're all there
     log.debug(str(args))
     if args['cropstartx'] is not None:
+        crop = (args['cropstartx'], args['cropstarty'], args['cropendx'], args['cropendy'])
+        width, height = size or (o_width, o_height)
+        if 0 <= crop[0] < crop[2] <= width and 0 <= crop[1] < crop[3] <= height:
+            # Map the crop back onto the master, so that only the
+            # region which survives it is decoded and resized
+            log.debug("Performing cropping")
+            fx, fy = o_width / width, o_height / height
+            master = resize_region(master, (crop[0] * fx, crop[1] * fy, crop[2] * fx, crop[3] * fy),
+                                   (crop[2] - crop[0], crop[3] - crop[1]), args=args)
+            log.info("Transformation complete")
+            return master
+    if size is not None:
+        log.debug("Performing transformation according to {}".format(
+            "explicit width/height" if args['width'] else "scaling constant"))
+        with metrics.stage("decode"):
+            master = reduced_decode(master, size)
+            master.load()
+        with metrics.stage("resize"):
+            master = resize(master, size, args)
+    if args['cropstartx'] is not None:
+        # Crops extending past the image are padded, as PIL does
         log.debug("Performing cropping")
-        master = master.crop((args['cropstartx'], args['cropstarty'],
-                              args['cropendx'], args['cropendy']))
+        with metrics.stage("crop"):
+            master = master.crop((args['cropstartx'], args['cropstarty'],
+                                  args['cropendx'], args['cropendy']))
+    log.info("Transformation complete")
+    return master
+
+
+def thumbnail_size(o_width, o_height, box):
+    """
+    Return the size PIL.Image.thumbnail() would produce for an image
+    of the given dimensions fit into box
+    """
+    x, y = box
+    if x >= o_width and y >= o_height:
+        return (o_width, o_height)
+
+    def round_aspect(number, key):
+        return max(min(floor(number), ceil(number), key=key), 1)
+
+    aspect = o_width / o_height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return (x, y)
+
+
+def output_size(args, o_width, o_height, thumbnail=False):
+    """
+    Return the (width, height) an image of the given dimensions will be
+    transformed to
+
+    __Args__
+    1) args (dict): The transformation arguments
+    2) o_width (int): The width of the image
+    3) o_height (int): The height of the image
+
+    __KWArgs__
+    * thumbnail (bool): Whether the image will be thumbnailed
+    """
+    if not thumbnail and not should_transform(args):
+        return (o_width, o_height)
+    args = sane_transform_args(dict(args), o_width, o_height)
+    if thumbnail:
+        return thumbnail_size(o_width, o_height, (args['width'], args['height']))
+    if args.get('cropstartx') is not None:
+        return (args['cropendx'] - args['cropstartx'], args['cropendy'] - args['cropstarty'])
+    return target_size(args, o_width, o_height) or (o_width, o_height)
+
+
+def decode_target(args, o_width, o_height, thumbnail=False):
+    """
+    Return the (width, height) a set of transformation arguments resize
+    the whole of an image of the given dimensions to, before any crop, or
+    None if they don't resize it
+
+    __Args__
+    1) args (dict): The transformation arguments
+    2) o_width (int): The width of the image
+    3) o_height (int): The height of the image
+
+    __KWArgs__
+    * thumbnail (bool): Whether the image will be thumbnailed
+    """
+    if not thumbnail and not should_transform(args):
+        return None
+    args = sane_transform_args(dict(args), o_width, o_height)
+    if thumbnail:
+        return thumbnail_size(o_width, o_height, (args['width'], args['height']))
+    return target_size(args, o_width, o_height)
+
+
+def decode_size(o_size, size, source_format=None, pyramid=False,
+                reducing_gap=DRAFT_REDUCING_GAP):
+    """
+    Return the (width, height) reduced_decode() will decode a master at
+    when the whole of it is resized to size, from its dimensions alone,
+    so that the master needn't be opened to find out
+
+    __Args__
+    1) o_size (tuple): The (width, height) of the master
+    2) size (tuple): The (width, height) the whole master will be resized
+        to, or None
+
+    __KWArgs__
+    * source_format (str): The format of the master, jpgs are drafted
+    * pyramid (bool): Whether the master is a pyramidal tif written by
+        lib.pyramid, with a reduced resolution subfile for each halving
+    * reducing_gap (float): As for reduced_decode()
+
+    __Return Values__
+    * (tuple) The (width, height) of the decoded image
+    """
+    o_size = tuple(o_size)
+    if size is None:
+        return o_size
+    want = (ceil(size[0] * reducing_gap), ceil(size[1] * reducing_gap))
+    if want[0] >= o_size[0] and want[1] >= o_size[1]:
+        return o_size
+    if source_format == "jpg":
+        # As PIL's JpegImageFile.draft() picks the DCT scale
+        scale = min(o_size[0] // want[0], o_size[1] // want[1])
+        scale = next(x for x in (8, 4, 2, 1) if scale >= x or x == 1)
+        return (ceil(o_size[0] / scale), ceil(o_size[1] / scale))
+    if pyramid:
+        from .pyramid import DEFAULT_TILE_SIZE
+        best = level = o_size
+        while max(level) > DEFAULT_TILE_SIZE:
+            level = (ceil(level[0] / 2), ceil(level[1] / 2))
+            if level[0] < want[0] or level[1] < want[1]:
+                break
+            best = level
+        return best
+    # Reduced resolution subfiles of other tifs can't be known of
+    # without reading them
+    return o_size
+
+
+def pixel_cost(o_size, size):
+    """
+    An upper bound on the pixels held in memory while transforming an image
+    decoded at o_size to size: the decoded image and the result
+    """
+    return o_size[0] * o_size[1] + size[0] * size[1]
+
+
+def thumbnail_transform(master, args):
+    """
+    Handles thumbnailing, which preserves aspect ratio within the
+    bounding box described by width and height
+    """
+    log.info("Performing transformation.")
+    o_width, o_height = master.size
+    args = sane_transform_args(args, o_width, o_height)
+    size = thumbnail_size(o_width, o_height, (args['width'], args['height']))
+    if size != (o_width, o_height):
+        # Computed against the native dimensions, so that decoding at a
+        # reduced resolution doesn't alter the result's dimensions
+        with metrics.stage("decode"):
+            master = reduced_decode(master, size)
+            master.load()
+        with metrics.stage("resize"):
+            master = resize(master, size, args, default="bicubic")
     log.info("Transformation complete")
     return master
+
+
+def resolve_source(storage_instance, identifier, formats, existence=None):
+    """
+    Walk the fallback chain of a storage instance, skipping formats which
+    are omitted or don't exist on disk
+
+    __Args__
+    1) storage_instance (StorageInterface): The storage instance
+    2) identifier (str): The identifier
+    3) formats (list[str]): The formats to try, in order, eg ["jpg", "tif", "pdf"]
+
+    __KWArgs__
+    * existence (ExistenceCache): Remembers which formats exist
+
+    __Return Values__
+    * (tuple) The source (a filepath or file like object) and the format it is in
+    """
+    existence = existence or UNCACHED
+    missing = None
+    for x in formats:
+        try:
+            source = existence.lookup(storage_instance, identifier, x)
+        except Omitted:
+            log.debug("{} retrieval functionality omitted, falling back".format(x))
+            metrics.count("fallbacks_total", omitted=x)
+            continue
+        except SourceNotFoundError as e:
+            log.debug("No {} exists, falling back".format(x))
+            metrics.count("missing_sources_total", missing=x)
+            missing = e
+            continue
+        log.info("Utilized {} retrieval implementation".format(x))
+        metrics.tag(format=x)
+        return source, x
+    if missing is not None:
+        raise missing
+    raise Omitted()
+
+
+def prefer_derivative(storage_instance, identifier, source, args, thumbnail=False, index=None):
+    """
+    Swap a master for the smallest pre-built jpg derivative which is
+    at least as large as the requested output, if the storage instance
+    provides any.
+
+    The transformation arguments are resolved against the dimensions of the
+    master, and returned as an explicit width/height, so that the result
+    is identical save for the source pixels.
+
+    __KWArgs__
+    * thumbnail (bool): Whether the request is for a thumbnail
+    * index (TechmdIndex): An index to read dimensions from, rather than the images
+
+    __Return Values__
+    * (tuple) The source, arguments and thumbnail flag to render with
+    """
+    try:
+        derivatives = storage_instance.get_jpg_derivatives(identifier)
+    except Omitted:
+        return source, args, thumbnail
+    o_width, o_height = image_dimensions(source, index)
+    args = sane_transform_args(dict(args), o_width, o_height)
+    if thumbnail:
+        size = thumbnail_size(o_width, o_height, (args['width'], args['height']))
+    else:
+        size = target_size(args, o_width, o_height)
+    if size is None:
+        # Native resolution is required
+        return source, args, thumbnail
+
+    best = None
+    for path in derivatives:
+        d_width, d_height = image_dimensions(path, index)
+        if d_width >= size[0] and d_height >= size[1]:
+            if best is None or d_width * d_height < best[1]:
+                best = (path, d_width * d_height)
+    if best is None:
+        return source, args, thumbnail
+    log.info("Utilizing pre-built derivative {}".format(best[0]))
+    args.update({'width': size[0], 'height': size[1], 'scale': None})
+    for x in ('cropstartx', 'cropstarty', 'cropendx', 'cropendy'):
+        args.setdefault(x, None)
+    return best[0], args, False
+
+
+def prefer_pyramid(storage_instance, identifier, source):
+    """
+    Swap a tif master for its tiled, pyramidal copy, if the storage
+    instance provides one
+
+    __Return Values__
+    * (str/file like object) The source to render from
+    """
+    try:
+        pyramid = storage_instance.get_tif_pyramid(identifier)
+    except Omitted:
+        return source
+    log.info("Utilizing pyramidal tif {}".format(pyramid))
+    return pyramid
+
+
+def render_derivative(source, args, output_format, thumbnail=False):
+    """
+    Open a master, transform it and encode it
+
+    __Args__
+    1) source (str/file like object): The master
+    2) args (dict): The transformation arguments
+    3) output_format (str): The format to encode to, a key of
+        encoders.ENCODERS, eg "jpg", "webp" or "tif"
+
+    __KWArgs__
+    * thumbnail (bool): Thumbnail rather than resize/scale/crop
+
+    __Return Values__
+    * (bytes) The encoded derivative
+    """
+    with metrics.stage("open"):
+        master = Image.open(source)
+    if thumbnail:
+        master = thumbnail_transform(master, args)
+    elif should_transform(args):
+        master = general_transform(master, args)
+    else:
+        with metrics.stage("decode"):
+            master.load()
+    return encode(master, output_format, args)
@@ -0,0 +1,100 @@
+"""
+Helpers for producing many derivatives in a single request
+"""
+import json
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
+
+from ..exceptions import Error
+
+
+log = logging.getLogger(__name__)
+
+# Characters left unescaped in part headers, which (unlike control
+# characters, spaces and angle brackets) can't end a header or the msg-id
+# of a Content-ID
+HEADER_SAFE = "/:@!$&'()*+,;=-._~"
+
+
+def error_part(identifier, e):
+    """
+    Describe a failure to produce a single item of a batch
+
+    __Return Values__
+    * (tuple) An HTTP status code and a JSON serializable dict
+    """
+    if isinstance(e, Error):
+        status, body = e.status_code, e.to_dict()
+    elif isinstance(e, FileNotFoundError):
+        status, body = 404, {"message": "No such file", "error_name": "FileNotFoundError"}
+    else:
+        status, body = 500, {"message": str(e), "error_name": type(e).__name__}
+    body["identifier"] = identifier
+    return status, body
+
+
+def iter_batch(identifiers, job, workers):
+    """
+    Run job(identifier) for each identifier on a pool of worker threads
+
+    __Args__
+    1) identifiers (list[str]): The identifiers
+    2) job (callable): Produces the bytes for a single identifier
+    3) workers (int): The number of threads to use
+
+    __Return Values__
+    * (generator) (identifier, status, content type, body) tuples, in
+        the order the items complete. Failures don't end the batch.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {executor.submit(job, x): x for x in identifiers}
+    try:
+        for future in as_completed(futures):
+            identifier = futures[future]
+            try:
+                yield identifier, 200, None, future.result()
+            except Exception as e:
+                log.info("Batch item {} failed: {}".format(identifier, e))
+                status, body = error_part(identifier, e)
+                yield identifier, status, "application/json", json.dumps(body).encode("utf-8")
+    finally:
+        # If the client went away there's no reason to keep working
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def multipart_stream(items, content_type, boundary=None):
+    """
+    Encode batch items as a multipart/mixed body, one part at a time.
+    Identifiers are percent encoded in the Content-ID of their part, so
+    that those supplied by clients can't inject headers or boundaries.
+
+    __Args__
+    1) items (iterable): (identifier, status, content type, body) tuples.
+        A content type of None indicates content_type
+    2) content_type (str): The content type of successful items
+
+    __KWArgs__
+    * boundary (str): The multipart boundary, generated if omitted
+
+    __Return Values__
+    * (tuple) The boundary, and a generator of bytes
+    """
+    boundary = boundary or uuid.uuid4().hex
+
+    def generate():
+        for identifier, status, part_type, body in items:
+            headers = "\r\n".join([
+                "--" + boundary,
+                "Content-Type: " + (part_type or content_type),
+                "Content-ID: <{}>".format(quote(identifier, safe=HEADER_SAFE)),
+                "Content-Length: {}".format(len(body)),
+                "X-Status: {}".format(status)
+            ])
+            yield headers.encode("utf-8") + b"\r\n\r\n" + body + b"\r\n"
+        yield "--{}--\r\n".format(boundary).encode("utf-8")
+
+    return boundary, generate()
@@ -0,0 +1,89 @@
+"""
+Admission control of image work by the number of pixels it holds in memory
+"""
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from ..exceptions import ImageTooLargeError, ServiceUnavailableError
+
+
+log = logging.getLogger(__name__)
+
+
+class PixelBudget:
+    """
+    A semaphore counting pixels rather than jobs.
+
+    Each job reserves (an upper bound on) the pixels it will decode and
+    produce before doing so, and waits, first come first served, while the
+    reservations of the jobs already running would exceed the budget.
+    Jobs which wait longer than timeout are rejected with a
+    ServiceUnavailableError, and jobs larger than the whole budget are
+    rejected immediately with an ImageTooLargeError.
+    """
+    def __init__(self, max_pixels, timeout=None):
+        """
+        __Args__
+        1) max_pixels (int): The number of pixels which may be reserved at once
+
+        __KWArgs__
+        * timeout (float): Seconds a job may wait for its reservation
+        """
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+        self.in_use = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._cond = threading.Condition()
+        self._waiters = deque()
+
+    def acquire(self, pixels):
+        if pixels > self.max_pixels:
+            self.rejected += 1
+            raise ImageTooLargeError(
+                "Producing this image requires {} pixels, more than the {} this server allows "
+                "at once".format(pixels, self.max_pixels)
+            )
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            token = object()
+            self._waiters.append(token)
+            try:
+                while self._waiters[0] is not token or self.in_use + pixels > self.max_pixels:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.timed_out += 1
+                        log.warning("Waited {}s for {} pixels, rejecting job".format(self.timeout, pixels))
+                        raise ServiceUnavailableError()
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters.remove(token)
+                # The next in line may fit now
+                self._cond.notify_all()
+            self.in_use += pixels
+            self.admitted += 1
+
+    def release(self, pixels):
+        with self._cond:
+            self.in_use -= pixels
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, pixels):
+        """
+        Hold a reservation of pixels for the duration of a with block
+        """
+        self.acquire(pixels)
+        try:
+            yield
+        finally:
+            self.release(pixels)
+
+    def stats(self):
+        return {"max_pixels": self.max_pixels, "in_use": self.in_use,
+                "waiting": len(self._waiters), "admitted": self.admitted,
+                "rejected": self.rejected, "timed_out": self.timed_out}
@@ -0,0 +1,246 @@
+"""
+A content addressed, on disk cache for derivative images.
+
+Entries are keyed on the identifier, the normalized transformation
+arguments, the output format and the stat signature of the master the
+derivative was produced from, so a changed master simply stops matching
+its old entries (which then age out of the LRU, or are removed promptly
+by invalidate(), see lib.watch).
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+def normalize_args(args):
+    """
+    Produce a stable, hashable representation of a set of request arguments
+
+    __Args__
+    1) args (dict): The parsed request arguments
+
+    __Return Values__
+    * (tuple) sorted (key, value) pairs, omitting keys whose value is None
+    """
+    return tuple(sorted((k, v) for k, v in args.items() if v is not None))
+
+
+def source_signature(source):
+    """
+    Return a (mtime_ns, size) tuple for a master, or None if the master
+    is not something we can stat (eg, a file like object). File like
+    objects may provide their own, as a signature attribute, eg
+    remote.RemoteFile.
+    """
+    if not isinstance(source, (str, bytes)):
+        return getattr(source, "signature", None)
+    try:
+        st = os.stat(source)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class DerivativeCache:
+    """
+    A size bounded LRU cache of derivative files on disk.
+
+    Writes are atomic (written to a temporary file in the cache root and
+    then renamed into place), so concurrent readers, including readers in
+    other worker processes sharing the same root, never see partial files.
+    Each process keeps its own recency index, which is seeded from the
+    access times of the files already on disk, and enforces the byte
+    budget against it alone, so a root shared by N processes may hold up
+    to N times max_bytes. Hits are returned as open files, which remain
+    readable if another process evicts them.
+    """
+    def __init__(self, root, max_bytes):
+        """
+        __Args__
+        1) root (str): The directory to store cached derivatives in
+        2) max_bytes (int): The byte budget for the cache
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def identifier_prefix(identifier):
+        """
+        The prefix shared by the keys of every derivative of an identifier,
+        which therefore also share a directory
+        """
+        return hashlib.sha1(identifier.encode("utf-8")).hexdigest()[:16]
+
+    @classmethod
+    def make_key(cls, identifier, args, fmt, signature):
+        """
+        Build the cache key for a derivative
+
+        __Args__
+        1) identifier (str): The identifier of the master
+        2) args (dict): The transformation arguments
+        3) fmt (str): The output format of the derivative
+        4) signature (tuple): The stat signature of the master
+
+        __Return Values__
+        * (str) A hex digest
+        """
+        material = json.dumps(
+            [identifier, normalize_args(args), fmt, list(signature)],
+            sort_keys=True
+        )
+        return cls.identifier_prefix(identifier) + hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _scan(self):
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for fname in filenames:
+                if fname.startswith(".tmp-"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, fname))
+                except OSError:
+                    continue
+                found.append((st.st_atime, fname, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total += size
+        log.debug("Derivative cache at {} seeded with {} entries".format(self.root, len(self._entries)))
+        self._evict()
+
+    def get(self, key, count=True):
+        """
+        Return a cached derivative, opened for reading, or None on a miss
+
+        __KWArgs__
+        * count (bool): Whether to count the lookup in the hit and miss
+            statistics
+        """
+        try:
+            f = open(self.path_for(key), "rb")
+        except FileNotFoundError:
+            f = None
+        with self._lock:
+            if f is None:
+                if key in self._entries:
+                    # Removed out from under us
+                    self._total -= self._entries.pop(key)
+                self.misses += count
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                # Written by another process sharing the cache root
+                self._entries[key] = os.fstat(f.fileno()).st_size
+                self._total += self._entries[key]
+            self.hits += count
+            return f
+
+    def put(self, key, data):
+        """
+        Atomically store a derivative
+
+        __Args__
+        1) key (str): The cache key
+        2) data (bytes): The encoded derivative
+
+        __Return Values__
+        * (str) The path the derivative was stored at
+        """
+        def write(tmp):
+            with open(tmp, "wb") as f:
+                f.write(data)
+        return self.put_file(key, write)
+
+    def put_file(self, key, write):
+        """
+        Atomically store a derivative which is written to disk by something
+        else, eg a subprocess, rather than held in RAM
+
+        __Args__
+        1) key (str): The cache key
+        2) write (callable): Called with a path to write the derivative to
+
+        __Return Values__
+        * (str) The path the derivative was stored at
+        """
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=self.root)
+        os.close(fd)
+        try:
+            write(tmp)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._entries.pop(key)
+            self._entries[key] = size
+            self._total += size
+            self._evict()
+        return path
+
+    def invalidate(self, identifier):
+        """
+        Remove every cached derivative of an identifier, including those
+        written by other processes sharing the cache root
+
+        __Return Values__
+        * (int) The number of derivatives removed
+        """
+        prefix = self.identifier_prefix(identifier)
+        dir_path = os.path.dirname(self.path_for(prefix))
+        try:
+            fnames = os.listdir(dir_path)
+        except FileNotFoundError:
+            return 0
+        removed = 0
+        for fname in fnames:
+            if not fname.startswith(prefix):
+                continue
+            try:
+                os.remove(os.path.join(dir_path, fname))
+                removed += 1
+            except OSError:
+                pass
+            with self._lock:
+                if fname in self._entries:
+                    self._total -= self._entries.pop(fname)
+        if removed:
+            log.debug("Removed {} derivatives of {} from the cache".format(removed, identifier))
+        return removed
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            log.debug("Evicting {} from the derivative cache".format(key))
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self._total,
+                "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses}
@@ -0,0 +1,117 @@
+"""
+Deduplication of identical, concurrent derivative requests
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Ensures only one thread computes the result for a given key at a time.
+    Threads requesting a key which is already being computed wait for, and
+    share, the result of the first.
+
+    If a lock_dir is given the leading thread also holds an exclusive lock
+    file for the key while computing, so that leaders in other processes
+    sharing the lock_dir wait too. Those leaders still compute the result
+    themselves afterwards, so the function should check a shared cache
+    (eg, the derivative cache) before doing any work.
+    """
+    def __init__(self, lock_dir=None):
+        """
+        __KWArgs__
+        * lock_dir (str): A directory for cross process lock files
+        """
+        self.lock_dir = lock_dir
+        self.leaders = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+        if self.lock_dir:
+            if fcntl is None:
+                log.warning("fcntl unavailable, coalescing across processes is disabled")
+                self.lock_dir = None
+            else:
+                os.makedirs(self.lock_dir, exist_ok=True)
+
+    @contextmanager
+    def _process_lock(self, key):
+        if not self.lock_dir:
+            yield
+            return
+        path = os.path.join(self.lock_dir, key + ".lock")
+        while True:
+            f = open(path, "a")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.path.samestat(os.stat(path), os.fstat(f.fileno())):
+                    break
+            except FileNotFoundError:
+                pass
+            # The holder we waited for removed the file, lock afresh
+            f.close()
+        try:
+            yield
+        finally:
+            # Lock files are removed while still held, so that there is
+            # one per request in flight rather than per request ever made
+            os.remove(path)
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def do(self, key, fn):
+        """
+        Return fn(), or the result of a concurrent call with the same key
+
+        __Args__
+        1) key (str): Identifies calls which produce identical results.
+            Must be usable as a filename if a lock_dir is in use.
+        2) fn (callable): Produces the result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            log.debug("Coalescing with in flight request for {}".format(key))
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            with self._process_lock(key):
+                call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def stats(self):
+        return {"leaders": self.leaders, "coalesced": self.coalesced,
+                "in_flight": len(self._calls)}
@@ -0,0 +1,70 @@
+"""
+Validators for conditional GET support
+"""
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from .cache import normalize_args
+
+
+# Cache-Control policies for each class of endpoint, overridable via
+# the CACHE_CONTROL_<CLASS> config values
+DEFAULT_CACHE_CONTROL = {
+    "IMAGE": "public, max-age=86400",
+    "DOCUMENT": "public, max-age=86400",
+    "METADATA": "public, max-age=3600"
+}
+
+
+def make_etag(signature, *parts, args=None):
+    """
+    Build a strong ETag for a response
+
+    __Args__
+    1) signature (tuple): The stat signature of the master the response
+        is derived from, or None
+    2) *parts: Anything else which determines the content of the response
+
+    __KWArgs__
+    * args (dict): Request arguments, normalized before hashing
+
+    __Return Values__
+    * (str) The (unquoted) ETag
+    """
+    material = json.dumps(
+        [list(signature) if signature else None, [str(x) for x in parts],
+         normalize_args(args) if args else None]
+    )
+    return hashlib.sha1(material.encode("utf-8")).hexdigest()
+
+
+def last_modified(signature):
+    """
+    Return the datetime a stat signature was last modified, or None
+    """
+    if not signature or not signature[0]:
+        return None
+    return datetime.fromtimestamp(signature[0] // 1000000000, tz=timezone.utc)
+
+
+def is_not_modified(if_none_match, if_modified_since, etag, modified):
+    """
+    Determine if a 304 response is appropriate
+
+    __Args__
+    1) if_none_match (werkzeug.datastructures.ETags): The request's If-None-Match
+    2) if_modified_since (datetime): The request's If-Modified-Since, or None
+    3) etag (str): The ETag of the would be response
+    4) modified (datetime): The Last-Modified of the would be response, or None
+
+    __Return Values__
+    * (bool)
+    """
+    # If-None-Match takes precedence, see RFC 7232 section 6, and is
+    # compared weakly, so ETags weakened by proxies still match
+    if if_none_match:
+        return if_none_match.contains_weak(etag) or if_none_match.star_tag
+    if if_modified_since is not None and modified is not None:
+        return modified <= if_modified_since
+    return False
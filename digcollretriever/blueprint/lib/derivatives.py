@@ -0,0 +1,114 @@
+"""
+Batch production of the standard jpg derivatives of mvol pages.
+
+    digcollretriever-build-derivatives --mvol-root /path/to/mvol/parent
+
+Derivatives are written beside the masters (or under --derivative-root)
+as described by MvolLayer4StorageInterface.derivative_path(). A
+derivative is only (re)built if it is missing or older than its master,
+so interrupted runs may simply be restarted.
+"""
+import logging
+import os
+from functools import partial
+from os.path import join, isfile
+
+from PIL import Image
+
+from . import reduced_decode, thumbnail_size
+from .storageinterfaces import MvolLayer4StorageInterface
+from .tools import write_atomically, run_jobs, format_counts, make_parser, add_mvol_args, \
+    add_build_args, parse_args
+
+
+log = logging.getLogger(__name__)
+
+
+def iter_mvol_pages(mvol_root):
+    """
+    Yield the identifiers of every mvol page with a tif master
+
+    __Args__
+    1) mvol_root (str): The directory containing the "mvol" directory
+    """
+    for dirpath, dirnames, filenames in os.walk(join(mvol_root, "mvol")):
+        dirnames.sort()
+        if os.path.basename(dirpath) != "TIFF":
+            continue
+        for fname in sorted(filenames):
+            identifier, ext = os.path.splitext(fname)
+            if ext == ".tif" and MvolLayer4StorageInterface.claim_identifier(identifier):
+                yield identifier
+
+
+def stale_derivatives(storage_instance, identifier, force=False):
+    """
+    Return the (size name, longest edge, path) of each derivative of a page
+    which is missing or older than its master
+    """
+    master_mtime = os.stat(storage_instance.get_tif(identifier)).st_mtime
+    stale = []
+    for name, edge in storage_instance.DERIVATIVE_SIZES:
+        path = storage_instance.derivative_path(identifier, name)
+        if force or not isfile(path) or os.stat(path).st_mtime < master_mtime:
+            stale.append((name, edge, path))
+    return stale
+
+
+def build_page_derivatives(conf, identifier, quality=90, force=False):
+    """
+    Build the stale derivatives of a single page
+
+    __Return Values__
+    * (list[str]) The names of the sizes which were built
+    """
+    storage_instance = MvolLayer4StorageInterface(conf)
+    stale = stale_derivatives(storage_instance, identifier, force=force)
+    if not stale:
+        return []
+    with Image.open(storage_instance.get_tif(identifier)) as master:
+        o_width, o_height = master.size
+        # Only decode what the largest stale derivative requires
+        sizes = {}
+        for name, edge, _ in stale:
+            box = (edge, edge) if edge else (o_width, o_height)
+            sizes[name] = thumbnail_size(o_width, o_height, box)
+        largest = max(sizes.values())
+        image = reduced_decode(master, largest)
+        image.load()
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        # Largest first, each subsequent size resized from the last
+        for name, edge, path in sorted(stale, key=lambda x: sizes[x[0]], reverse=True):
+            if image.size != sizes[name]:
+                image = image.resize(sizes[name], resample=Image.LANCZOS)
+            write_atomically(lambda tmp: image.save(tmp, "JPEG", quality=quality), path)
+    log.info("Built {} derivatives for {}".format(len(stale), identifier))
+    return [x[0] for x in stale]
+
+
+def build_derivatives(conf, workers=None, quality=90, force=False):
+    """
+    Build the stale derivatives of every mvol page, in parallel
+
+    __Return Values__
+    * (dict) Counts of pages "built", "skipped" and "failed"
+    """
+    job = partial(build_page_derivatives, conf, quality=quality, force=force)
+    return run_jobs(job, iter_mvol_pages(conf['MVOL_ROOT']), workers,
+                    action="build derivatives for")
+
+
+def main():
+    parser = make_parser("Pre-generate jpg derivatives of mvol pages")
+    add_mvol_args(parser, derivative_root="Write derivatives here, rather than beside the masters")
+    add_build_args(parser, force="Rebuild up to date derivatives")
+    parser.add_argument("--quality", type=int, default=90)
+    args = parse_args(parser, mvol_root="MVOL_ROOT")
+    conf = {"MVOL_ROOT": args.mvol_root, "DERIVATIVE_ROOT": args.derivative_root}
+    counts = build_derivatives(conf, workers=args.workers, quality=args.quality, force=args.force)
+    print(format_counts(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Encoders for derivative images, and selection between them
+"""
+import logging
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import features
+
+from . import metrics
+from ..exceptions import InvalidFormatError
+
+
+log = logging.getLogger(__name__)
+
+# pil_format: The PIL format name
+# mimetype: The mimetype of the encoded image
+# quality: The default quality, None for lossless formats
+# modes: The image modes the format can store, others are converted to RGB
+# options: Any other keyword arguments to Image.save()
+Encoder = namedtuple("Encoder", ["pil_format", "mimetype", "quality", "modes", "options"])
+
+ENCODERS = {
+    # Kept at the long standing default, so existing urls produce the same images
+    "jpg": Encoder("JPEG", "image/jpg", 95, ("RGB", "L", "CMYK"), {}),
+    # Progressive, with optimized huffman tables, typically 5-10% smaller
+    # than baseline at the same quality, and displayed coarse-to-fine
+    "pjpg": Encoder("JPEG", "image/jpg", 85, ("RGB", "L", "CMYK"),
+                    {"progressive": True, "optimize": True}),
+    "tif": Encoder("TIFF", "image/tif", None, None, {})
+}
+if features.check("webp"):
+    ENCODERS["webp"] = Encoder("WEBP", "image/webp", 80, ("RGB", "RGBA"), {"method": 4})
+if features.check("avif"):
+    ENCODERS["avif"] = Encoder("AVIF", "image/avif", 60, ("RGB", "RGBA"), {"speed": 8})
+
+# Lossless compressions which may be requested for tifs
+TIFF_COMPRESSIONS = {
+    "none": None,
+    "lzw": "tiff_lzw",
+    "deflate": "tiff_adobe_deflate"
+}
+if not features.check("libtiff"):
+    # PIL only writes compressed tifs through libtiff
+    TIFF_COMPRESSIONS = {"none": None}
+
+# Formats offered to clients which Accept them, most preferred first.
+# Clients which accept none of them receive the default.
+NEGOTIABLE = ("avif", "webp")
+
+
+def select_format(requested, default, accept=None):
+    """
+    Choose the format of a derivative image
+
+    __Args__
+    1) requested (str): The format explicitly requested, or None
+    2) default (str): The format of the endpoint
+
+    __KWArgs__
+    * accept (werkzeug.datastructures.MIMEAccept): The Accept header of the
+        request, to negotiate a format from when none was requested, or None
+        to skip negotiation
+
+    __Return Values__
+    * (str) The format, a key of ENCODERS
+    """
+    if requested is not None:
+        if requested not in ENCODERS or requested == "tif" and default != "tif":
+            raise InvalidFormatError("Unsupported format: {}".format(requested))
+        return requested
+    if accept is not None:
+        # Only offered to clients which name them, wildcards don't count,
+        # and prefer them at least as much as the default
+        baseline = accept.quality(ENCODERS[default].mimetype)
+        named = {value.lower(): quality for value, quality in accept}
+        for fmt in NEGOTIABLE:
+            if fmt in ENCODERS:
+                quality = named.get(ENCODERS[fmt].mimetype, 0)
+                if quality > 0 and quality >= baseline:
+                    return fmt
+    return default
+
+
+def tiff_compression(requested, default=None):
+    """
+    Validate a requested tif compression
+
+    __Return Values__
+    * (str) The compression, a key of TIFF_COMPRESSIONS, or None
+    """
+    compression = requested or default
+    if compression is None or compression == "none":
+        return None
+    if compression not in TIFF_COMPRESSIONS:
+        raise InvalidFormatError("Unsupported tif compression: {}".format(compression))
+    return compression
+
+
+def encode(image, fmt, args):
+    """
+    Encode an image
+
+    __Args__
+    1) image (PIL.Image): The image
+    2) fmt (str): The format, a key of ENCODERS
+    3) args (dict): The transformation arguments, supplying quality and
+        compression
+
+    __Return Values__
+    * (bytes) The encoded image
+    """
+    encoder = ENCODERS[fmt]
+    kwargs = dict(encoder.options)
+    if encoder.quality is not None:
+        kwargs['quality'] = args.get('quality') or encoder.quality
+    if encoder.pil_format == "TIFF" and args.get('compression'):
+        kwargs['compression'] = TIFF_COMPRESSIONS[args['compression']]
+    if encoder.modes is not None and image.mode not in encoder.modes:
+        image = image.convert("RGBA" if "RGBA" in encoder.modes and "A" in image.getbands() else "RGB")
+    result = BytesIO()
+    log.debug("Saving result to RAM object as {}".format(fmt))
+    with metrics.stage("encode"):
+        image.save(result, encoder.pil_format, **kwargs)
+    return result.getvalue()
@@ -0,0 +1,85 @@
+"""
+Offloading of image work from request threads onto a pool of processes
+"""
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from ..exceptions import ServiceUnavailableError, TransformTimeoutError
+
+
+log = logging.getLogger(__name__)
+
+
+class TransformExecutor:
+    """
+    A process pool with a bounded queue.
+
+    At most workers + queue_size jobs may be running or waiting at once,
+    further submissions are rejected immediately with a
+    ServiceUnavailableError rather than piling up behind a stampede.
+    A job which times out keeps its slot until its process is done
+    with it, so that timed out work still applies backpressure.
+
+    A pool of zero workers runs jobs inline, on the calling thread.
+    """
+    def __init__(self, workers, queue_size=0, timeout=None):
+        """
+        __Args__
+        1) workers (int): The number of worker processes
+
+        __KWArgs__
+        * queue_size (int): The number of jobs which may wait for a worker
+        * timeout (float): Seconds to wait on a job before giving up on it
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.submitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._slots = threading.BoundedSemaphore(workers + queue_size) if workers else None
+        self._pool = None
+        if workers:
+            # Forking a multithreaded server process is unsafe
+            self._pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def run(self, fn, *args):
+        """
+        Run fn(*args), in a worker process if the pool has any
+
+        __Return Values__
+        * The return value of fn
+        """
+        if self._pool is None:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            log.warning("Transform executor saturated, rejecting job")
+            raise ServiceUnavailableError()
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        self.submitted += 1
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            self.timed_out += 1
+            future.cancel()
+            log.warning("Transform job exceeded {}s".format(self.timeout))
+            raise TransformTimeoutError()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def stats(self):
+        return {"workers": self.workers, "queue_size": self.queue_size,
+                "submitted": self.submitted, "rejected": self.rejected,
+                "timed_out": self.timed_out}
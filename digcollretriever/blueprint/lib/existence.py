@@ -0,0 +1,139 @@
+"""
+Memoization of which formats exist for an identifier
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from ..exceptions import Omitted, SourceNotFoundError
+
+
+log = logging.getLogger(__name__)
+
+EXISTS = "exists"
+MISSING = "missing"
+OMITTED = "omitted"
+
+
+def probe(storage_instance, identifier, fmt, exists=None):
+    """
+    Determine whether a storage instance can provide a format of an identifier
+
+    __Args__
+    1) storage_instance (StorageInterface): The storage instance
+    2) identifier (str): The identifier
+    3) fmt (str): The format, a get_$fmt method of the storage instance,
+        eg "tif" or "limb_ocr"
+
+    __KWArgs__
+    * exists (callable): Judges whether a filepath exists, rather than
+        statting it, eg listing.DirectoryScanCache.exists
+
+    __Return Values__
+    * (tuple) EXISTS, MISSING or OMITTED, and the source (a filepath or
+        file like object) if one was returned
+    """
+    try:
+        source = getattr(storage_instance, "get_" + fmt)(identifier)
+    except Omitted:
+        return OMITTED, None
+    if isinstance(source, (str, bytes)):
+        if exists is not None:
+            return (EXISTS if exists(source) else MISSING), source
+        try:
+            os.stat(source)
+        except FileNotFoundError:
+            return MISSING, source
+    return EXISTS, source
+
+
+class ExistenceCache:
+    """
+    Remembers, for ttl seconds, whether each format of an identifier was
+    omitted by its storage interface, missing from disk or present, so
+    that repeated requests (including requests for things which don't
+    exist) don't repeat the same filesystem probes.
+
+    Only outcomes involving filepaths are remembered, file like objects
+    can't be handed out twice. A ttl of 0 disables the memoization.
+    """
+    def __init__(self, ttl=60, max_entries=65536, exists=None):
+        """
+        __KWArgs__
+        * ttl (float): Seconds to remember an outcome for
+        * max_entries (int): The number of outcomes to remember, least
+            recently used outcomes are forgotten beyond it
+        * exists (callable): Judges whether a filepath exists, see probe()
+        """
+        self.ttl = ttl
+        self._exists = exists
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def lookup(self, storage_instance, identifier, fmt):
+        """
+        Return the source of a format of an identifier
+
+        __Return Values__
+        * (str/bytes/file like object) The source
+
+        Raises Omitted if the storage interface doesn't provide the format,
+        or SourceNotFoundError if it does but the file doesn't exist.
+        """
+        key = (type(storage_instance), identifier, fmt)
+        entry = None
+        if self.ttl:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                else:
+                    entry = None
+                    self.misses += 1
+        if entry is None:
+            state, source = probe(storage_instance, identifier, fmt, exists=self._exists)
+            if self.ttl and (state == OMITTED or isinstance(source, (str, bytes))):
+                with self._lock:
+                    self._entries[key] = (time.monotonic() + self.ttl, state, source)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        else:
+            _, state, source = entry
+        if state == OMITTED:
+            raise Omitted()
+        if state == MISSING:
+            log.debug("No {} exists for {}".format(fmt, identifier))
+            raise SourceNotFoundError()
+        return source
+
+    def exists(self, storage_instance, identifier, fmt):
+        """
+        Whether a format of an identifier exists
+        """
+        try:
+            self.lookup(storage_instance, identifier, fmt)
+        except (Omitted, SourceNotFoundError):
+            return False
+        return True
+
+    def invalidate(self, identifier=None):
+        """
+        Forget the outcomes for an identifier, or for every identifier
+        """
+        with self._lock:
+            if identifier is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if k[1] == identifier]:
+                del self._entries[key]
+
+    def stats(self):
+        return {"entries": len(self._entries), "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses}
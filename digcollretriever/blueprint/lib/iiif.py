@@ -0,0 +1,306 @@
+"""
+IIIF Image API 3.0 request parsing and rendering
+
+See https://iiif.io/api/image/3.0/
+"""
+import logging
+from collections import namedtuple
+from io import BytesIO
+from math import ceil
+
+from PIL import Image, features
+
+from ..exceptions import IIIFRequestError
+from . import resize_region, metrics
+
+
+log = logging.getLogger(__name__)
+
+CONTEXT = "http://iiif.io/api/image/3/context.json"
+
+PROFILE = "level2"
+
+PROFILE_URI = "http://iiif.io/api/image/3/level2.json"
+
+# IIIF format extension: (PIL format name, mimetype)
+FORMATS = {
+    "jpg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+    "tif": ("TIFF", "image/tiff"),
+    "gif": ("GIF", "image/gif")
+}
+if features.check("webp"):
+    FORMATS["webp"] = ("WEBP", "image/webp")
+
+QUALITIES = ("default", "color", "gray", "bitonal")
+
+FEATURES = ["cors", "jsonldMediaType", "mirroring", "profileLinkHeader",
+            "regionByPct", "regionByPx", "regionSquare", "rotationArbitrary", "rotationBy90s",
+            "sizeByConfinedWh", "sizeByH", "sizeByPct", "sizeByW", "sizeByWh", "sizeUpscaling"]
+
+ImageRequest = namedtuple("ImageRequest", ["region", "size", "rotation", "mirror", "quality", "format"])
+
+
+def parse_region(region, width, height):
+    """
+    Parse a region parameter
+
+    __Args__
+    1) region (str): The region parameter
+    2) width (int): The width of the image
+    3) height (int): The height of the image
+
+    __Return Values__
+    * (tuple) The (left, upper, right, lower) box of the region, within the image
+    """
+    if region == "full":
+        return (0, 0, width, height)
+    if region == "square":
+        side = min(width, height)
+        x = (width - side) // 2
+        y = (height - side) // 2
+        return (x, y, x + side, y + side)
+    try:
+        if region.startswith("pct:"):
+            x, y, w, h = (float(v) for v in region[4:].split(","))
+            x, y, w, h = (round(x * width / 100), round(y * height / 100),
+                          round(w * width / 100), round(h * height / 100))
+        else:
+            x, y, w, h = (int(v) for v in region.split(","))
+    except ValueError:
+        raise IIIFRequestError("Invalid region: {}".format(region))
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x >= width or y >= height:
+        raise IIIFRequestError("Region {} is outside of the image".format(region))
+    return (x, y, min(x + w, width), min(y + h, height))
+
+
+def parse_size(size, region_width, region_height, max_width=None, max_height=None, max_area=None):
+    """
+    Parse a size parameter
+
+    __Args__
+    1) size (str): The size parameter
+    2) region_width (int): The width of the region
+    3) region_height (int): The height of the region
+
+    __KWArgs__
+    * max_width (int): The maximum width the server will produce
+    * max_height (int): The maximum height the server will produce
+    * max_area (int): The maximum number of pixels the server will produce
+
+    __Return Values__
+    * (tuple) The (width, height) of the result
+    """
+    upscale = size.startswith("^")
+    if upscale:
+        size = size[1:]
+    try:
+        if size == "max":
+            w, h = region_width, region_height
+            if upscale:
+                # As large as the limits allow
+                factor = min(x for x in (
+                    max_width / w if max_width else None,
+                    max_height / h if max_height else None,
+                    (max_area / (w * h)) ** .5 if max_area else None,
+                    1 if not (max_width or max_height or max_area) else None
+                ) if x is not None)
+            else:
+                factor = min(x for x in (
+                    1,
+                    max_width / w if max_width else None,
+                    max_height / h if max_height else None,
+                    (max_area / (w * h)) ** .5 if max_area else None
+                ) if x is not None)
+            w, h = max(1, int(w * factor)), max(1, int(h * factor))
+            return (w, h)
+        elif size.startswith("pct:"):
+            pct = float(size[4:])
+            w, h = round(region_width * pct / 100), round(region_height * pct / 100)
+        elif size.startswith("!"):
+            bw, bh = (int(x) for x in size[1:].split(","))
+            factor = min(bw / region_width, bh / region_height)
+            if not upscale:
+                # A box larger than the region is satisfied by the region itself
+                factor = min(factor, 1)
+            w, h = round(region_width * factor), round(region_height * factor)
+        elif size.endswith(","):
+            w = int(size[:-1])
+            h = round(region_height * w / region_width)
+        elif size.startswith(","):
+            h = int(size[1:])
+            w = round(region_width * h / region_height)
+        else:
+            w, h = (int(x) for x in size.split(","))
+    except ValueError:
+        raise IIIFRequestError("Invalid size: {}".format(size))
+    if w < 1 or h < 1:
+        raise IIIFRequestError("Size {} results in an empty image".format(size))
+    if not upscale and (w > region_width or h > region_height):
+        raise IIIFRequestError("Size {} requires upscaling, which must be requested with ^".format(size))
+    if (max_width and w > max_width) or (max_height and h > max_height) or \
+            (max_area and w * h > max_area):
+        raise IIIFRequestError("Size {} exceeds the maximum size supported".format(size))
+    return (w, h)
+
+
+def parse_rotation(rotation):
+    """
+    Parse a rotation parameter
+
+    __Return Values__
+    * (tuple) The clockwise rotation in degrees, and whether to mirror first
+    """
+    mirror = rotation.startswith("!")
+    if mirror:
+        rotation = rotation[1:]
+    try:
+        degrees = float(rotation)
+    except ValueError:
+        raise IIIFRequestError("Invalid rotation: {}".format(rotation))
+    if not 0 <= degrees <= 360:
+        raise IIIFRequestError("Rotation must be between 0 and 360")
+    return degrees % 360, mirror
+
+
+def parse_request(region, size, rotation, quality, fmt, width, height, limits=None):
+    """
+    Parse the parameters of an image request
+
+    __Args__
+    1-5) The region, size, rotation, quality and format parameters
+    6) width (int): The width of the image
+    7) height (int): The height of the image
+
+    __KWArgs__
+    * limits (dict): max_width, max_height and max_area
+
+    __Return Values__
+    * (ImageRequest)
+    """
+    box = parse_region(region, width, height)
+    result_size = parse_size(size, box[2] - box[0], box[3] - box[1], **(limits or {}))
+    degrees, mirror = parse_rotation(rotation)
+    if quality not in QUALITIES:
+        raise IIIFRequestError("Unsupported quality: {}".format(quality))
+    if fmt not in FORMATS:
+        raise IIIFRequestError("Unsupported format: {}".format(fmt))
+    return ImageRequest(box, result_size, degrees, mirror, quality, fmt)
+
+
+def canonical_args(image_request):
+    """
+    The canonical form of a request, so that equivalent requests share
+    derivative cache entries and validators
+    """
+    x0, y0, x1, y1 = image_request.region
+    return {
+        "region": "{},{},{},{}".format(x0, y0, x1 - x0, y1 - y0),
+        "size": "{},{}".format(*image_request.size),
+        "rotation": ("!" if image_request.mirror else "") + "{:g}".format(image_request.rotation),
+        "quality": image_request.quality,
+        "format": image_request.format
+    }
+
+
+def render_image_request(source, image_request):
+    """
+    Produce the image described by an ImageRequest
+
+    Only the region is decoded, at the lowest resolution the requested
+    size allows.
+
+    __Args__
+    1) source (str/file like object): The master
+    2) image_request (ImageRequest): The parsed request
+
+    __Return Values__
+    * (bytes) The encoded image
+    """
+    with metrics.stage("open"):
+        master = Image.open(source)
+    image = resize_region(master, image_request.region, image_request.size)
+    if image_request.mirror or image_request.rotation:
+        with metrics.stage("rotate"):
+            image = _rotate(image, image_request)
+    with metrics.stage("encode"):
+        return _encode(image, image_request)
+
+
+def _rotate(image, image_request):
+    if image_request.mirror:
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    if image_request.rotation:
+        transposes = {90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90}
+        if image_request.rotation in transposes:
+            image = image.transpose(transposes[image_request.rotation])
+        else:
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            # PIL rotates counter clockwise, IIIF clockwise
+            image = image.rotate(-image_request.rotation, resample=Image.BICUBIC, expand=True,
+                                 fillcolor="white")
+    return image
+
+
+def _encode(image, image_request):
+    if image_request.quality == "gray":
+        image = image.convert("L")
+    elif image_request.quality == "bitonal":
+        image = image.convert("1")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    pil_format = FORMATS[image_request.format][0]
+    if pil_format == "JPEG" and image.mode == "1":
+        image = image.convert("L")
+    result = BytesIO()
+    image.save(result, pil_format)
+    return result.getvalue()
+
+
+def scale_factors(width, height, tile_size):
+    """
+    The power of two scale factors at which a viewer should request tiles
+    """
+    factors = [1]
+    while max(width, height) / factors[-1] > tile_size:
+        factors.append(factors[-1] * 2)
+    return factors
+
+
+def info(base_id, width, height, tile_size=512, limits=None):
+    """
+    Build the info.json document for an image
+
+    __Args__
+    1) base_id (str): The base URI of the image
+    2) width (int): The width of the image
+    3) height (int): The height of the image
+
+    __KWArgs__
+    * tile_size (int): The width and height of the tiles viewers should request
+    * limits (dict): max_width, max_height and max_area
+
+    __Return Values__
+    * (dict)
+    """
+    factors = scale_factors(width, height, tile_size)
+    document = {
+        "@context": CONTEXT,
+        "id": base_id,
+        "type": "ImageService3",
+        "protocol": "http://iiif.io/api/image",
+        "profile": PROFILE,
+        "width": width,
+        "height": height,
+        "tiles": [{"width": tile_size, "height": tile_size, "scaleFactors": factors}],
+        "sizes": [{"width": ceil(width / x), "height": ceil(height / x)} for x in reversed(factors)],
+        "extraFormats": [x for x in FORMATS if x != "jpg"],
+        "extraQualities": ["color", "gray", "bitonal"],
+        "extraFeatures": FEATURES
+    }
+    limits = limits or {}
+    for key, name in (("max_width", "maxWidth"), ("max_height", "maxHeight"), ("max_area", "maxArea")):
+        if limits.get(key):
+            document[name] = limits[key]
+    return document
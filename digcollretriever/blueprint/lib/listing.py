@@ -0,0 +1,113 @@
+"""
+Memoized directory listings, for enumerating the children of an
+intellectual unit and checking which files exist without statting each
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SCAN_TTL = 5
+
+# Directories modified this recently may change again within the
+# resolution of their mtime, so their listings aren't remembered
+RACY_NS = 2 * 1000000000
+
+_SCAN_CACHES = {}
+_SCAN_CACHES_LOCK = threading.Lock()
+
+
+class DirectoryScanCache:
+    """
+    Remembers the (sorted) entries of directories.
+
+    A listing is trusted for ttl seconds, after which the directory is
+    statted again and the listing is reused if the directory's mtime
+    hasn't changed, and rescanned otherwise. Adding, removing or renaming
+    an entry always changes the mtime of its directory.
+    """
+    def __init__(self, ttl=DEFAULT_SCAN_TTL, max_entries=4096):
+        """
+        __KWArgs__
+        * ttl (float): Seconds to trust a listing for without statting
+            its directory
+        * max_entries (int): The number of directories to remember, least
+            recently used directories are forgotten beyond it
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def scan(self, path):
+        """
+        Return the names of the entries of a directory, sorted
+
+        Raises FileNotFoundError (or another OSError) if the directory
+        can't be listed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                if entry[0] > now:
+                    self.hits += 1
+                    return entry[2]
+        st = os.stat(path)
+        if entry is not None and entry[1] == st.st_mtime_ns:
+            with self._lock:
+                self.hits += 1
+                self._entries[path] = (now + self.ttl, entry[1], entry[2])
+            return entry[2]
+        log.debug("Scanning {}".format(path))
+        names = tuple(sorted(os.listdir(path)))
+        with self._lock:
+            self.misses += 1
+            if time.time_ns() - st.st_mtime_ns > RACY_NS:
+                self._entries[path] = (now + self.ttl, st.st_mtime_ns, names)
+                self._entries.move_to_end(path)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return names
+
+    def exists(self, path):
+        """
+        Whether a file exists, judged by the listing of its directory
+        """
+        dirname, basename = os.path.split(path)
+        try:
+            return basename in self.scan(dirname)
+        except OSError:
+            return False
+
+    def invalidate(self, path=None):
+        """
+        Forget the listing of a directory, or of every directory
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self):
+        return {"entries": len(self._entries), "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses}
+
+
+def get_scan_cache(ttl=None):
+    """
+    Return the (shared) DirectoryScanCache with a ttl
+    """
+    ttl = float(DEFAULT_SCAN_TTL if ttl is None else ttl)
+    with _SCAN_CACHES_LOCK:
+        if ttl not in _SCAN_CACHES:
+            _SCAN_CACHES[ttl] = DirectoryScanCache(ttl)
+        return _SCAN_CACHES[ttl]
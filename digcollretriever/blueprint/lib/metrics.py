@@ -0,0 +1,259 @@
+"""
+Request and pipeline stage metrics, exposed in the Prometheus text format
+
+Code anywhere in a request (or in a transform worker process, see
+call_collecting()) reports to the collector of the current thread:
+
+    with metrics.stage("resize"):
+        ...
+    metrics.tag(format="tif")
+    metrics.count("fallbacks_total", format="jpg")
+
+The collector is folded into METRICS once the request completes, labelled
+by the storage interface and source format which were tagged. Without a
+collector (ie when metrics are disabled) all of the above do nothing.
+"""
+import threading
+from math import inf
+from time import perf_counter
+
+
+PREFIX = "digcollretriever_"
+
+DEFAULT_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, inf)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, labels=None):
+        key = tuple((labels or {}).get(x, "") for x in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        yield "# HELP {} {}".format(self.name, self.documentation)
+        yield "# TYPE {} counter".format(self.name)
+        for key, value in sorted(self._values.items()):
+            yield "{}{} {}".format(self.name, _format_labels(self.labelnames, key), _format_value(value))
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, labels=None):
+        key = tuple((labels or {}).get(x, "") for x in self.labelnames)
+        counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._values[key] = (counts, total + value)
+
+    def expose(self):
+        yield "# HELP {} {}".format(self.name, self.documentation)
+        yield "# TYPE {} histogram".format(self.name)
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield "{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labelnames, key, ("le", _format_value(bound))), count
+                )
+            labels = _format_labels(self.labelnames, key)
+            yield "{}_sum{} {}".format(self.name, labels, _format_value(total))
+            yield "{}_count{} {}".format(self.name, labels, counts[-1])
+
+
+class Registry:
+    """
+    A thread safe collection of metrics of this process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self.requests = self._add(Counter(
+            PREFIX + "requests_total", "Requests handled", ("endpoint", "status")))
+        self.request_duration = self._add(Histogram(
+            PREFIX + "request_duration_seconds", "Time taken to handle requests",
+            ("endpoint", "storage", "format")))
+        self.stage_duration = self._add(Histogram(
+            PREFIX + "stage_duration_seconds", "Time spent in each stage of producing a response",
+            ("stage", "storage", "format")))
+        self.response_bytes = self._add(Counter(
+            PREFIX + "response_bytes_total", "Bytes of response bodies with a known length",
+            ("endpoint",)))
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def record(self, collector, endpoint, status, seconds, nbytes=None):
+        """
+        Fold the collector of a completed request into the registry
+        """
+        labels = dict(collector.labels, endpoint=endpoint, status=status)
+        with self._lock:
+            self.requests.inc(labels=labels)
+            self.request_duration.observe(seconds, labels)
+            if nbytes is not None:
+                self.response_bytes.inc(nbytes, labels)
+            for name, elapsed in collector.stages:
+                self.stage_duration.observe(elapsed, dict(collector.labels, stage=name))
+            for (name, extra), amount in collector.counts.items():
+                metric = self._metrics.get(PREFIX + name)
+                if metric is None:
+                    metric = self._add(Counter(
+                        PREFIX + name, name.replace("_", " "),
+                        ("storage", "format") + tuple(k for k, _ in extra)))
+                metric.inc(amount, dict(collector.labels, **dict(extra)))
+
+    def expose(self):
+        with self._lock:
+            lines = [line for metric in self._metrics.values() for line in metric.expose()]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+
+
+class Collector:
+    """
+    The measurements of a single request
+    """
+    __slots__ = ("labels", "stages", "counts")
+
+    def __init__(self):
+        self.labels = {}
+        self.stages = []
+        self.counts = {}
+
+    def merge(self, stages, counts):
+        self.stages.extend(stages)
+        for key, amount in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+
+def begin():
+    """
+    Start collecting measurements on this thread
+    """
+    collector = Collector()
+    _local.collector = collector
+    return collector
+
+
+def end():
+    """
+    Stop collecting measurements on this thread
+
+    __Return Values__
+    * (Collector) The measurements, or None if none were being collected
+    """
+    collector = getattr(_local, "collector", None)
+    _local.collector = None
+    return collector
+
+
+def current():
+    return getattr(_local, "collector", None)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("collector", "name", "start")
+
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.collector.stages.append((self.name, perf_counter() - self.start))
+        return False
+
+
+def stage(name):
+    """
+    A context manager timing a stage of the current request
+    """
+    collector = getattr(_local, "collector", None)
+    if collector is None:
+        return _NULL_STAGE
+    return _Stage(collector, name)
+
+
+def tag(**labels):
+    """
+    Label the current request, eg with its storage interface or source format
+    """
+    collector = getattr(_local, "collector", None)
+    if collector is not None:
+        collector.labels.update(labels)
+
+
+def count(name, amount=1, **labels):
+    """
+    Increment a counter (PREFIX + name) on behalf of the current request
+    """
+    collector = getattr(_local, "collector", None)
+    if collector is not None:
+        key = (name, tuple(sorted(labels.items())))
+        collector.counts[key] = collector.counts.get(key, 0) + amount
+
+
+def call_collecting(fn, *args):
+    """
+    Call fn(*args), collecting its measurements, so that they can be
+    returned from a worker process and merged into the request's
+
+    __Return Values__
+    * (tuple) The return value of fn, its stages and its counts
+    """
+    previous = current()
+    collector = begin()
+    try:
+        return fn(*args), collector.stages, collector.counts
+    finally:
+        _local.collector = previous
@@ -0,0 +1,365 @@
+"""
+A persistent index of the ALTO OCR of pages, holding their plain text,
+the bounding box of each word and a full text index, so that text, word
+coordinates and search results can be served without parsing XML.
+
+    digcollretriever-index-ocr --index /path/to/ocr.sqlite3 --mvol-root /path/to/mvol/parent
+
+Like the technical metadata index, records are filled lazily on first
+access or in bulk with the above command, and are replaced whenever the
+mtime or size of the ALTO file changes. ALTO is parsed incrementally, a
+text block at a time, so large files are never held in memory whole.
+"""
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from .storageinterfaces import MvolLayer4StorageInterface
+from .tools import run_jobs, format_counts, make_parser, add_mvol_args, parse_args
+
+
+log = logging.getLogger(__name__)
+
+FIELDS = ("width", "height", "text", "bytes", "mtime_ns")
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+DEFAULT_CHECK_TTL = 300
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _int(value):
+    return int(float(value or 0))
+
+
+def parse_alto(source):
+    """
+    Parse an ALTO file
+
+    __Args__
+    1) source (str/file like object): The ALTO file
+
+    __Return Values__
+    * (dict) The width and height of the page, its text (words separated
+        by spaces, lines by newlines and blocks by blank lines), and its
+        words and their (x, y, width, height) boxes, in reading order
+    """
+    page = {"width": 0, "height": 0, "words": [], "boxes": []}
+    blocks, lines, line = [], [], []
+    root = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if root is None:
+            root = elem
+        name = _local_name(elem.tag)
+        if event == "start":
+            if name == "Page":
+                page["width"], page["height"] = _int(elem.get("WIDTH")), _int(elem.get("HEIGHT"))
+            continue
+        if name == "String":
+            content = (elem.get("CONTENT") or "").replace("\n", " ")
+            if content:
+                line.append(content)
+                page["words"].append(content)
+                page["boxes"].append(tuple(_int(elem.get(x)) for x in ("HPOS", "VPOS", "WIDTH", "HEIGHT")))
+        elif name == "HYP" and line:
+            line[-1] += elem.get("CONTENT") or "-"
+        elif name == "TextLine":
+            lines.append(" ".join(line))
+            line = []
+        elif name == "TextBlock":
+            blocks.append("\n".join(lines))
+            lines = []
+            # Finished blocks are no longer needed
+            root.clear()
+    page["text"] = "\n\n".join(x for x in blocks if x)
+    return page
+
+
+def pack_boxes(boxes):
+    packed = array("I", (v for box in boxes for v in box))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_boxes(data):
+    packed = array("I")
+    packed.frombytes(data)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return [tuple(packed[i:i + 4]) for i in range(0, len(packed), 4)]
+
+
+def intersects(box, region):
+    """
+    Whether an (x, y, width, height) box intersects a (left, upper, right,
+    lower) region
+    """
+    x, y, w, h = box
+    return x < region[2] and x + w > region[0] and y < region[3] and y + h > region[1]
+
+
+class OcrIndex:
+    """
+    A SQLite backed store of the text and word boxes of pages, with a
+    full text (FTS5) index over the text
+    """
+    def __init__(self, path=":memory:"):
+        """
+        __KWArgs__
+        * path (str): The SQLite database to store the index in. Defaults
+            to a non-persistent in memory database.
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Issue identifier -> when its pages are next checked for changes
+        self._checked = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            # Allow concurrent readers in other worker processes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr ("
+            "identifier TEXT PRIMARY KEY, issue TEXT, path TEXT, width INTEGER, height INTEGER, "
+            "text TEXT, words TEXT, boxes BLOB, bytes INTEGER, mtime_ns INTEGER)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ocr_issue ON ocr (issue)")
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS ocr_text USING "
+            "fts5(text, identifier UNINDEXED, issue UNINDEXED)"
+        )
+
+    @staticmethod
+    def issue_of(identifier):
+        return identifier.split("_")[0]
+
+    def lookup(self, identifier):
+        """
+        Return the indexed record of a page without touching the
+        filesystem, or None. The record may be stale.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT width, height, text, bytes, mtime_ns FROM ocr WHERE identifier = ?",
+                (identifier,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(FIELDS, row))
+
+    def get(self, identifier, path):
+        """
+        Return the record of a page, indexing it if it is missing or stale
+
+        __Args__
+        1) identifier (str): The identifier of the page
+        2) path (str): The path to its ALTO file
+
+        __Return Values__
+        * (dict) width, height, text, bytes and mtime_ns
+        """
+        st = os.stat(path)
+        record = self.lookup(identifier)
+        if record is not None and record['mtime_ns'] == st.st_mtime_ns and \
+                record['bytes'] == st.st_size:
+            self.hits += 1
+            return record
+        self.misses += 1
+        return self.index(identifier, path, st)
+
+    def index(self, identifier, path, st=None):
+        """
+        (Re)index a single page
+        """
+        if st is None:
+            st = os.stat(path)
+        log.debug("Indexing the ocr of {}".format(identifier))
+        page = parse_alto(path)
+        issue = self.issue_of(identifier)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM ocr_text WHERE identifier = ?", (identifier,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO ocr (identifier, issue, path, width, height, text, words, "
+                    "boxes, bytes, mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (identifier, issue, os.path.abspath(path), page['width'], page['height'],
+                     page['text'], "\n".join(page['words']), pack_boxes(page['boxes']),
+                     st.st_size, st.st_mtime_ns)
+                )
+                self._conn.execute("INSERT INTO ocr_text (text, identifier, issue) VALUES (?, ?, ?)",
+                                   (page['text'], identifier, issue))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return dict(zip(FIELDS, (page['width'], page['height'], page['text'],
+                                 st.st_size, st.st_mtime_ns)))
+
+    def refresh(self, issue, pages, ttl=DEFAULT_CHECK_TTL):
+        """
+        Index the new or changed pages of an issue, unless they were
+        checked in the last ttl seconds
+
+        __Args__
+        1) issue (str): The identifier of the issue
+        2) pages (callable): Returns the (identifier, ALTO path) pairs of
+            the issue's pages, only called when they're checked
+
+        __KWArgs__
+        * ttl (float): Seconds to trust a check for
+
+        __Return Values__
+        * (dict) As for index_pages(), or None if the issue wasn't checked
+        """
+        with self._lock:
+            if self._checked.get(issue, 0) > time.monotonic():
+                return None
+        counts = index_pages(self, pages())
+        with self._lock:
+            self._checked[issue] = time.monotonic() + ttl
+        return counts
+
+    def words(self, identifier, region=None):
+        """
+        Return the words of an indexed page, and their boxes
+
+        __KWArgs__
+        * region (tuple): A (left, upper, right, lower) region, only words
+            intersecting it are returned
+
+        __Return Values__
+        * (list[tuple]) (word, (x, y, width, height)) pairs
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT words, boxes FROM ocr WHERE identifier = ?",
+                                     (identifier,)).fetchone()
+        if row is None or not row[0]:
+            return []
+        words = list(zip(row[0].split("\n"), unpack_boxes(row[1])))
+        if region is not None:
+            words = [x for x in words if intersects(x[1], region)]
+        return words
+
+    def search(self, issue, query, limit=20):
+        """
+        Search the text of the indexed pages of an issue
+
+        __Args__
+        1) issue (str): The identifier of the issue
+        2) query (str): Words, all of which must appear on a page
+
+        __KWArgs__
+        * limit (int): The maximum number of pages to return
+
+        __Return Values__
+        * (list[dict]) The identifier of each matching page, best first, a
+            snippet of its text and the words on it matching the query
+            with their boxes
+        """
+        terms = [x.lower() for x in TOKEN.findall(query)]
+        if not terms:
+            return []
+        match = " ".join('"{}"'.format(x) for x in terms)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT identifier, snippet(ocr_text, 0, '', '', '...', 16) FROM ocr_text "
+                "WHERE ocr_text MATCH ? AND issue = ? ORDER BY rank LIMIT ?",
+                (match, issue, limit)
+            ).fetchall()
+        hits = []
+        for identifier, snippet in rows:
+            words = [{"text": word, "box": box} for word, box in self.words(identifier)
+                     if any(t.lower() in terms for t in TOKEN.findall(word))]
+            hits.append({"identifier": identifier, "snippet": snippet, "words": words})
+        return hits
+
+    def invalidate(self, identifier):
+        """
+        Drop the record of a page
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM ocr WHERE identifier = ?", (identifier,))
+            self._conn.execute("DELETE FROM ocr_text WHERE identifier = ?", (identifier,))
+            self._checked.pop(self.issue_of(identifier), None)
+
+    def stats(self):
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM ocr").fetchone()[0]
+        return {"entries": count, "hits": self.hits, "misses": self.misses}
+
+
+def get_index(path=None):
+    """
+    Return the (shared) OcrIndex stored at path, or an in memory index if
+    path is None
+    """
+    path = path or ":memory:"
+    with _INDEXES_LOCK:
+        if path not in _INDEXES:
+            _INDEXES[path] = OcrIndex(path)
+        return _INDEXES[path]
+
+
+def iter_mvol_alto(mvol_root):
+    """
+    Yield the identifier and ALTO file of every mvol page with OCR
+    """
+    for dirpath, dirnames, filenames in os.walk(os.path.join(mvol_root, "mvol")):
+        dirnames.sort()
+        if os.path.basename(dirpath) != "ALTO":
+            continue
+        for fname in sorted(filenames):
+            identifier, ext = os.path.splitext(fname)
+            if ext == ".xml" and MvolLayer4StorageInterface.claim_identifier(identifier):
+                yield identifier, os.path.join(dirpath, fname)
+
+
+def index_pages(index, pages):
+    """
+    Index pages whose records are missing or stale
+
+    __Args__
+    1) index (OcrIndex): The index
+    2) pages (iterable): (identifier, ALTO path) pairs
+
+    __Return Values__
+    * (dict) Counts of pages "indexed", "current" and "failed"
+    """
+    def index_page(page):
+        misses = index.misses
+        index.get(*page)
+        return index.misses > misses
+
+    # One at a time, so that misses are attributed to the right page
+    return run_jobs(index_page, pages, 1, executor_class=ThreadPoolExecutor,
+                    outcomes=("indexed", "current"), action="index the ocr of")
+
+
+def main():
+    parser = make_parser("Index the ALTO OCR of mvol pages")
+    parser.add_argument("--index", default=os.environ.get("DIGCOLLRETRIEVER_OCR_INDEX"),
+                        help="The SQLite database to store the index in")
+    add_mvol_args(parser)
+    args = parse_args(parser, index="OCR_INDEX", mvol_root="MVOL_ROOT")
+    counts = index_pages(OcrIndex(args.index), iter_mvol_alto(args.mvol_root))
+    print(format_counts(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+"""
+Rasterization of PDF pages, so that image derivatives can be produced
+for identifiers whose only master is a PDF, and the writing of smaller
+or linearized PDFs from them.
+
+PIL can't read PDFs, so pages are rendered by an optional backend:
+PyMuPDF (pip install digcollretriever[pdf]) if it is importable, otherwise
+poppler's pdftoppm/pdfinfo if they are on the PATH.
+
+A page's "native" dimensions are its dimensions at NATIVE_DPI, which is
+what width, height, scale and crop parameters are relative to. Pages are
+rendered at the lowest of DPI_STEPS which covers the requested output, so
+that differently sized requests for a page share a rendering.
+
+Selected pages are copied into a new PDF, and PDFs are linearized ("fast
+web view", so a browser can display the first page before the rest has
+arrived), by qpdf if it is on the PATH, otherwise pypdf (which can't
+linearize). Both read only the objects the selected pages require.
+
+    digcollretriever-linearize-pdfs --mvol-root /path/to/mvol/parent
+
+writes linearized copies of every issue PDF ahead of time.
+"""
+import logging
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from io import BytesIO
+from math import floor
+from os.path import isfile, join
+
+from PIL import Image
+
+from ..exceptions import InvalidPageError, PDFRasterizerUnavailableError, PDFWriterUnavailableError
+from . import sane_transform_args, target_size, thumbnail_size, metrics
+from .storageinterfaces import MvolLayer3StorageInterface
+from .tools import write_atomically, run_jobs, format_counts, make_parser, add_mvol_args, \
+    add_build_args, parse_args
+
+
+log = logging.getLogger(__name__)
+
+NATIVE_DPI = 150
+
+DPI_STEPS = (72, 150, 300)
+
+# PDF user space units per inch
+POINTS_PER_INCH = 72
+
+
+class PyMuPDFRasterizer:
+    name = "pymupdf"
+
+    @staticmethod
+    def available():
+        try:
+            import fitz  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def page_info(self, path, page):
+        import fitz
+        with fitz.open(path) as doc:
+            if not 1 <= page <= doc.page_count:
+                raise InvalidPageError("The pdf has {} pages".format(doc.page_count))
+            rect = doc[page - 1].rect
+            return doc.page_count, (rect.width, rect.height)
+
+    def render(self, path, page, dpi):
+        import fitz
+        with fitz.open(path) as doc:
+            pixmap = doc[page - 1].get_pixmap(dpi=dpi, alpha=False)
+            return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+
+class PdftoppmRasterizer:
+    name = "pdftoppm"
+
+    @staticmethod
+    def available():
+        return bool(shutil.which("pdftoppm") and shutil.which("pdfinfo"))
+
+    def page_info(self, path, page):
+        info = subprocess.run(["pdfinfo", "-f", str(page), "-l", str(page), path],
+                              check=True, capture_output=True).stdout.decode("latin1")
+        count = int(re.search(r"^Pages:\s+(\d+)", info, re.M).group(1))
+        if not 1 <= page <= count:
+            raise InvalidPageError("The pdf has {} pages".format(count))
+        width, height = (float(x) for x in re.search(
+            r"^Page\s+{} size:\s+([\d.]+) x ([\d.]+)".format(page), info, re.M).groups())
+        rotation = re.search(r"^Page\s+{} rot:\s+(\d+)".format(page), info, re.M)
+        if rotation and int(rotation.group(1)) % 180:
+            width, height = height, width
+        return count, (width, height)
+
+    def render(self, path, page, dpi):
+        # Without an output root the page is written to stdout
+        out = subprocess.run(["pdftoppm", "-f", str(page), "-l", str(page), "-r", str(dpi),
+                              "-singlefile", "-png", path],
+                             check=True, capture_output=True).stdout
+        image = Image.open(BytesIO(out))
+        image.load()
+        return image
+
+
+# name: rasterizer class, in order of preference
+RASTERIZERS = {x.name: x for x in (PyMuPDFRasterizer, PdftoppmRasterizer)}
+
+
+def get_rasterizer(name=None):
+    """
+    Return a rasterizer, either the one named or the first available
+
+    Raises PDFRasterizerUnavailableError if there isn't one.
+    """
+    if name:
+        if name not in RASTERIZERS or not RASTERIZERS[name].available():
+            raise PDFRasterizerUnavailableError("The {} pdf rasterizer isn't available".format(name))
+        return RASTERIZERS[name]()
+    for kls in RASTERIZERS.values():
+        if kls.available():
+            return kls()
+    raise PDFRasterizerUnavailableError()
+
+
+def available(name=None):
+    """
+    Whether pdfs can be rasterized
+    """
+    try:
+        get_rasterizer(name)
+    except PDFRasterizerUnavailableError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=4096)
+def _page_info(name, path, page, signature):
+    # The signature isn't used, it invalidates the entry if the pdf changes
+    return RASTERIZERS[name]().page_info(path, page)
+
+
+def page_info(rasterizer, source, page, signature=None):
+    """
+    Return the page count of a pdf, and the (width, height) of one of its
+    pages in points
+
+    Raises InvalidPageError if the pdf has no such page.
+    """
+    if signature is None:
+        return rasterizer.page_info(source, page)
+    return _page_info(rasterizer.name, source, page, signature)
+
+
+def rendered_size(page_size, dpi):
+    return tuple(max(1, floor(x * dpi / POINTS_PER_INCH)) for x in page_size)
+
+
+def native_size(page_size):
+    return rendered_size(page_size, NATIVE_DPI)
+
+
+def choose_dpi(page_size, size):
+    """
+    Return the lowest of DPI_STEPS at which a page is at least the given
+    size, or the highest if none is
+
+    __Args__
+    1) page_size (tuple): The (width, height) of the page in points
+    2) size (tuple): The (width, height) required in pixels
+    """
+    required = POINTS_PER_INCH * max(size[0] / page_size[0], size[1] / page_size[1])
+    for dpi in DPI_STEPS:
+        if dpi >= required:
+            return dpi
+    return DPI_STEPS[-1]
+
+
+def page_render_args(page_size, args, thumbnail=False):
+    """
+    Resolve the transformation arguments of a request for a page against
+    its native dimensions
+
+    The arguments are returned as an explicit width/height, so that the
+    page may be rendered at whatever resolution suits the request and then
+    transformed as though it were an image of its native dimensions.
+
+    __Args__
+    1) page_size (tuple): The (width, height) of the page in points
+    2) args (dict): The transformation arguments
+
+    __KWArgs__
+    * thumbnail (bool): Whether the request is for a thumbnail
+
+    __Return Values__
+    * (tuple) The dpi to render the page at, and the arguments to render with
+    """
+    o_width, o_height = native_size(page_size)
+    args = sane_transform_args(dict(args), o_width, o_height)
+    if thumbnail:
+        size = thumbnail_size(o_width, o_height, (args['width'], args['height']))
+    else:
+        size = target_size(args, o_width, o_height) or (o_width, o_height)
+    args.update({'width': size[0], 'height': size[1], 'scale': None})
+    for x in ('cropstartx', 'cropstarty', 'cropendx', 'cropendy'):
+        args.setdefault(x, None)
+    return choose_dpi(page_size, size), args
+
+
+def rasterize_page(source, name, page, dpi):
+    """
+    Render a page of a pdf as a (quickly compressed) png
+
+    __Args__
+    1) source (str): The path to the pdf
+    2) name (str): The name of the rasterizer to use
+    3) page (int): The page, counting from 1
+    4) dpi (int): The resolution to render at
+
+    __Return Values__
+    * (bytes) The png
+    """
+    with metrics.stage("rasterize"):
+        image = RASTERIZERS[name]().render(source, page, dpi)
+    result = BytesIO()
+    with metrics.stage("encode"):
+        image.save(result, "PNG", compress_level=1)
+    return result.getvalue()
+
+
+class QpdfWriter:
+    name = "qpdf"
+    can_linearize = True
+
+    @staticmethod
+    def available():
+        return bool(shutil.which("qpdf"))
+
+    @staticmethod
+    def _run(args):
+        # qpdf exits 3 when it succeeded with warnings
+        result = subprocess.run(["qpdf"] + args, capture_output=True)
+        if result.returncode not in (0, 3):
+            raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+        return result.stdout
+
+    def page_count(self, path):
+        return int(self._run(["--show-npages", path]))
+
+    def extract(self, path, pages, out, linearize=False):
+        self._run((["--linearize"] if linearize else []) +
+                  [path, "--pages", ".", format_pages(pages), "--", out])
+
+    def linearize(self, path, out):
+        self._run(["--linearize", path, out])
+
+
+class PypdfWriter:
+    name = "pypdf"
+    can_linearize = False
+
+    @staticmethod
+    def available():
+        try:
+            import pypdf  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def page_count(self, path):
+        from pypdf import PdfReader
+        return len(PdfReader(path).pages)
+
+    def extract(self, path, pages, out, linearize=False):
+        from pypdf import PdfReader, PdfWriter
+        reader = PdfReader(path)
+        writer = PdfWriter()
+        for page in pages:
+            writer.add_page(reader.pages[page - 1])
+        with open(out, "wb") as f:
+            writer.write(f)
+
+    def linearize(self, path, out):
+        raise PDFWriterUnavailableError("pypdf can't linearize pdfs")
+
+
+# name: writer class, in order of preference
+WRITERS = {x.name: x for x in (QpdfWriter, PypdfWriter)}
+
+
+def get_writer(name=None):
+    """
+    Return a pdf writer, either the one named or the first available
+
+    Raises PDFWriterUnavailableError if there isn't one.
+    """
+    if name:
+        if name not in WRITERS or not WRITERS[name].available():
+            raise PDFWriterUnavailableError("The {} pdf writer isn't available".format(name))
+        return WRITERS[name]()
+    for kls in WRITERS.values():
+        if kls.available():
+            return kls()
+    raise PDFWriterUnavailableError()
+
+
+@lru_cache(maxsize=4096)
+def _page_count(name, path, signature):
+    return WRITERS[name]().page_count(path)
+
+
+def page_count(writer, path, signature=None):
+    """
+    Return the number of pages in a pdf
+    """
+    if signature is None:
+        return writer.page_count(path)
+    return _page_count(writer.name, path, signature)
+
+
+def parse_pages(spec, count):
+    """
+    Parse a selection of pages, eg "3-5" or "1,4,7-9"
+
+    __Args__
+    1) spec (str): The selection
+    2) count (int): The number of pages in the pdf
+
+    __Return Values__
+    * (list[int]) The selected pages, counting from 1, in the order given
+
+    Raises InvalidPageError if the selection is malformed or includes pages
+    the pdf doesn't have.
+    """
+    pages = []
+    for part in spec.split(","):
+        first, _, last = part.strip().partition("-")
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise InvalidPageError("Invalid pages: {}".format(spec))
+        if not 1 <= first <= last <= count:
+            raise InvalidPageError("Pages {} aren't within the pdf's {} pages".format(part, count))
+        pages.extend(range(first, last + 1))
+    return pages
+
+
+def format_pages(pages):
+    """
+    The canonical selection of a list of pages, with runs collapsed into ranges
+    """
+    runs = []
+    for page in pages:
+        if runs and page == runs[-1][1] + 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return ",".join(str(a) if a == b else "{}-{}".format(a, b) for a, b in runs)
+
+
+def iter_mvol_issues(mvol_root):
+    """
+    Yield the identifiers of every mvol issue with a pdf
+    """
+    for dirpath, dirnames, filenames in os.walk(join(mvol_root, "mvol")):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            identifier, ext = os.path.splitext(fname)
+            if ext == ".pdf" and MvolLayer3StorageInterface.claim_identifier(identifier):
+                yield identifier
+
+
+def linearize_issue(conf, writer, identifier, force=False):
+    """
+    Write the linearized copy of an issue's pdf, if it is missing or stale
+
+    __Return Values__
+    * (bool) Whether the copy was written
+    """
+    storage_instance = MvolLayer3StorageInterface(conf)
+    path = storage_instance.linearized_path(identifier)
+    master = storage_instance.get_pdf(identifier)
+    if not force and isfile(path) and os.stat(path).st_mtime >= os.stat(master).st_mtime:
+        return False
+    write_atomically(lambda out: writer.linearize(master, out), path)
+    log.info("Linearized {}".format(identifier))
+    return True
+
+
+def linearize_pdfs(conf, writer, workers=4, force=False):
+    """
+    Write the missing or stale linearized copies of every issue's pdf
+
+    __Return Values__
+    * (dict) Counts of issues "linearized", "skipped" and "failed"
+    """
+    # The work is done by qpdf, so threads suffice
+    job = partial(linearize_issue, conf, writer, force=force)
+    return run_jobs(job, iter_mvol_issues(conf['MVOL_ROOT']), workers,
+                    executor_class=ThreadPoolExecutor, outcomes=("linearized", "skipped"),
+                    action="linearize")
+
+
+def main():
+    parser = make_parser("Write linearized copies of mvol issue pdfs")
+    add_mvol_args(parser, derivative_root="Write copies here, rather than beside the pdfs")
+    add_build_args(parser, force="Rewrite up to date copies", workers=4)
+    args = parse_args(parser, mvol_root="MVOL_ROOT")
+    writer = get_writer("qpdf")
+    conf = {"MVOL_ROOT": args.mvol_root, "DERIVATIVE_ROOT": args.derivative_root}
+    counts = linearize_pdfs(conf, writer, workers=args.workers, force=args.force)
+    print(format_counts(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Tiled, multi-resolution ("pyramidal") tifs, which allow a region of an
+image to be produced at a given size by decoding only the tiles of the
+nearest resolution which intersect it.
+
+    digcollretriever-build-pyramids --mvol-root /path/to/mvol/parent
+
+PIL can't write tiled tifs, and only decodes individual tiles of tiled
+tifs which are uncompressed, so pyramids are written (uncompressed) by
+write_pyramid() below. Each resolution is stored as a subfile flagged as
+a reduced resolution version of the first (see lib.reduced_decode() and
+lib.decode_tiles()).
+"""
+import logging
+import os
+import struct
+from functools import partial
+from os.path import isfile
+
+from PIL import Image
+
+from .derivatives import iter_mvol_pages
+from .storageinterfaces import MvolLayer4StorageInterface
+from .tools import write_atomically, run_jobs, format_counts, make_parser, add_mvol_args, \
+    add_build_args, parse_args
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TILE_SIZE = 256
+
+# TIFF field types
+SHORT = 3
+LONG = 4
+
+# Classic (non-Big) TIFF uses 32 bit offsets
+MAX_TIFF_BYTES = 2 ** 32 - 1
+
+
+def pyramid_levels(image, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Yield an image and successive halvings of it, until a level fits in a tile
+    """
+    yield image
+    while max(image.size) > tile_size:
+        image = image.reduce(2)
+        yield image
+
+
+def _ifd(offset, entries, next_ifd=0):
+    """
+    Serialize an image file directory which will be written at offset
+
+    __Args__
+    1) offset (int): Where the IFD will be written
+    2) entries (list): (tag, type, values) tuples
+
+    __Return Values__
+    * (tuple) The bytes of the IFD, and the position of its next IFD pointer
+    """
+    entries = sorted(entries)
+    size = 2 + 12 * len(entries) + 4
+    body = struct.pack("<H", len(entries))
+    extra = b""
+    for tag, typ, values in entries:
+        fmt = "H" if typ == SHORT else "I"
+        data = struct.pack("<{}{}".format(len(values), fmt), *values)
+        if len(data) <= 4:
+            body += struct.pack("<HHI", tag, typ, len(values)) + data.ljust(4, b"\0")
+        else:
+            body += struct.pack("<HHII", tag, typ, len(values), offset + size + len(extra))
+            extra += data
+            if len(extra) % 2:
+                extra += b"\0"
+    next_pointer = offset + len(body)
+    body += struct.pack("<I", next_ifd)
+    return body + extra, next_pointer
+
+
+def write_pyramid(image, path, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Write an image as an uncompressed, tiled, pyramidal tif
+
+    __Args__
+    1) image (PIL.Image.Image): The full resolution image
+    2) path (str): Where to write the tif
+
+    __KWArgs__
+    * tile_size (int): The width and height of tiles, a multiple of 16
+    """
+    if tile_size % 16:
+        raise ValueError("Tile size must be a multiple of 16")
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    samples = len(image.getbands())
+    with open(path, "wb") as f:
+        f.write(b"II*\0" + struct.pack("<I", 0))
+        pointer = 4
+        for i, level in enumerate(pyramid_levels(image, tile_size)):
+            width, height = level.size
+            offsets, counts = [], []
+            for y in range(0, height, tile_size):
+                for x in range(0, width, tile_size):
+                    # Edge tiles are padded out to the full tile size
+                    data = level.crop((x, y, x + tile_size, y + tile_size)).tobytes()
+                    offsets.append(f.tell())
+                    counts.append(len(data))
+                    f.write(data)
+            entries = [
+                (254, LONG, [1 if i else 0]),
+                (256, LONG, [width]),
+                (257, LONG, [height]),
+                (258, SHORT, [8] * samples),
+                (259, SHORT, [1]),
+                (262, SHORT, [2 if samples == 3 else 1]),
+                (277, SHORT, [samples]),
+                (284, SHORT, [1]),
+                (322, LONG, [tile_size]),
+                (323, LONG, [tile_size]),
+                (324, LONG, offsets),
+                (325, LONG, counts)
+            ]
+            offset = f.tell() + (f.tell() % 2)
+            f.seek(offset)
+            ifd, next_pointer = _ifd(offset, entries)
+            if offset + len(ifd) > MAX_TIFF_BYTES:
+                raise ValueError("Image is too large for a classic tif")
+            f.write(ifd)
+            end = f.tell()
+            f.seek(pointer)
+            f.write(struct.pack("<I", offset))
+            f.seek(end)
+            pointer = next_pointer
+
+
+def build_page_pyramid(conf, identifier, tile_size=DEFAULT_TILE_SIZE, force=False):
+    """
+    Build the pyramid of a single mvol page, if it is missing or stale
+
+    __Return Values__
+    * (bool) Whether the pyramid was built
+    """
+    storage_instance = MvolLayer4StorageInterface(conf)
+    master = storage_instance.get_tif(identifier)
+    path = storage_instance.pyramid_path(identifier)
+    if not force and isfile(path) and os.stat(path).st_mtime >= os.stat(master).st_mtime:
+        return False
+    with Image.open(master) as image:
+        write_atomically(lambda tmp: write_pyramid(image, tmp, tile_size=tile_size), path)
+    log.info("Built pyramid for {}".format(identifier))
+    return True
+
+
+def build_pyramids(conf, workers=None, tile_size=DEFAULT_TILE_SIZE, force=False):
+    """
+    Build the missing or stale pyramids of every mvol page, in parallel
+
+    __Return Values__
+    * (dict) Counts of pages "built", "skipped" and "failed"
+    """
+    job = partial(build_page_pyramid, conf, tile_size=tile_size, force=force)
+    return run_jobs(job, iter_mvol_pages(conf['MVOL_ROOT']), workers, action="build the pyramid of")
+
+
+def main():
+    parser = make_parser("Write tiled, pyramidal tifs of mvol pages")
+    add_mvol_args(parser, derivative_root="Write pyramids here, rather than beside the masters")
+    add_build_args(parser, force="Rebuild up to date pyramids")
+    parser.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE)
+    args = parse_args(parser, mvol_root="MVOL_ROOT")
+    conf = {"MVOL_ROOT": args.mvol_root, "DERIVATIVE_ROOT": args.derivative_root}
+    counts = build_pyramids(conf, workers=args.workers, tile_size=args.tile_size, force=args.force)
+    print(format_counts(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Resolution of identifiers to the StorageInterface classes which handle them
+"""
+import inspect
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+from .storageinterfaces import StorageInterface
+
+
+log = logging.getLogger(__name__)
+
+
+def _uses_default_claim(kls):
+    return getattr(kls.claim_identifier, "__func__", None) is \
+        StorageInterface.claim_identifier.__func__
+
+
+def _combinable(pattern):
+    # Flags don't survive being embedded in the alternation by source, and
+    # groups of the pattern's own would renumber, or shadow the group
+    # identifying it
+    return pattern.groups == 0 and not pattern.flags & ~re.UNICODE
+
+
+class IdentifierRegistry:
+    """
+    An ordered collection of StorageInterface classes.
+
+    Classes which declare an identifier_pattern and don't override
+    claim_identifier are matched with precompiled alternations of their
+    patterns, consecutive patterns without flags or groups of their own
+    sharing one, others matched alone, in registration order. Classes
+    which implement their own claim_identifier are consulted afterwards,
+    in registration order.
+    Results are memoized in a bounded LRU.
+    """
+    def __init__(self, classes=None, cache_size=4096):
+        """
+        __KWArgs__
+        * classes (list[cls]): StorageInterface classes to register, in order
+        * cache_size (int): The number of identifier resolutions to remember
+        """
+        self.cache_size = cache_size
+        self._classes = []
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._matchers = []
+        self._claimers = []
+        for kls in classes or []:
+            self.register(kls, _compile=False)
+        self._compile()
+
+    @classmethod
+    def from_module(cls, module, **kwargs):
+        """
+        Build a registry from the StorageInterface subclasses defined in
+        or imported into a module, in alphabetical order.
+        """
+        classes = [
+            x[1] for x in inspect.getmembers(module, inspect.isclass)
+            if issubclass(x[1], StorageInterface)
+        ]
+        return cls(classes, **kwargs)
+
+    @property
+    def classes(self):
+        return list(self._classes)
+
+    def register(self, kls, _compile=True):
+        """
+        Register a StorageInterface class
+
+        __Args__
+        1) kls (cls): A StorageInterface subclass
+        """
+        if not issubclass(kls, StorageInterface):
+            raise TypeError("{} is not a StorageInterface".format(kls.__name__))
+        if kls in self._classes:
+            return
+        self._classes.append(kls)
+        if _compile:
+            self._compile()
+
+    def _compile(self):
+        # (compiled pattern, {group name: class}) pairs, a group name of
+        # None indicating a pattern matched alone
+        matchers = []
+        patterns = []
+        group_to_kls = {}
+        claimers = []
+
+        def flush():
+            if patterns:
+                matchers.append((re.compile("|".join(patterns)), dict(group_to_kls)))
+                patterns.clear()
+                group_to_kls.clear()
+
+        for i, kls in enumerate(self._classes):
+            pattern = getattr(kls, "identifier_pattern", None)
+            if _uses_default_claim(kls):
+                if pattern is None:
+                    # Can never claim anything
+                    continue
+                if not _combinable(pattern):
+                    flush()
+                    matchers.append((pattern, {None: kls}))
+                    continue
+                group = "k{}".format(i)
+                group_to_kls[group] = kls
+                patterns.append("(?P<{}>{})".format(group, pattern.pattern))
+            else:
+                claimers.append(kls)
+        flush()
+        self._matchers = matchers
+        self._claimers = claimers
+        with self._lock:
+            self._cache.clear()
+        log.debug("Compiled identifier registry of {} classes".format(len(self._classes)))
+
+    def _lookup(self, identifier):
+        for pattern, group_to_kls in self._matchers:
+            match = pattern.match(identifier)
+            if match is not None:
+                return group_to_kls.get(None) or group_to_kls[match.lastgroup]
+        for kls in self._claimers:
+            if kls.claim_identifier(identifier):
+                return kls
+        return None
+
+    def resolve(self, identifier):
+        """
+        Return the class which claims an identifier, or None
+        """
+        with self._lock:
+            if identifier in self._cache:
+                self._cache.move_to_end(identifier)
+                return self._cache[identifier]
+        kls = self._lookup(identifier)
+        with self._lock:
+            self._cache[identifier] = kls
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return kls
@@ -0,0 +1,405 @@
+"""
+Masters held in a remote, eg S3 compatible, object store, read over HTTP
+with ranged GETs
+
+Objects are opened as seekable file like objects, so that PIL reads only
+the parts of an image it needs: its header, and the strips or tiles of
+the region it decodes. Reads are made a block at a time, the blocks which
+follow a missing block are read ahead in the same request, and blocks are
+kept in a bounded, per process, LRU block cache shared by every object of
+a store. Connections are pooled and kept alive between requests.
+"""
+import http.client
+import io
+import logging
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, quote
+
+from ..exceptions import SourceNotFoundError, RemoteStorageError
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+DEFAULT_READ_AHEAD = 4
+
+DEFAULT_MAX_CONNECTIONS = 16
+
+DEFAULT_TIMEOUT = 30
+
+DEFAULT_BLOCK_CACHE_BYTES = 256 * 1024 * 1024
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    A bounded pool of keep-alive HTTP(S) connections to a single host
+    """
+    def __init__(self, scheme, netloc, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 timeout=DEFAULT_TIMEOUT):
+        """
+        __Args__
+        1) scheme (str): "http" or "https"
+        2) netloc (str): The host, and optionally port, to connect to
+
+        __KWArgs__
+        * max_connections (int): The number of requests which may be made at
+            once, further requests wait for a connection to be returned
+        * timeout (float): The socket timeout, in seconds
+        """
+        self.connection_class = http.client.HTTPSConnection if scheme == "https" \
+            else http.client.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.connections = 0
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+            self.connections += 1
+        return self.connection_class(self.netloc, timeout=self.timeout), False
+
+    def _put(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    def request(self, method, path, headers=None):
+        """
+        Make a request, reading the whole response
+
+        __Return Values__
+        * (tuple) The status, headers (http.client.HTTPMessage) and body
+        """
+        with self._slots:
+            while True:
+                conn, reused = self._get()
+                try:
+                    conn.request(method, path, headers=headers or {})
+                    response = conn.getresponse()
+                    body = response.read()
+                except (http.client.RemoteDisconnected, ConnectionError) as e:
+                    conn.close()
+                    if reused:
+                        # The server closed an idle connection, try another
+                        continue
+                    raise RemoteStorageError("Requesting {} failed: {}".format(path, e))
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    raise RemoteStorageError("Requesting {} failed: {}".format(path, e))
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._put(conn)
+                return response.status, response.headers, body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class BlockCache:
+    """
+    A byte bounded LRU cache of blocks of remote objects
+    """
+    def __init__(self, max_bytes=DEFAULT_BLOCK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._blocks
+
+    def put(self, key, block):
+        if not self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._blocks[key] = block
+            self.bytes += len(block)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def stats(self):
+        return {"entries": len(self._blocks), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    A read only, seekable file like object over a remote object
+    """
+    def __init__(self, store, key, size, etag=None, mtime_ns=None):
+        """
+        __Args__
+        1) store (RemoteStore): The store holding the object
+        2) key (str): The key of the object
+        3) size (int): The length of the object in bytes
+
+        __KWArgs__
+        * etag (str): The ETag of the object, reads fail rather than mix
+            versions if it changes
+        * mtime_ns (int): When the object was last modified
+        """
+        super().__init__()
+        self.store = store
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.mtime_ns = mtime_ns
+        self._pos = 0
+
+    @property
+    def signature(self):
+        """
+        The equivalent of cache.source_signature() for a filepath, so that
+        derivatives of remote masters may be cached and validated
+        """
+        if self.mtime_ns is None and self.etag is None:
+            return None
+        return (self.mtime_ns or 0, self.size, self.etag)
+
+    @property
+    def version(self):
+        """
+        Tells this version of the object from others at the same key: its
+        ETag, or failing that its modification time and size, or None if
+        the store gave neither
+        """
+        if self.etag is not None:
+            return self.etag
+        if self.mtime_ns is not None:
+            return (self.mtime_ns, self.size)
+        return None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence: {}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        length = min(len(b), self.size - self._pos)
+        if length <= 0:
+            return 0
+        data = self.store.read(self, self._pos, length)
+        b[:length] = data
+        self._pos += length
+        return length
+
+    def readall(self):
+        return self.read(max(self.size - self._pos, 0))
+
+
+class RemoteStore:
+    """
+    Objects below a base URL, read with ranged GETs through a shared
+    connection pool and block cache
+    """
+    def __init__(self, base_url, block_size=DEFAULT_BLOCK_SIZE, read_ahead=DEFAULT_READ_AHEAD,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, timeout=DEFAULT_TIMEOUT,
+                 cache_bytes=DEFAULT_BLOCK_CACHE_BYTES, stat_ttl=0):
+        """
+        __Args__
+        1) base_url (str): The URL object keys are relative to, eg
+            https://s3.example.edu/bucket/prefix
+
+        __KWArgs__
+        * block_size (int): The unit, in bytes, objects are read and cached in
+        * read_ahead (int): The number of blocks read beyond a missing block
+        * max_connections (int): The size of the connection pool
+        * timeout (float): The socket timeout, in seconds
+        * cache_bytes (int): The byte budget of the block cache
+        * stat_ttl (float): Seconds to remember the size and version of an
+            object for, 0 asks the store on every open
+        """
+        parts = urlsplit(base_url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError("Unsupported remote storage url: {}".format(base_url))
+        self.base_url = base_url
+        self.base_path = parts.path.rstrip("/")
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.stat_ttl = stat_ttl
+        self.requests = 0
+        self.bytes_fetched = 0
+        self.pool = ConnectionPool(parts.scheme, parts.netloc, max_connections, timeout)
+        self.cache = BlockCache(cache_bytes)
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def path(self, key):
+        return self.base_path + "/" + quote(key)
+
+    def _request(self, method, key, headers=None):
+        status, headers, body = self.pool.request(method, self.path(key), headers)
+        with self._stats_lock:
+            self.requests += 1
+            self.bytes_fetched += len(body)
+        if status == 404:
+            log.debug("No object {} exists".format(key))
+            raise SourceNotFoundError()
+        return status, headers, body
+
+    def stat(self, key):
+        """
+        Return the size, ETag and modification time (in ns) of an object
+
+        Raises SourceNotFoundError if there is no such object.
+        """
+        if self.stat_ttl:
+            with self._stats_lock:
+                entry = self._stats.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+        status, headers, _ = self._request("HEAD", key)
+        if status != 200:
+            raise RemoteStorageError("Stat of {} failed with status {}".format(key, status))
+        modified = headers.get("Last-Modified")
+        mtime_ns = None
+        if modified:
+            mtime_ns = int(parsedate_to_datetime(modified).timestamp()) * 1000000000
+        result = (int(headers["Content-Length"]), headers.get("ETag"), mtime_ns)
+        if self.stat_ttl:
+            with self._stats_lock:
+                self._stats[key] = (time.monotonic() + self.stat_ttl, result)
+        return result
+
+    def open(self, key):
+        """
+        Open an object
+
+        __Return Values__
+        * (RemoteFile) The object
+
+        Raises SourceNotFoundError if there is no such object.
+        """
+        size, etag, mtime_ns = self.stat(key)
+        return RemoteFile(self, key, size, etag=etag, mtime_ns=mtime_ns)
+
+    def fetch(self, f, start, end):
+        """
+        Read bytes [start, end) of an object from the store
+        """
+        headers = {"Range": "bytes={}-{}".format(start, end - 1)}
+        if f.etag:
+            headers["If-Match"] = f.etag
+        status, _, body = self._request("GET", f.key, headers)
+        if status == 200:
+            # The store ignored the range
+            return body[start:end]
+        if status != 206:
+            raise RemoteStorageError("Reading {} failed with status {}".format(f.key, status))
+        return body
+
+    def read(self, f, start, length):
+        """
+        Read bytes of an object, through the block cache
+
+        __Args__
+        1) f (RemoteFile): The object
+        2) start (int): The offset to read from
+        3) length (int): The number of bytes to read, which must not extend
+            past the end of the object
+        """
+        version = f.version
+        if version is None:
+            # Its blocks couldn't be told from those of an object since
+            # replaced at the same key, so bypass the block cache
+            return self.fetch(f, start, start + length)
+        bs = self.block_size
+        first, last = start // bs, (start + length - 1) // bs
+        final = (f.size - 1) // bs
+        blocks = []
+        i = first
+        while i <= last:
+            block = self.cache.get((f.key, version, i))
+            if block is not None:
+                blocks.append(block)
+                i += 1
+                continue
+            # Fetch the whole run of missing blocks, and those after it, at once
+            j = i
+            while j < last and (f.key, version, j + 1) not in self.cache:
+                j += 1
+            end = min(j + self.read_ahead, final)
+            data = self.fetch(f, i * bs, min((end + 1) * bs, f.size))
+            for k in range(i, end + 1):
+                block = data[(k - i) * bs:(k - i + 1) * bs]
+                self.cache.put((f.key, version, k), block)
+                if k <= j:
+                    blocks.append(block)
+            i = j + 1
+        data = b"".join(blocks)
+        offset = start - first * bs
+        return data[offset:offset + length]
+
+    def stats(self):
+        return {"requests": self.requests, "bytes_fetched": self.bytes_fetched,
+                "connections": self.pool.connections, "block_cache": self.cache.stats()}
+
+
+def get_store(base_url, **kwargs):
+    """
+    Return the (shared) RemoteStore for a base URL
+
+    __KWArgs__
+    * As for RemoteStore, used only when the store is first created
+    """
+    with _STORES_LOCK:
+        if base_url not in _STORES:
+            _STORES[base_url] = RemoteStore(base_url, **kwargs)
+        return _STORES[base_url]
+
+
+def stats():
+    """
+    The statistics of every store in use by this process
+    """
+    with _STORES_LOCK:
+        return {url: store.stats() for url, store in _STORES.items()}
@@ -18,7 +18,10 @@ stat_schema = {
         "contexts_available": {"type": "array",
                                "items": {"type": "string",
                                          "pattern": "^.*$"},
-                               "minItems": 0}
+                               "minItems": 0},
+        "formats_available": {"type": "array",
+                              "items": {"type": "string"},
+                              "minItems": 0}
     }
 }
 
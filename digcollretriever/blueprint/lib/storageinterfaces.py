@@ -1,8 +1,10 @@
-from os.path import join
+from os.path import join, getmtime, splitext
 import re
-from PIL import Image
 
-from ..exceptions import Omitted
+from ..exceptions import Omitted, SourceNotFoundError
+from .techmd import get_index, image_dimensions
+from .listing import get_scan_cache
+from . import remote
 
 # NOTE: When implementing your identifier schema be sure that the set of
 # all valid identifiers from other schemas is disjoint from the set of
@@ -17,6 +19,11 @@ class StorageInterface:
     Provides method signatures and documentation in each method pertaining
     to implementing said method in your own subclass
     """
+    # A compiled regular expression matching the identifiers this class
+    # handles. Classes which declare one and don't override claim_identifier
+    # are matched via a single precompiled dispatch regex.
+    identifier_pattern = None
+
     @classmethod
     def claim_identifier(cls, identifier):
         """
@@ -24,6 +31,9 @@ class StorageInterface:
         in instances where the interface class can/should handle an identifier,
         and otherwise boolean False
 
+        The default implementation matches identifier_pattern, prefer
+        setting that over overriding this method.
+
         __Args__
 
         1) identifier (str): An identifier
@@ -33,7 +43,9 @@ class StorageInterface:
         * (bool): A boolean representation of whether or not this StorageInterface
             should be used to handle requests pertaining to the identifier.
         """
-        return False
+        if cls.identifier_pattern is None:
+            return False
+        return cls.identifier_pattern.match(identifier) is not None
 
     def __init__(self, conf):
         """
@@ -90,6 +102,20 @@ class StorageInterface:
         """
         raise Omitted()
 
+    def get_pdf_linearized(self, identifier):
+        """
+        Return an up to date, linearized ("fast web view") copy of a pdf
+        (see lib.pdf), or raise Omitted if none is available. When present
+        the API will send it in place of the pdf.
+
+        __Args__
+        1) identifier (str): The identifier of the pdf
+
+        __Return Values__
+        * (str/bytes) A filepath to the pdf on disk
+        """
+        raise Omitted()
+
     def get_jpg(self, identifier):
         """
         Return a jpg file, or raise Omitted to trigger fallback functionality
@@ -129,12 +155,71 @@ class StorageInterface:
         """
         raise Omitted()
 
+    def get_jpg_derivatives(self, identifier):
+        """
+        Return pre-built jpg derivatives of an image, or raise Omitted if
+        none are available. Derivatives must preserve the aspect ratio of
+        the image. When present the API will produce jpgs by resizing the
+        smallest derivative which is at least as large as the request,
+        rather than from the master.
+
+        __Args__
+        1) identifier (str): The identifier of the image
+
+        __Return Values__
+        * (list) filepaths (str/bytes) to jpg files on disk
+        """
+        raise Omitted()
+
+    def get_tif_pyramid(self, identifier):
+        """
+        Return an up to date, tiled, pyramidal copy of a tif (see lib.pyramid),
+        or raise Omitted if none is available. When present the API will
+        produce resized and cropped images from it, rather than from the
+        master, decoding only the tiles they require.
+
+        __Args__
+        1) identifier (str): The identifier of the image
+
+        __Return Values__
+        * (str/bytes) A filepath to the tif on disk
+        """
+        raise Omitted()
+
     def get_limb_ocr(self, identifier):
         """
         # TODO
         """
         raise Omitted()
 
+    def get_limb_ocr_pages(self, identifier):
+        """
+        Return the limb OCR of every page of an intellectual unit, eg an
+        issue, or raise Omitted. Required to search within the unit.
+
+        __Args__
+        1) identifier (str): The identifier of the intellectual unit
+
+        __Return Values__
+        * (list[tuple]) The identifier of each page and a filepath (str/bytes)
+            to its limb OCR on disk
+        """
+        raise Omitted()
+
+    def list_children(self, identifier):
+        """
+        Return the identifiers of the children of an intellectual unit, eg
+        the issues of a volume or the pages of an issue, or raise Omitted
+        if it has none
+
+        __Args__
+        1) identifier (str): The identifier of the intellectual unit
+
+        __Return Values__
+        * (list[str]) The identifiers of its children, in order
+        """
+        raise Omitted()
+
     def get_descriptive_metadata(self, identifier):
         """
         Returns DublinCore XML descriptive metadata about an intellectual unit
@@ -157,10 +242,7 @@ class FlatTifDirStorageInterface(StorageInterface):
     letters and numbers in their file names and serve them as tifs
     and jpgs via the web interface.
     """
-    @classmethod
-    def claim_identifier(cls, identifier):
-        if re.match("^flattifdir-[a-z0-9]+$", identifier):
-            return True
+    identifier_pattern = re.compile("^flattifdir-[a-z0-9]+$")
 
     def __init__(self, conf):
         self.root = conf['FLAT_TIF_DIR_ROOT']
@@ -176,10 +258,7 @@ class FlatJpgDirStorageInterface(StorageInterface):
     letters and numbers in their file names and serve them as tifs
     and jpgs via the web interface.
     """
-    @classmethod
-    def claim_identifier(cls, identifier):
-        if re.match("^flatjpgdir-[a-z0-9]+$", identifier):
-            return True
+    identifier_pattern = re.compile("^flatjpgdir-[a-z0-9]+$")
 
     def __init__(self, conf):
         self.root = conf['FLAT_JPG_DIR_ROOT']
@@ -193,43 +272,107 @@ class FlatJpgDirNoBadTifsStorageInterface(FlatJpgDirStorageInterface):
     A subclass of the above, which will refuse to produce tifs
     from jpgs dynamically
     """
-    @classmethod
-    def claim_identifier(cls, identifier):
-        if re.match("^flatjpgdirnobadtifs-[a-z0-9]+$", identifier):
-            return True
+    identifier_pattern = re.compile("^flatjpgdirnobadtifs-[a-z0-9]+$")
 
     def get_tif(self, identifier):
         raise NotImplementedError()
 
 
+class RemoteStorageInterface(StorageInterface):
+    """
+    A base class for StorageInterface classes serving files from a remote,
+    eg S3 compatible, object store over HTTP(S) (see lib.remote).
+
+    Subclasses map identifiers onto object keys and return self.open(key),
+    a seekable file like object read with ranged GETs, from their get_$fmt
+    methods. Missing objects raise SourceNotFoundError, triggering the
+    usual fallback functionality.
+    """
+    def __init__(self, conf):
+        self.store = remote.get_store(
+            conf['REMOTE_STORAGE_URL'],
+            block_size=int(conf.get('REMOTE_BLOCK_SIZE') or remote.DEFAULT_BLOCK_SIZE),
+            read_ahead=int(conf.get('REMOTE_READ_AHEAD', remote.DEFAULT_READ_AHEAD)),
+            max_connections=int(conf.get('REMOTE_MAX_CONNECTIONS') or remote.DEFAULT_MAX_CONNECTIONS),
+            timeout=float(conf.get('REMOTE_TIMEOUT') or remote.DEFAULT_TIMEOUT),
+            cache_bytes=int(conf.get('REMOTE_BLOCK_CACHE_BYTES', remote.DEFAULT_BLOCK_CACHE_BYTES)),
+            stat_ttl=float(conf.get('EXISTENCE_CACHE_TTL') or 0)
+        )
+
+    def open(self, key):
+        return self.store.open(key)
+
+
+class RemoteFlatTifStorageInterface(RemoteStorageInterface):
+    """
+    An example implementation of a remote storage interface class.
+    This one will take a bucket (or prefix) full of tifs with only
+    lowercase letters and numbers in their names and serve them as tifs
+    and jpgs via the web interface.
+    """
+    identifier_pattern = re.compile("^remotetif-[a-z0-9]+$")
+
+    def get_tif(self, identifier):
+        return self.open(identifier[10:] + ".tif")
+
+    def get_tif_techmd(self, identifier):
+        # Only the header of the tif is read
+        tif = self.get_tif(identifier)
+        width, height = image_dimensions(tif)
+        return {"width": width, "height": height, "bytes": tif.size}
+
+
+def scan_dir(scans, dir_path):
+    """
+    List a directory through a DirectoryScanCache, raising
+    SourceNotFoundError if it doesn't exist
+    """
+    try:
+        return scans.scan(dir_path)
+    except FileNotFoundError:
+        raise SourceNotFoundError()
+
+
 class MvolLayer1StorageInterface(StorageInterface):
-    @classmethod
-    def claim_identifier(cls, identifier):
-        if re.match("^mvol-[0-9]{4}$", identifier):
-            return True
+    identifier_pattern = re.compile("^mvol-[0-9]{4}$")
 
     def __init__(self, conf):
-        pass
+        self.MVOL_ROOT = conf['MVOL_ROOT']
+        self.scans = get_scan_cache(conf.get('DIRECTORY_SCAN_TTL'))
+
+    def build_dir_path(self, identifier):
+        return join(self.MVOL_ROOT, "mvol", identifier.split("-")[1])
+
+    def list_children(self, identifier):
+        children = [identifier + "-" + x for x in scan_dir(self.scans, self.build_dir_path(identifier))]
+        return [x for x in children if MvolLayer2StorageInterface.claim_identifier(x)]
 
 
 class MvolLayer2StorageInterface(StorageInterface):
-    @classmethod
-    def claim_identifier(cls, identifier):
-        if re.match("^mvol-[0-9]{4}-[0-9]{4}$", identifier):
-            return True
+    identifier_pattern = re.compile("^mvol-[0-9]{4}-[0-9]{4}$")
 
     def __init__(self, conf):
-        pass
+        self.MVOL_ROOT = conf['MVOL_ROOT']
+        self.scans = get_scan_cache(conf.get('DIRECTORY_SCAN_TTL'))
+
+    def build_dir_path(self, identifier):
+        return join(self.MVOL_ROOT, "mvol", identifier.split("-")[1], identifier.split("-")[2])
+
+    def list_children(self, identifier):
+        children = [identifier + "-" + x for x in scan_dir(self.scans, self.build_dir_path(identifier))]
+        return [x for x in children if MvolLayer3StorageInterface.claim_identifier(x)]
 
 
 class MvolLayer3StorageInterface(StorageInterface):
-    @classmethod
-    def claim_identifier(cls, identifier):
-        if re.match("^mvol-[0-9]{4}-[0-9]{4}-[0-9]{4}$", identifier):
-            return True
+    identifier_pattern = re.compile("^mvol-[0-9]{4}-[0-9]{4}-[0-9]{4}$")
+
+    # The directories of an issue holding files named after its pages
+    PAGE_DIRS = ("TIFF", "ALTO")
 
     def __init__(self, conf):
         self.MVOL_ROOT = conf['MVOL_ROOT']
+        self.DERIVATIVE_ROOT = conf.get('DERIVATIVE_ROOT')
+        self.scans = get_scan_cache(conf.get('DIRECTORY_SCAN_TTL'))
 
     def build_dir_path(self, identifier):
         return join(
@@ -240,21 +383,62 @@ class MvolLayer3StorageInterface(StorageInterface):
             identifier.split("-")[3]
         )
 
+    def derivative_dir(self, identifier):
+        dir_path = self.build_dir_path(identifier)
+        if self.DERIVATIVE_ROOT:
+            dir_path = join(self.DERIVATIVE_ROOT, dir_path[len(self.MVOL_ROOT):].lstrip("/"))
+        return join(dir_path, "DERIVATIVES")
+
+    def linearized_path(self, identifier):
+        return join(self.derivative_dir(identifier), "linearized", identifier + ".pdf")
+
     def get_pdf(self, identifier):
         return join(self.build_dir_path(identifier), identifier + ".pdf")
 
+    def get_pdf_linearized(self, identifier):
+        path = self.linearized_path(identifier)
+        try:
+            if getmtime(path) >= getmtime(self.get_pdf(identifier)):
+                return path
+        except OSError:
+            pass
+        raise Omitted()
+
     def get_descriptive_metadata(self, identifier):
         return join(self.build_dir_path(identifier), identifier + ".dc.xml")
 
+    def get_limb_ocr_pages(self, identifier):
+        alto_dir = join(self.build_dir_path(identifier), "ALTO")
+        fnames = scan_dir(self.scans, alto_dir)
+        return [(fname[:-len(".xml")], join(alto_dir, fname)) for fname in fnames
+                if fname.endswith(".xml") and
+                MvolLayer4StorageInterface.claim_identifier(fname[:-len(".xml")])]
+
+    def list_children(self, identifier):
+        dir_path = self.build_dir_path(identifier)
+        scan_dir(self.scans, dir_path)
+        pages = set()
+        for page_dir in self.PAGE_DIRS:
+            try:
+                fnames = self.scans.scan(join(dir_path, page_dir))
+            except FileNotFoundError:
+                continue
+            pages.update(splitext(x)[0] for x in fnames)
+        return sorted(x for x in pages if MvolLayer4StorageInterface.claim_identifier(x))
+
 
 class MvolLayer4StorageInterface(StorageInterface):
-    @classmethod
-    def claim_identifier(cls, identifier):
-        if re.match("^mvol-[0-9]{4}-[0-9]{4}-[0-9]{4}_[0-9]{4}$", identifier):
-            return True
+    identifier_pattern = re.compile("^mvol-[0-9]{4}-[0-9]{4}-[0-9]{4}_[0-9]{4}$")
+
+    # Names of the standard derivative sizes, and the longest edge of each
+    # in pixels. None indicates native dimensions.
+    DERIVATIVE_SIZES = (("thumb", 200), ("screen", 1200), ("full", None))
 
     def __init__(self, conf):
         self.MVOL_ROOT = conf['MVOL_ROOT']
+        # Derivatives live beside the masters unless a sidecar root is given
+        self.DERIVATIVE_ROOT = conf.get('DERIVATIVE_ROOT')
+        self.TECHMD_INDEX = conf.get('TECHMD_INDEX')
 
     def build_dir_path(self, identifier):
         return join(
@@ -268,10 +452,49 @@ class MvolLayer4StorageInterface(StorageInterface):
     def get_tif(self, identifier):
         return join(self.build_dir_path(identifier), "TIFF", identifier + ".tif")
 
+    def derivative_dir(self, identifier):
+        dir_path = self.build_dir_path(identifier)
+        if self.DERIVATIVE_ROOT:
+            dir_path = join(self.DERIVATIVE_ROOT, dir_path[len(self.MVOL_ROOT):].lstrip("/"))
+        return join(dir_path, "DERIVATIVES")
+
+    def derivative_path(self, identifier, size_name):
+        return join(self.derivative_dir(identifier), size_name, identifier + ".jpg")
+
+    def pyramid_path(self, identifier):
+        return join(self.derivative_dir(identifier), "pyramid", identifier + ".tif")
+
+    def get_jpg_derivatives(self, identifier):
+        try:
+            master_mtime = getmtime(self.get_tif(identifier))
+        except OSError:
+            raise Omitted()
+        derivatives = []
+        for name, _ in self.DERIVATIVE_SIZES:
+            path = self.derivative_path(identifier, name)
+            try:
+                # Derivatives older than their master are out of date
+                if getmtime(path) >= master_mtime:
+                    derivatives.append(path)
+            except OSError:
+                pass
+        if not derivatives:
+            raise Omitted()
+        return derivatives
+
+    def get_tif_pyramid(self, identifier):
+        path = self.pyramid_path(identifier)
+        try:
+            if getmtime(path) >= getmtime(self.get_tif(identifier)):
+                return path
+        except OSError:
+            pass
+        raise Omitted()
+
     def get_tif_techmd(self, identifier):
-        tif = Image.open(self.get_tif(identifier))
-        width, height = tif.size
-        return {"width": width, "height": height}
+        record = get_index(self.TECHMD_INDEX).get(self.get_tif(identifier))
+        return {"width": record['width'], "height": record['height'],
+                "mode": record['mode'], "bytes": record['bytes']}
 
     def get_limb_ocr(self, identifier):
         return join(self.build_dir_path(identifier), "ALTO", identifier + ".xml")
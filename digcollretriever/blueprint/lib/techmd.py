@@ -0,0 +1,191 @@
+"""
+A persistent index of the technical metadata of masters, so that their
+dimensions can be known without opening them.
+
+    digcollretriever-index-techmd --index /path/to/techmd.sqlite3 DIR [DIR ...]
+
+Records are filled lazily on first access, or in bulk with the above
+command, and are replaced whenever the mtime or size of the file changes.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from .tools import run_jobs, format_counts, make_parser, parse_args
+
+
+log = logging.getLogger(__name__)
+
+FIELDS = ("width", "height", "mode", "bytes", "mtime_ns")
+
+IMAGE_EXTENSIONS = (".tif", ".tiff", ".jpg", ".jpeg")
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+class TechmdIndex:
+    """
+    A SQLite backed mapping of file paths to their technical metadata
+    """
+    def __init__(self, path=":memory:"):
+        """
+        __KWArgs__
+        * path (str): The SQLite database to store the index in. Defaults
+            to a non-persistent in memory database.
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            # Allow concurrent readers in other worker processes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS techmd ("
+            "path TEXT PRIMARY KEY, width INTEGER, height INTEGER, mode TEXT, "
+            "bytes INTEGER, mtime_ns INTEGER)"
+        )
+
+    def lookup(self, path):
+        """
+        Return the indexed record for a path without touching the
+        filesystem, or None. The record may be stale.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT width, height, mode, bytes, mtime_ns FROM techmd WHERE path = ?",
+                (path,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(FIELDS, row))
+
+    def get(self, path):
+        """
+        Return the technical metadata of an image, indexing it if its
+        record is missing or stale
+
+        __Args__
+        1) path (str): The path to the image
+
+        __Return Values__
+        * (dict) width, height, mode, bytes and mtime_ns
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        record = self.lookup(path)
+        if record is not None and record['mtime_ns'] == st.st_mtime_ns and \
+                record['bytes'] == st.st_size:
+            self.hits += 1
+            return record
+        self.misses += 1
+        return self.index(path, st)
+
+    def index(self, path, st=None):
+        """
+        (Re)index a single image
+        """
+        path = os.path.abspath(path)
+        if st is None:
+            st = os.stat(path)
+        log.debug("Indexing technical metadata of {}".format(path))
+        with Image.open(path) as image:
+            width, height = image.size
+            mode = image.mode
+        record = dict(zip(FIELDS, (width, height, mode, st.st_size, st.st_mtime_ns)))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO techmd (path, width, height, mode, bytes, mtime_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path,) + tuple(record[x] for x in FIELDS)
+            )
+        return record
+
+    def invalidate(self, path):
+        """
+        Drop the record for a path
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._conn.execute("DELETE FROM techmd WHERE path = ?", (path,))
+
+    def stats(self):
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM techmd").fetchone()[0]
+        return {"entries": count, "hits": self.hits, "misses": self.misses}
+
+
+def get_index(path=None):
+    """
+    Return the (shared) TechmdIndex stored at path, or an in memory
+    index if path is None
+    """
+    path = path or ":memory:"
+    with _INDEXES_LOCK:
+        if path not in _INDEXES:
+            _INDEXES[path] = TechmdIndex(path)
+        return _INDEXES[path]
+
+
+def image_dimensions(source, index=None):
+    """
+    Return the (width, height) of an image, from the index when possible
+
+    __Args__
+    1) source (str/file like object): The image
+
+    __KWArgs__
+    * index (TechmdIndex): The index to consult for filepaths
+    """
+    if index is not None and isinstance(source, str):
+        record = index.get(source)
+        return record['width'], record['height']
+    with Image.open(source) as image:
+        return image.size
+
+
+def index_tree(index, root):
+    """
+    Index every image under a directory
+
+    __Return Values__
+    * (dict) Counts of images "indexed", "current" and "failed"
+    """
+    def iter_images():
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for fname in sorted(filenames):
+                if fname.lower().endswith(IMAGE_EXTENSIONS) and not fname.startswith("."):
+                    yield os.path.join(dirpath, fname)
+
+    def index_image(path):
+        misses = index.misses
+        index.get(path)
+        return index.misses > misses
+
+    # One at a time, so that misses are attributed to the right image
+    return run_jobs(index_image, iter_images(), 1, executor_class=ThreadPoolExecutor,
+                    outcomes=("indexed", "current"), action="index")
+
+
+def main():
+    parser = make_parser("Index the technical metadata of image masters")
+    parser.add_argument("--index", default=os.environ.get("DIGCOLLRETRIEVER_TECHMD_INDEX"),
+                        help="The SQLite database to store the index in")
+    parser.add_argument("roots", nargs="+", help="Directories to index")
+    args = parse_args(parser, index="TECHMD_INDEX")
+    index = TechmdIndex(args.index)
+    for root in args.roots:
+        counts = index_tree(index, os.path.abspath(root))
+        print("{}: {}".format(root, format_counts(counts)))
+
+
+if __name__ == "__main__":
+    main()
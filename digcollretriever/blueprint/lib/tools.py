@@ -0,0 +1,112 @@
+"""
+Helpers shared by the command line tools which build derivatives and
+indexes ahead of time
+"""
+import argparse
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from os.path import dirname
+
+
+log = logging.getLogger(__name__)
+
+ENV_PREFIX = "DIGCOLLRETRIEVER_"
+
+
+def write_atomically(write, path):
+    """
+    Write a file via a temporary file beside it, which is renamed into
+    place once complete, so that readers never see a partial file
+
+    __Args__
+    1) write (callable): Writes the file, given the temporary path
+    2) path (str): The path of the file
+    """
+    os.makedirs(dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dirname(path))
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def run_jobs(job, items, workers=None, executor_class=ProcessPoolExecutor,
+             outcomes=("built", "skipped"), action="process"):
+    """
+    Run job(item) for every item, in parallel
+
+    __Args__
+    1) job (callable): Does the work for one item, returning whether there
+        was any to do. Must be picklable for process pools.
+    2) items (iterable): The items
+
+    __KWArgs__
+    * workers (int): The size of the pool
+    * executor_class (cls): The concurrent.futures executor to use
+    * outcomes (tuple): The names to count items for which job returned
+        True and False under
+    * action (str): Describes the work, for logging failures
+
+    __Return Values__
+    * (dict) Counts of items under each of the outcomes, and "failed"
+    """
+    counts = dict.fromkeys(outcomes + ("failed",), 0)
+    with executor_class(max_workers=workers) as executor:
+        futures = {executor.submit(job, item): item for item in items}
+        for future, item in futures.items():
+            try:
+                counts[outcomes[0] if future.result() else outcomes[1]] += 1
+            except Exception as e:
+                log.warning("Failed to {} {}: {}".format(action, item, e))
+                counts["failed"] += 1
+    return counts
+
+
+def format_counts(counts):
+    return " ".join("{}: {}".format(k.capitalize(), v) for k, v in counts.items())
+
+
+def make_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--verbosity", default="INFO")
+    return parser
+
+
+def add_mvol_args(parser, derivative_root=None):
+    """
+    Add --mvol-root, and if its help is given --derivative-root
+    """
+    parser.add_argument("--mvol-root", default=os.environ.get(ENV_PREFIX + "MVOL_ROOT"),
+                        help="The directory containing the mvol directory")
+    if derivative_root:
+        parser.add_argument("--derivative-root", default=os.environ.get(ENV_PREFIX + "DERIVATIVE_ROOT"),
+                            help=derivative_root)
+
+
+def add_build_args(parser, force, workers=None):
+    """
+    Add --workers, and --force with the given help
+    """
+    parser.add_argument("--workers", type=int, default=workers)
+    parser.add_argument("--force", action="store_true", help=force)
+
+
+def parse_args(parser, **required):
+    """
+    Parse the command line and configure logging
+
+    __KWArgs__
+    * Arguments which are required, each mapped to the configuration
+        option (sans prefix) in the environment which may supply it
+    """
+    args = parser.parse_args()
+    for dest, option in required.items():
+        if not getattr(args, dest):
+            parser.error("--{} or {} is required".format(dest.replace("_", "-"), ENV_PREFIX + option))
+    logging.basicConfig(level=args.verbosity)
+    return args
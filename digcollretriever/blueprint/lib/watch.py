@@ -0,0 +1,697 @@
+"""
+Watching the directories masters are stored in, so that caches in front
+of them are invalidated as soon as masters change, rather than relying on
+every hit re-statting its master, and so that the standard derivatives of
+newly ingested pages are built before anybody asks for them.
+
+    digcollretriever-watch --mvol-root /path/to/mvol/parent [--warmup]
+
+Changes are noticed with inotify where it is available, and otherwise (or
+on filesystems, eg network mounts, where it doesn't report changes made
+elsewhere) by periodically statting every file, a batch at a time, and
+comparing mtimes and sizes against the previous pass.
+
+Caches which are shared between processes (the derivative cache, and the
+technical metadata and OCR indexes) may be invalidated by the standalone
+watcher. Caches which live in a process (the existence and directory
+scan caches) are only invalidated by a watcher running in that process,
+see the WATCH configuration option.
+
+Derivatives are warmed up by one process only: whichever first takes the
+warmup lock file beside the derivatives, be it the standalone watcher or
+one of the API's worker processes.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from os.path import join, basename, dirname, splitext
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .storageinterfaces import MvolLayer3StorageInterface, MvolLayer4StorageInterface, \
+    FlatTifDirStorageInterface, FlatJpgDirStorageInterface, FlatJpgDirNoBadTifsStorageInterface
+from .tools import make_parser, add_mvol_args
+
+
+log = logging.getLogger(__name__)
+
+CHANGED = "changed"
+REMOVED = "removed"
+# Changes may have been missed, everything should be considered changed
+RESCAN = "rescan"
+
+DEFAULT_POLL_INTERVAL = 30
+
+DEFAULT_BATCH_SIZE = 1000
+
+DEFAULT_WARMUP_DELAY = 5
+
+# The name of the lock file held by the process which warms up derivatives
+WARMUP_LOCK = ".warmup.lock"
+
+# Directories which hold things we write, rather than masters
+IGNORED_DIRS = ("DERIVATIVES",)
+
+# Prefix of the temporary files written (and renamed into place) by
+# tools.write_atomically()
+TEMP_PREFIX = ".tmp-"
+
+# The identifiers of the masters in the flat directories are their file
+# names, prefixed by one of these
+FLAT_TIF_PREFIXES = (("flattifdir-", FlatTifDirStorageInterface),)
+FLAT_JPG_PREFIXES = (("flatjpgdir-", FlatJpgDirStorageInterface),
+                     ("flatjpgdirnobadtifs-", FlatJpgDirNoBadTifsStorageInterface))
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def ignored(path):
+    """
+    Whether changes to a path are of no interest
+    """
+    name = basename(path)
+    return name.startswith(TEMP_PREFIX) or name in IGNORED_DIRS
+
+
+class InotifyWatcher:
+    """
+    Reports changes below a set of directories, via inotify.
+
+    Every directory below the roots is watched, and directories created
+    later are watched as they appear. Files are reported as changed once
+    they have been closed after writing, or moved into place, so files
+    still being copied aren't.
+    """
+    backend = "inotify"
+
+    def __init__(self, roots):
+        """
+        __Args__
+        1) roots (iterable): The directories to watch
+
+        Raises OSError if inotify isn't available, or a root can't be
+        watched, eg because the limit on watches has been reached.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._wds = {}
+        self.roots = list(roots)
+        try:
+            for root in self.roots:
+                self._add_tree(root, strict=True)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "Watching {} failed: {}".format(path, os.strerror(err)))
+        self._wds[wd] = path
+
+    def _add_tree(self, root, strict=False):
+        """
+        Watch a directory and every directory below it
+
+        __Return Values__
+        * (list) The files found below it, which may have been created
+            before it was watched
+        """
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [x for x in dirnames if not ignored(x)]
+            try:
+                self._add_watch(dirpath)
+            except OSError as e:
+                if strict:
+                    raise
+                log.warning(str(e))
+            files.extend(join(dirpath, x) for x in filenames if not ignored(x))
+        return files
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds for changes
+
+        __Return Values__
+        * (list) (kind, path) tuples
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                log.warning("inotify queue overflowed, changes may have been missed")
+                events.append((RESCAN, None))
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self._wds.pop(wd, None)
+                continue
+            parent = self._wds.get(wd)
+            if parent is None or not name or ignored(name):
+                continue
+            path = join(parent, name)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append((REMOVED, path))
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    events.append((CHANGED, path))
+                    events.extend((CHANGED, x) for x in self._add_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                events.append((CHANGED, path))
+        return events
+
+    def stats(self):
+        return {"backend": self.backend, "watches": len(self._wds)}
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """
+    Reports changes below a set of directories by comparing the mtime and
+    size of every file against the previous pass over them.
+
+    Files are statted batch_size at a time, with a short pause between
+    batches to spread the load a pass places on the filesystem, and a
+    pass begins interval seconds after the last began. The first pass
+    only records what exists.
+    """
+    backend = "poll"
+
+    def __init__(self, roots, interval=DEFAULT_POLL_INTERVAL, batch_size=DEFAULT_BATCH_SIZE,
+                 pause=0.05):
+        """
+        __Args__
+        1) roots (iterable): The directories to watch
+
+        __KWArgs__
+        * interval (float): Seconds between the starts of passes
+        * batch_size (int): The number of files statted at once
+        * pause (float): Seconds to wait between batches
+        """
+        self.roots = list(roots)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.passes = 0
+        self._snapshot = None
+        self._seen = None
+        self._walk = None
+        self._next_pass = time.monotonic()
+
+    def _iter_files(self):
+        stack = list(reversed(self.roots))
+        while stack:
+            path = stack.pop()
+            try:
+                with os.scandir(path) as it:
+                    entries = sorted(it, key=lambda x: x.name, reverse=True)
+            except OSError:
+                continue
+            for entry in entries:
+                if ignored(entry.name):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    # Removed since the directory was listed
+                    continue
+                yield entry.path, (st.st_mtime_ns, st.st_size)
+
+    def poll(self, timeout=None):
+        """
+        Stat the next batch of files, or wait up to timeout seconds for
+        the next pass to begin
+
+        __Return Values__
+        * (list) (kind, path) tuples
+        """
+        if self._walk is None:
+            wait = self._next_pass - time.monotonic()
+            if wait > 0:
+                time.sleep(wait if timeout is None else min(wait, timeout))
+                if time.monotonic() < self._next_pass:
+                    return []
+            self._next_pass = time.monotonic() + self.interval
+            self._walk = self._iter_files()
+            self._seen = {}
+        elif self.pause:
+            time.sleep(self.pause)
+        events = []
+        count = 0
+        for path, signature in self._walk:
+            self._seen[path] = signature
+            if self._snapshot is not None and self._snapshot.get(path) != signature:
+                events.append((CHANGED, path))
+            count += 1
+            if count >= self.batch_size:
+                return events
+        # The pass is complete
+        if self._snapshot is not None:
+            events.extend((REMOVED, x) for x in self._snapshot if x not in self._seen)
+        self._snapshot, self._seen, self._walk = self._seen, None, None
+        self.passes += 1
+        return events
+
+    def stats(self):
+        return {"backend": self.backend, "files": len(self._snapshot or ()),
+                "passes": self.passes, "interval": self.interval}
+
+    def close(self):
+        pass
+
+
+def open_watcher(roots, backend=None, interval=DEFAULT_POLL_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Start watching a set of directories
+
+    __Args__
+    1) roots (iterable): The directories to watch
+
+    __KWArgs__
+    * backend (str): "inotify" or "poll", defaults to inotify where it is
+        available, and polling otherwise
+    * interval (float), batch_size (int): As for PollingWatcher
+
+    __Return Values__
+    * (InotifyWatcher or PollingWatcher) The watcher
+    """
+    roots = [x for x in roots if os.path.isdir(x)]
+    if backend == "poll":
+        return PollingWatcher(roots, interval, batch_size)
+    if backend not in (None, "inotify"):
+        raise ValueError("Unknown watch backend: {}".format(backend))
+    try:
+        return InotifyWatcher(roots)
+    except OSError as e:
+        if backend == "inotify":
+            raise
+        log.warning("Can't watch with inotify ({}), polling instead".format(e))
+        return PollingWatcher(roots, interval, batch_size)
+
+
+def identifiers_for(conf, path):
+    """
+    Return the identifiers whose masters (or other files) a path holds
+
+    __Args__
+    1) conf (dict): The configuration, supplying the storage roots
+    2) path (str): The path of a file below them
+    """
+    stem, ext = splitext(basename(path))
+    mvol_root = conf.get('MVOL_ROOT')
+    if mvol_root:
+        mvol_dir = join(mvol_root, "mvol") + os.sep
+        if path.startswith(mvol_dir):
+            parts = path[len(mvol_dir):].split(os.sep)
+            if any(x in IGNORED_DIRS for x in parts):
+                return []
+            if len(parts) == 5 and parts[3] in MvolLayer3StorageInterface.PAGE_DIRS and \
+                    MvolLayer4StorageInterface.claim_identifier(stem):
+                return [stem]
+            if len(parts) == 4:
+                issue = "mvol-" + "-".join(parts[:3])
+                if MvolLayer3StorageInterface.claim_identifier(issue):
+                    return [issue]
+            return []
+    identifiers = []
+    for root, master_ext, prefixes in (
+            (conf.get('FLAT_TIF_DIR_ROOT'), ".tif", FLAT_TIF_PREFIXES),
+            (conf.get('FLAT_JPG_DIR_ROOT'), ".jpg", FLAT_JPG_PREFIXES)):
+        if root and ext == master_ext and dirname(path) == root.rstrip(os.sep):
+            for prefix, kls in prefixes:
+                if kls.claim_identifier(prefix + stem):
+                    identifiers.append(prefix + stem)
+    return identifiers
+
+
+def is_page_master(path):
+    """
+    Whether a path is the tif master of an mvol page
+    """
+    return path.endswith(".tif") and basename(dirname(path)) == "TIFF"
+
+
+class Invalidator:
+    """
+    Pushes changes to masters into the caches in front of them
+    """
+    def __init__(self, conf, derivative_cache=None, techmd=None, existence=None,
+                 scans=None, ocr=None, warmup=None):
+        """
+        __Args__
+        1) conf (dict): The configuration, supplying the storage roots
+
+        __KWArgs__
+        * derivative_cache (cache.DerivativeCache)
+        * techmd (techmd.TechmdIndex)
+        * existence (existence.ExistenceCache)
+        * scans (listing.DirectoryScanCache)
+        * ocr (ocr.OcrIndex)
+        * warmup (WarmupQueue): Builds the derivatives of changed pages
+            Any of which may be omitted.
+        """
+        self.conf = conf
+        self.derivative_cache = derivative_cache
+        self.techmd = techmd
+        self.existence = existence
+        self.scans = scans
+        self.ocr = ocr
+        self.warmup = warmup
+        self.counts = {CHANGED: 0, REMOVED: 0, RESCAN: 0}
+
+    def __call__(self, kind, path):
+        self.counts[kind] += 1
+        if kind == RESCAN:
+            # Entries in the shared caches are validated against their
+            # master's signature, so only what isn't has to be dropped
+            if self.existence is not None:
+                self.existence.invalidate()
+            if self.scans is not None:
+                self.scans.invalidate()
+            return
+        log.debug("{} {}".format(path, kind))
+        if self.scans is not None:
+            self.scans.invalidate(dirname(path))
+            if kind == REMOVED:
+                self.scans.invalidate(path)
+        if self.techmd is not None:
+            self.techmd.invalidate(path)
+        for identifier in identifiers_for(self.conf, path):
+            if self.existence is not None:
+                self.existence.invalidate(identifier)
+            if self.derivative_cache is not None:
+                self.derivative_cache.invalidate(identifier)
+            if self.ocr is not None and path.endswith(".xml"):
+                self.ocr.invalidate(identifier)
+            if self.warmup is not None and kind == CHANGED and is_page_master(path):
+                self.warmup.submit(identifier)
+
+    def stats(self):
+        return dict(self.counts)
+
+
+_CLAIMS = {}
+
+_CLAIMS_LOCK = threading.Lock()
+
+
+def warmup_lock_path(conf):
+    """
+    Return the path of the lock file shared by the processes which may
+    warm up derivatives under a configuration
+    """
+    return join(conf.get("DERIVATIVE_ROOT") or conf["MVOL_ROOT"], WARMUP_LOCK)
+
+
+def claim_warmup(path):
+    """
+    Elect this process to warm up derivatives, unless another process
+    holds the lock file at path. An elected process holds it until it exits.
+
+    __Args__
+    1) path (str): The lock file, see warmup_lock_path()
+
+    __Return Values__
+    * (bool) Whether this process was elected
+    """
+    if fcntl is None:
+        log.warning("fcntl unavailable, every watching process will warm up derivatives")
+        return True
+    # Locks held by a parent aren't the child's to use after a fork
+    key = (os.getpid(), path)
+    with _CLAIMS_LOCK:
+        if key in _CLAIMS:
+            return True
+        os.makedirs(dirname(path), exist_ok=True)
+        f = open(path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            log.debug("Another process is warming up derivatives")
+            return False
+        _CLAIMS[key] = f
+        return True
+
+
+class WarmupQueue:
+    """
+    Builds the standard derivatives (see derivatives.py) of pages, and
+    records their technical metadata, in a background thread.
+
+    Jobs wait delay seconds before running, and a page submitted again in
+    the meantime waits afresh, so a master which is still being written
+    is built once, after it settles.
+    """
+    def __init__(self, conf, delay=DEFAULT_WARMUP_DELAY, quality=90, techmd=None):
+        """
+        __Args__
+        1) conf (dict): The configuration, supplying MVOL_ROOT and
+            DERIVATIVE_ROOT
+
+        __KWArgs__
+        * delay (float): Seconds to wait before building a page
+        * quality (int): The jpg quality of the derivatives
+        * techmd (techmd.TechmdIndex): An index to record the masters in
+        """
+        self.conf = conf
+        self.delay = delay
+        self.quality = quality
+        self.techmd = techmd
+        self.built = 0
+        self.failed = 0
+        self._active = 0
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def submit(self, identifier):
+        with self._cond:
+            self._pending[identifier] = time.monotonic() + self.delay
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="digcollretriever-warmup",
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while not self._stopped:
+                if self._pending:
+                    identifier, due = min(self._pending.items(), key=lambda x: x[1])
+                    wait = due - time.monotonic()
+                    if wait <= 0:
+                        del self._pending[identifier]
+                        self._active += 1
+                        return identifier
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+            return None
+
+    def _run(self):
+        while True:
+            identifier = self._next()
+            if identifier is None:
+                return
+            try:
+                self.run(identifier)
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+
+    def run(self, identifier):
+        """
+        Build the derivatives of a page now
+
+        __Return Values__
+        * (list[str]) The names of the sizes which were built
+        """
+        # Imported here, as derivatives imports this package's siblings
+        from .derivatives import build_page_derivatives
+        try:
+            built = build_page_derivatives(self.conf, identifier, quality=self.quality)
+            if self.techmd is not None:
+                self.techmd.get(MvolLayer4StorageInterface(self.conf).get_tif(identifier))
+        except Exception as e:
+            log.warning("Failed to warm up {}: {}".format(identifier, e))
+            self.failed += 1
+            return []
+        self.built += 1
+        return built
+
+    def join(self, timeout=None):
+        """
+        Wait up to timeout seconds for every submitted page to be built
+
+        __Return Values__
+        * (bool) Whether every page was
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._active, timeout)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {"pending": pending, "active": self._active, "built": self.built,
+                "failed": self.failed}
+
+
+class Watcher:
+    """
+    Feeds the changes reported by an InotifyWatcher or PollingWatcher to
+    a handler, eg an Invalidator, in a background thread
+    """
+    def __init__(self, source, handler):
+        self.source = source
+        self.handler = handler
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="digcollretriever-watch", daemon=True)
+
+    def start(self):
+        log.info("Watching {} with {}".format(", ".join(self.source.roots), self.source.backend))
+        self._thread.start()
+        return self
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                events = self.source.poll(1)
+            except Exception as e:
+                log.warning("Watching failed: {}".format(e))
+                self._stopped.wait(1)
+                continue
+            for kind, path in events:
+                try:
+                    self.handler(kind, path)
+                except Exception as e:
+                    log.warning("Handling {} of {} failed: {}".format(kind, path, e))
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self.source.close()
+
+    def stats(self):
+        stats = self.source.stats()
+        if hasattr(self.handler, "stats"):
+            stats["events"] = self.handler.stats()
+        warmup = getattr(self.handler, "warmup", None)
+        if warmup is not None:
+            stats["warmup"] = warmup.stats()
+        return stats
+
+
+def main():
+    from .cache import DerivativeCache
+    from .techmd import get_index
+    from . import ocr
+
+    parser = make_parser("Invalidate caches as masters change, and build the derivatives of new pages")
+    add_mvol_args(parser, derivative_root="Write derivatives here, rather than beside the masters")
+    parser.add_argument("--flat-tif-dir-root", default=os.environ.get("DIGCOLLRETRIEVER_FLAT_TIF_DIR_ROOT"))
+    parser.add_argument("--flat-jpg-dir-root", default=os.environ.get("DIGCOLLRETRIEVER_FLAT_JPG_DIR_ROOT"))
+    parser.add_argument("--derivative-cache-dir",
+                        default=os.environ.get("DIGCOLLRETRIEVER_DERIVATIVE_CACHE_DIR"))
+    parser.add_argument("--techmd-index", default=os.environ.get("DIGCOLLRETRIEVER_TECHMD_INDEX"))
+    parser.add_argument("--ocr-index", default=os.environ.get("DIGCOLLRETRIEVER_OCR_INDEX"))
+    parser.add_argument("--backend", choices=("inotify", "poll"), default=None)
+    parser.add_argument("--interval", type=float, default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--warmup", action="store_true",
+                        help="Build the standard derivatives of new and changed pages")
+    parser.add_argument("--warmup-delay", type=float, default=DEFAULT_WARMUP_DELAY)
+    parser.add_argument("--quality", type=int, default=90)
+    args = parser.parse_args()
+    roots = [x for x in (args.mvol_root and join(args.mvol_root, "mvol"),
+                         args.flat_tif_dir_root, args.flat_jpg_dir_root) if x]
+    if not roots:
+        parser.error("At least one of --mvol-root, --flat-tif-dir-root or --flat-jpg-dir-root is required")
+    logging.basicConfig(level=args.verbosity)
+    conf = {"MVOL_ROOT": args.mvol_root, "DERIVATIVE_ROOT": args.derivative_root,
+            "FLAT_TIF_DIR_ROOT": args.flat_tif_dir_root, "FLAT_JPG_DIR_ROOT": args.flat_jpg_dir_root,
+            "TECHMD_INDEX": args.techmd_index}
+    cache = None
+    if args.derivative_cache_dir:
+        # Only ever removes entries, so the byte budget is irrelevant
+        cache = DerivativeCache(args.derivative_cache_dir, float("inf"))
+    techmd = get_index(args.techmd_index) if args.techmd_index else None
+    warmup = None
+    if args.warmup and args.mvol_root:
+        if claim_warmup(warmup_lock_path(conf)):
+            warmup = WarmupQueue(conf, args.warmup_delay, args.quality, techmd)
+        else:
+            log.warning("Another process holds {}, not warming up derivatives".format(
+                warmup_lock_path(conf)))
+    handler = Invalidator(conf, derivative_cache=cache, techmd=techmd,
+                          ocr=ocr.get_index(args.ocr_index) if args.ocr_index else None,
+                          warmup=warmup)
+    source = open_watcher(roots, args.backend, args.interval, args.batch_size)
+    watcher = Watcher(source, handler).start()
+    try:
+        while True:
+            time.sleep(60)
+            log.info("Watch stats: {}".format(watcher.stats()))
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,7 @@ setup(
     author_email="balsamo@uchicago.edu",
     packages=find_packages(
         exclude=[
+            "benchmarks"
         ]
     ),
     include_package_data=True,
@@ -25,8 +26,21 @@ setup(
         'flask_env',
         'flask_restful',
         'jsonschema',
-        'pillow'
+        'pillow>=7.0'
     ],
+    entry_points={
+        'console_scripts': [
+            'digcollretriever-build-derivatives = digcollretriever.blueprint.lib.derivatives:main',
+            'digcollretriever-index-techmd = digcollretriever.blueprint.lib.techmd:main',
+            'digcollretriever-index-ocr = digcollretriever.blueprint.lib.ocr:main',
+            'digcollretriever-build-pyramids = digcollretriever.blueprint.lib.pyramid:main',
+            'digcollretriever-linearize-pdfs = digcollretriever.blueprint.lib.pdf:main',
+            'digcollretriever-watch = digcollretriever.blueprint.lib.watch:main'
+        ]
+    },
+    extras_require={
+        'pdf': ['pymupdf', 'pypdf']
+    },
     tests_require=[
         'pytest'
     ],
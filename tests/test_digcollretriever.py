@@ -1,10 +1,20 @@
+import asyncio
 import unittest
 import json
-from os import environ, getcwd
-from os.path import join
-from urllib.parse import quote
+import time
+import threading
+from io import BytesIO
+import re
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ, getcwd, listdir, mkdir, makedirs, remove, stat, utime
+from os.path import join, isfile, dirname
+from shutil import copyfile
+from tempfile import TemporaryDirectory
+from urllib.parse import quote, unquote
 
 import jsonschema
+from PIL import Image, ImageChops, ImageStat
 
 # Defer any configuration to the tests setUp()
 environ['DIGCOLLRETRIEVER_DEFER_CONFIG'] = "True"
@@ -12,6 +22,96 @@ environ['DIGCOLLRETRIEVER_DEFER_CONFIG'] = "True"
 import digcollretriever
 from digcollretriever.blueprint.lib.schemas import \
     techmd_schema, stat_schema, root_schema
+from digcollretriever.blueprint.lib.cache import DerivativeCache
+from digcollretriever.blueprint.lib import determine_identifier_type, reduced_decode, \
+    thumbnail_transform, general_transform, resize_region, resize, resample_policy, decode_size, \
+    is_tiled
+from digcollretriever.blueprint.lib.registry import IdentifierRegistry
+from digcollretriever.blueprint.lib.derivatives import build_derivatives
+from digcollretriever.blueprint.lib.pyramid import write_pyramid, build_pyramids
+from digcollretriever.blueprint.lib.techmd import TechmdIndex, index_tree
+from digcollretriever.blueprint.lib.storageinterfaces import StorageInterface, \
+    MvolLayer1StorageInterface, MvolLayer2StorageInterface, MvolLayer3StorageInterface, \
+    MvolLayer4StorageInterface
+from digcollretriever.blueprint.lib.executor import TransformExecutor
+from digcollretriever.blueprint.lib.coalesce import SingleFlight
+from digcollretriever.blueprint.lib.budget import PixelBudget
+from digcollretriever.blueprint.lib import pdf
+from digcollretriever.blueprint.lib.ocr import parse_alto
+from digcollretriever.blueprint.lib.remote import RemoteStore
+from digcollretriever.blueprint.lib.listing import DirectoryScanCache
+from digcollretriever.blueprint.lib.batch import multipart_stream
+from digcollretriever.blueprint.lib.tools import write_atomically
+from digcollretriever.blueprint.lib.existence import ExistenceCache
+from digcollretriever.blueprint.lib import watch
+from digcollretriever.asgi import ASGIApplication
+from digcollretriever.blueprint.exceptions import UnknownIdentifierFormatError, \
+    ServiceUnavailableError, TransformTimeoutError, ImageTooLargeError, SourceNotFoundError, \
+    Omitted
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    A stand in for an object store, serving the files of a directory
+    with byte ranges and the validators (ETag, Last-Modified) it is set
+    to send, and recording the requests it receives
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self, head=False):
+        self.server.requests.append((self.command, self.headers.get("Range")))
+        path = join(self.server.root, unquote(self.path.lstrip("/")))
+        if not isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with open(path, "rb") as f:
+            body = f.read()
+        st = stat(path)
+        etag = '"{}-{}"'.format(st.st_mtime_ns, st.st_size)
+        status = 200
+        match = re.match(r"bytes=(\d+)-(\d+)$", self.headers.get("Range") or "")
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(body) - 1)
+            status = 206
+        self.send_response(status)
+        if "ETag" in self.server.validators:
+            self.send_header("ETag", etag)
+        if "Last-Modified" in self.server.validators:
+            self.send_header("Last-Modified", formatdate(st.st_mtime, usegmt=True))
+        if match:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(body)))
+            body = body[start:end + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+def range_server(root, validators=("ETag", "Last-Modified")):
+    """
+    Serve a directory, returning the server and the base URL of its
+    "bucket" subdirectory
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.root, server.requests, server.connections = root, [], 0
+    server.validators = validators
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/bucket".format(server.server_address[1])
 
 
 class Tests(unittest.TestCase):
@@ -97,6 +197,1188 @@ class Tests(unittest.TestCase):
             self.app.get("/{}/pdf".format(quote("mvol-0001-0002-0003")))
         )
 
+    def testGetJpgResized(self):
+        rv = self.response_200(
+            self.app.get("/{}/jpg?width=320&height=200".format(quote("mvol-0001-0002-0003_0001")))
+        )
+        self.assertEqual(Image.open(BytesIO(rv.data)).size, (320, 200))
+
+    def testDerivativeCache(self):
+        with TemporaryDirectory() as tmp:
+            digcollretriever.blueprint.BLUEPRINT.config['DERIVATIVE_CACHE_DIR'] = tmp
+            url = "/{}/jpg/thumb?width=100&height=100".format(quote("mvol-0001-0002-0003_0001"))
+            first = self.response_200(self.app.get(url)).data
+            cache = digcollretriever.blueprint.derivative_cache()
+            self.assertEqual(cache.stats()['misses'], 1)
+            second = self.response_200(self.app.get(url)).data
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(first, second)
+            # Hits are sent from an open file, which supports ranges too
+            rv = self.app.get(url, headers={"Range": "bytes=0-9"})
+            self.assertEqual((rv.status_code, rv.data), (206, first[:10]))
+            self.assertEqual(rv.headers['Content-Range'], "bytes 0-9/{}".format(len(first)))
+
+    def testDerivativeCacheEviction(self):
+        with TemporaryDirectory() as tmp:
+            cache = DerivativeCache(tmp, 10)
+            cache.put("aa01", b"123456")
+            cache.put("aa02", b"123456")
+            self.assertIsNone(cache.get("aa01"))
+            with cache.get("aa02") as f:
+                # Hits remain readable if they're evicted, eg by another process
+                cache.put("aa03", b"654321")
+                self.assertIsNone(cache.get("aa02"))
+                self.assertEqual(f.read(), b"123456")
+            self.assertEqual([x for x in listdir(tmp) if not x.startswith(".")], ["aa"])
+
+    def testDerivativeCacheInvalidate(self):
+        with TemporaryDirectory() as tmp:
+            cache = DerivativeCache(tmp, 1024)
+            keys = [DerivativeCache.make_key(ident, {'width': w}, "jpg", (1, 2))
+                    for ident in ("flattifdir-a", "flattifdir-b") for w in (10, 20)]
+            for key in keys:
+                cache.put(key, b"123456")
+            self.assertEqual(cache.invalidate("flattifdir-a"), 2)
+            hits = [cache.get(x) for x in keys]
+            self.assertEqual([x is not None for x in hits], [False, False, True, True])
+            for x in hits[2:]:
+                x.close()
+            self.assertEqual(cache.stats()['bytes'], 12)
+            self.assertEqual(cache.invalidate("flattifdir-c"), 0)
+
+    def testDetermineIdentifierType(self):
+        self.assertIs(determine_identifier_type("mvol-0001-0002-0003"), MvolLayer3StorageInterface)
+        self.assertIs(determine_identifier_type("mvol-0001-0002-0003_0001"), MvolLayer4StorageInterface)
+        self.assertRaises(UnknownIdentifierFormatError, determine_identifier_type, "nope")
+        self.assertRaises(UnknownIdentifierFormatError, determine_identifier_type,
+                          "mvol-0001-0002-0003", omits=[MvolLayer3StorageInterface])
+
+    def testUnknownIdentifier(self):
+        rv = self.app.get("/{}/stat".format(quote("not-an-identifier")))
+        self.assertEqual(rv.status_code, 500)
+        self.assertEqual(json.loads(rv.data.decode())['error_name'], "UnknownIdentifierFormatError")
+
+    def testRegistryRegister(self):
+        class Custom(StorageInterface):
+            @classmethod
+            def claim_identifier(cls, identifier):
+                return identifier == "custom"
+
+        registry = IdentifierRegistry([MvolLayer3StorageInterface], cache_size=1)
+        self.assertIsNone(registry.resolve("custom"))
+        registry.register(Custom)
+        self.assertIs(registry.resolve("custom"), Custom)
+        self.assertIs(registry.resolve("mvol-0001-0002-0003"), MvolLayer3StorageInterface)
+
+    def testRegistryPatternFlagsAndGroups(self):
+        class Insensitive(StorageInterface):
+            identifier_pattern = re.compile("^upper-[a-z]+$", re.I)
+
+        class Grouped(StorageInterface):
+            identifier_pattern = re.compile("^(?P<kind>grouped)-([0-9]+)$")
+
+        registry = IdentifierRegistry([MvolLayer3StorageInterface, Insensitive, Grouped,
+                                       MvolLayer4StorageInterface])
+        self.assertIs(registry.resolve("UPPER-ABC"), Insensitive)
+        self.assertIs(registry.resolve("grouped-1"), Grouped)
+        self.assertIs(registry.resolve("mvol-0001-0002-0003"), MvolLayer3StorageInterface)
+        self.assertIs(registry.resolve("mvol-0001-0002-0003_0001"), MvolLayer4StorageInterface)
+        self.assertIsNone(registry.resolve("grouped-x"))
+
+    def testReducedDecodeJpg(self):
+        master = Image.new("RGB", (1600, 1200), "red")
+        data = BytesIO()
+        master.save(data, "JPEG")
+        args = {'width': 100, 'height': 100, 'scale': None}
+        thumb = thumbnail_transform(Image.open(BytesIO(data.getvalue())), args)
+        self.assertEqual(thumb.size, (100, 75))
+        drafted = reduced_decode(Image.open(BytesIO(data.getvalue())), (100, 75))
+        self.assertEqual(drafted.size, (200, 150))
+
+    def testReducedDecodeTifSubfile(self):
+        master = Image.new("RGB", (800, 600), "red")
+        data = BytesIO()
+        master.save(data, "TIFF", save_all=True, tiffinfo={254: 1},
+                    append_images=[master.resize((400, 300)), master.resize((200, 150))])
+        drafted = reduced_decode(Image.open(BytesIO(data.getvalue())), (90, 60))
+        self.assertEqual(drafted.tell(), 2)
+        args = {'width': 90, 'height': 60, 'scale': None, 'cropstartx': None,
+                'cropstarty': None, 'cropendx': None, 'cropendy': None}
+        self.assertEqual(general_transform(Image.open(BytesIO(data.getvalue())), args).size, (90, 60))
+
+    def testPrebuiltDerivatives(self):
+        config = digcollretriever.blueprint.BLUEPRINT.config
+        ident = "mvol-0001-0002-0003_0001"
+        with TemporaryDirectory() as tmp:
+            config['DERIVATIVE_ROOT'] = tmp
+            counts = build_derivatives(config, workers=1)
+            self.assertEqual(counts, {"built": 1, "skipped": 0, "failed": 0})
+            counts = build_derivatives(config, workers=1)
+            self.assertEqual(counts, {"built": 0, "skipped": 1, "failed": 0})
+            storage = MvolLayer4StorageInterface(config)
+            self.assertEqual(len(storage.get_jpg_derivatives(ident)), 3)
+            with self.assertLogs("digcollretriever.blueprint.lib", "INFO") as logs:
+                rv = self.response_200(self.app.get("/{}/jpg/thumb?width=150&height=150".format(quote(ident))))
+            self.assertTrue(any("DERIVATIVES/thumb" in x for x in logs.output))
+            self.assertEqual(Image.open(BytesIO(rv.data)).size, (150, 100))
+            rv = self.response_200(self.app.get("/{}/jpg?width=300".format(quote(ident))))
+            self.assertEqual(Image.open(BytesIO(rv.data)).size, (300, 427))
+            # As though the master were replaced after the derivatives were built
+            master_mtime = stat(storage.get_tif(ident)).st_mtime_ns
+            thumb = storage.derivative_path(ident, "thumb")
+            utime(thumb, ns=(master_mtime - 10 ** 9, master_mtime - 10 ** 9))
+            self.assertEqual(len(storage.get_jpg_derivatives(ident)), 2)
+            self.assertNotIn(thumb, storage.get_jpg_derivatives(ident))
+            for name, _ in storage.DERIVATIVE_SIZES:
+                path = storage.derivative_path(ident, name)
+                utime(path, ns=(master_mtime - 10 ** 9, master_mtime - 10 ** 9))
+            self.assertRaises(Omitted, storage.get_jpg_derivatives, ident)
+            with self.assertLogs("digcollretriever.blueprint", "DEBUG") as logs:
+                self.response_200(self.app.get("/{}/jpg/thumb?width=150&height=150".format(quote(ident))))
+            self.assertFalse(any("DERIVATIVES" in x for x in logs.output))
+
+    def testGetTifPassthrough(self):
+        url = "/{}/tif".format(quote("mvol-0001-0002-0003_0001"))
+        rv = self.response_200(self.app.get(url))
+        with open(join(digcollretriever.blueprint.BLUEPRINT.config['MVOL_ROOT'], "mvol", "0001",
+                       "0002", "0003", "TIFF", "mvol-0001-0002-0003_0001.tif"), "rb") as f:
+            native = f.read()
+        self.assertEqual(rv.data, native)
+        self.assertEqual(int(rv.headers['Content-Length']), len(native))
+        self.assertIsNotNone(rv.headers.get('ETag'))
+        self.assertIsNotNone(rv.headers.get('Last-Modified'))
+        rv = self.app.get(url, headers={"Range": "bytes=0-99"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, native[:100])
+
+    def testGetPDFRange(self):
+        rv = self.app.get("/{}/pdf".format(quote("mvol-0001-0002-0003")), headers={"Range": "bytes=0-3"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, b"%PDF")
+
+    def testConditionalGet(self):
+        ident = quote("mvol-0001-0002-0003_0001")
+        for url in ("/{}/jpg?width=100&height=100", "/{}/tif", "/{}/tif/technical_metadata",
+                    "/{}/ocr/limb", "/{}/stat"):
+            url = url.format(ident)
+            rv = self.response_200(self.app.get(url))
+            etag = rv.headers['ETag']
+            self.assertIn("max-age", rv.headers['Cache-Control'])
+            rv = self.app.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(rv.status_code, 304, url)
+            self.assertEqual(rv.headers['ETag'], etag)
+            # As weakened by a proxy
+            rv = self.app.get(url, headers={"If-None-Match": "W/" + etag})
+            self.assertEqual(rv.status_code, 304, url)
+        rv = self.response_200(self.app.get("/{}/jpg?width=100&height=100".format(ident)))
+        rv = self.app.get("/{}/jpg?width=100&height=100".format(ident),
+                          headers={"If-Modified-Since": rv.headers['Last-Modified']})
+        self.assertEqual(rv.status_code, 304)
+        rv = self.app.get("/{}/jpg?width=101&height=100".format(ident),
+                          headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 200)
+
+    def testTechmdIndex(self):
+        with TemporaryDirectory() as tmp:
+            master = join(tmp, "master.tif")
+            Image.new("RGB", (30, 20)).save(master)
+            index = TechmdIndex(join(tmp, "techmd.sqlite3"))
+            self.assertEqual(index_tree(index, tmp), {"indexed": 1, "current": 0, "failed": 0})
+            record = index.get(master)
+            self.assertEqual((record['width'], record['height'], record['mode']), (30, 20, "RGB"))
+            self.assertEqual(index.stats()['hits'], 1)
+            Image.new("L", (40, 10)).save(master)
+            record = index.get(master)
+            self.assertEqual((record['width'], record['height'], record['mode']), (40, 10, "L"))
+            # Persistent
+            self.assertEqual(TechmdIndex(join(tmp, "techmd.sqlite3")).lookup(master)['width'], 40)
+
+    def testGetTifTechnicalMetadataIndexed(self):
+        with TemporaryDirectory() as tmp:
+            digcollretriever.blueprint.BLUEPRINT.config['TECHMD_INDEX'] = join(tmp, "techmd.sqlite3")
+            url = "/{}/tif/technical_metadata".format(quote("mvol-0001-0002-0003_0001"))
+            rj = self.response_200_json(self.app.get(url))
+            self.assertEqual((rj['width'], rj['height']), (640, 427))
+            index = TechmdIndex(join(tmp, "techmd.sqlite3"))
+            self.assertEqual(index.stats()['entries'], 1)
+
+    def testBatchJpg(self):
+        rv = self.app.post("/batch/jpg", json={
+            "identifiers": ["mvol-0001-0002-0003_0001", "mvol-0001-0002-0003_0002", "nope"],
+            "thumbnail": True, "width": 50, "height": 50
+        })
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.headers['Content-Type'].startswith("multipart/mixed"))
+        boundary = rv.headers['Content-Type'].split("boundary=")[1]
+        parts = rv.data.split(("--" + boundary).encode())[1:-1]
+        self.assertEqual(len(parts), 3)
+        statuses = {}
+        for part in parts:
+            head, body = part.split(b"\r\n\r\n", 1)
+            head = dict(x.split(": ", 1) for x in head.decode().strip().split("\r\n"))
+            statuses[head['Content-ID']] = head['X-Status']
+            if head['X-Status'] == "200":
+                self.assertEqual(Image.open(BytesIO(body[:-2])).size, (50, 33))
+        self.assertEqual(statuses, {"<mvol-0001-0002-0003_0001>": "200",
+                                    "<mvol-0001-0002-0003_0002>": "404",
+                                    "<nope>": "500"})
+
+    def testWriteAtomically(self):
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, "a", "out")
+
+            def fail(out):
+                open(out, "w").write("partial")
+                raise ValueError()
+
+            self.assertRaises(ValueError, write_atomically, fail, path)
+            self.assertEqual(listdir(join(tmp, "a")), [])
+            write_atomically(lambda out: open(out, "w").write("whole"), path)
+            self.assertEqual(listdir(join(tmp, "a")), ["out"])
+
+    def testBatchJpgHeaderInjection(self):
+        boundary, body = multipart_stream(
+            [("nope\r\n--b--\r\nX-Injected: 1", 500, "application/json", b"{}")], "image/jpg", "b")
+        body = b"".join(body)
+        # Only the opening and closing delimiters begin lines
+        self.assertEqual([x for x in body.split(b"\r\n") if x.startswith(b"--b")], [b"--b", b"--b--"])
+        self.assertNotIn(b"\r\nX-Injected", body)
+        self.assertIn(b"Content-ID: <nope%0D%0A--b--%0D%0AX-Injected:%201>", body)
+
+    def testPartialCrop(self):
+        url = "/{}/jpg".format(quote("mvol-0001-0002-0003_0001"))
+        for query in ("cropstartx=5", "cropstartx=0&cropstarty=0&cropendx=10"):
+            rv = self.app.get(url + "?" + query)
+            self.assertEqual(rv.status_code, 400, query)
+            self.assertEqual(json.loads(rv.data.decode())['error_name'], "MissingParametersError")
+        rv = self.response_200(self.app.get(url + "?cropstartx=0&cropstarty=0&cropendx=10&cropendy=20"))
+        self.assertEqual(Image.open(BytesIO(rv.data)).size, (10, 20))
+        for query in ("cropstartx=50&cropstarty=50&cropendx=10&cropendy=10",
+                      "cropstartx=0&cropstarty=0&cropendx=10&cropendy=0"):
+            for base in (url, url[:-len("jpg")] + "tif"):
+                rv = self.app.get(base + "?" + query)
+                self.assertEqual(rv.status_code, 400, query)
+                self.assertEqual(json.loads(rv.data.decode())['error_name'], "InvalidCropError")
+
+    def testBatchJpgThumbnailRequiresDimensions(self):
+        rv = self.app.post("/batch/jpg", json={"identifiers": ["mvol-0001-0002-0003_0001"],
+                                               "thumbnail": True})
+        self.assertEqual(rv.status_code, 400)
+
+    def testTransformExecutor(self):
+        digcollretriever.blueprint.BLUEPRINT.config['TRANSFORM_WORKERS'] = 1
+        rv = self.response_200(
+            self.app.get("/{}/jpg?width=64&height=64".format(quote("mvol-0001-0002-0003_0001")))
+        )
+        self.assertEqual(Image.open(BytesIO(rv.data)).size, (64, 64))
+        self.assertEqual(digcollretriever.blueprint.transform_executor().stats()['submitted'], 1)
+
+    def testTransformExecutorBackpressure(self):
+        executor = TransformExecutor(1, 0, timeout=0.1)
+        try:
+            self.assertRaises(TransformTimeoutError, executor.run, time.sleep, 1)
+            # The timed out job still occupies the only slot
+            self.assertRaises(ServiceUnavailableError, executor.run, time.sleep, 0)
+        finally:
+            executor.shutdown()
+
+    def testSingleFlight(self):
+        with TemporaryDirectory() as tmp:
+            flight = SingleFlight(tmp)
+            calls = []
+            started = threading.Event()
+
+            def slow():
+                started.set()
+                time.sleep(.2)
+                calls.append(1)
+                return b"result"
+
+            results = []
+            leader = threading.Thread(target=lambda: results.append(flight.do("key", slow)))
+            leader.start()
+            started.wait()
+            followers = [threading.Thread(target=lambda: results.append(flight.do("key", slow)))
+                         for _ in range(3)]
+            for x in followers:
+                x.start()
+            for x in [leader] + followers:
+                x.join()
+            self.assertEqual(results, [b"result"] * 4)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(flight.stats(), {"leaders": 1, "coalesced": 3, "in_flight": 0})
+            # Leaders in other processes (here, instances) wait on the
+            # lock file, which is removed once the last is done
+            active, overlaps = [], []
+
+            def exclusive():
+                active.append(1)
+                overlaps.append(len(active) > 1)
+                time.sleep(.05)
+                active.pop()
+                return b"result"
+
+            threads = [threading.Thread(target=lambda x=x: x.do("key", exclusive))
+                       for x in [flight] + [SingleFlight(tmp) for _ in range(3)]]
+            for x in threads:
+                x.start()
+            for x in threads:
+                x.join()
+            self.assertEqual(overlaps, [False] * 4)
+            self.assertEqual(listdir(tmp), [])
+
+    def testGetStats(self):
+        rj = self.response_200_json(self.app.get("/stats"))
+        self.assertIn("coalescing", rj)
+
+    def testIIIFInfo(self):
+        rv = self.response_200(self.app.get("/iiif/{}/info.json".format(quote("mvol-0001-0002-0003_0001"))))
+        rj = json.loads(rv.data.decode())
+        self.assertEqual((rj['width'], rj['height']), (640, 427))
+        self.assertEqual(rj['tiles'], [{"width": 512, "height": 512, "scaleFactors": [1, 2]}])
+        self.assertTrue(rj['id'].endswith("/iiif/mvol-0001-0002-0003_0001"))
+        self.assertEqual(rv.headers['Access-Control-Allow-Origin'], "*")
+
+    def testIIIFImage(self):
+        base = "/iiif/{}/".format(quote("mvol-0001-0002-0003_0001"))
+        for path, size, mode in (("full/max/0/default.jpg", (640, 427), "RGB"),
+                                 ("0,0,512,427/256,/0/default.jpg", (256, 214), "RGB"),
+                                 ("square/!100,100/90/gray.png", (100, 100), "L"),
+                                 ("pct:0,0,50,50/,50/!0/bitonal.png", (75, 50), "1"),
+                                 ("full/^1280,/0/color.tif", (1280, 854), "RGB"),
+                                 ("full/!10000,10000/0/default.jpg", (640, 427), "RGB"),
+                                 ("full/^!1280,1280/0/default.jpg", (1280, 854), "RGB")):
+            rv = self.response_200(self.app.get(base + path))
+            image = Image.open(BytesIO(rv.data))
+            self.assertEqual((image.size, image.mode), (size, mode), path)
+        # 90 degree rotations swap dimensions
+        rv = self.response_200(self.app.get(base + "full/100,50/90/default.jpg"))
+        self.assertEqual(Image.open(BytesIO(rv.data)).size, (50, 100))
+        for path in ("full/1000,/0/default.jpg", "700,0,10,10/max/0/default.jpg",
+                     "full/max/0/sepia.jpg", "full/max/361/default.jpg"):
+            self.assertEqual(self.app.get(base + path).status_code, 400, path)
+
+    def testPyramidRegionDecode(self):
+        master = Image.effect_noise((1000, 700), 64).convert("RGB")
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, "pyramid.tif")
+            write_pyramid(master, path, tile_size=256)
+            pyramid = Image.open(path)
+            self.assertEqual(pyramid.n_frames, 3)
+            self.assertEqual(len(pyramid.tile), 12)
+            self.assertEqual(pyramid.tobytes(), master.tobytes())
+            with self.assertLogs("digcollretriever.blueprint.lib", "DEBUG") as logs:
+                region = resize_region(Image.open(path), (300, 200, 700, 500), (400, 300))
+            self.assertIn("Decoding 4 of 12 tiles", "\n".join(logs.output))
+            # Tile layouts other than Pillow's current one are decoded whole
+            with Image.open(path) as pyramid:
+                self.assertTrue(is_tiled(pyramid))
+                pyramid.tile = [tuple(t) + (None,) for t in pyramid.tile]
+                self.assertFalse(is_tiled(pyramid))
+            self.assertEqual(region.tobytes(), master.crop((300, 200, 700, 500)).tobytes())
+            # Small output comes from a reduced resolution subfile
+            with Image.open(path) as pyramid:
+                self.assertEqual(resize_region(pyramid, (0, 0, 1000, 700), (100, 70)).size, (100, 70))
+                self.assertEqual(pyramid.tell(), 2)
+            args = {'width': 500, 'height': 350, 'scale': None, 'cropstartx': 10,
+                    'cropstarty': 10, 'cropendx': 110, 'cropendy': 60}
+            self.assertEqual(general_transform(Image.open(path), dict(args)).size, (100, 50))
+            # Crops past the edge of the image are padded, as before
+            args.update({'cropendx': 600, 'cropendy': 400})
+            self.assertEqual(general_transform(Image.open(path), dict(args)).size, (590, 390))
+
+    def testIIIFPdfOnly(self):
+        # Issues have only a pdf, which IIIF doesn't serve
+        base = "/iiif/{}/".format(quote("mvol-0001-0002-0003"))
+        for path in ("info.json", "full/max/0/default.jpg"):
+            rv = self.app.get(base + path)
+            self.assertEqual(rv.status_code, 404, path)
+            self.assertEqual(json.loads(rv.data.decode())['error_name'], "UnsupportedContextError")
+
+    def testPrebuiltPyramids(self):
+        config = digcollretriever.blueprint.BLUEPRINT.config
+        ident = "mvol-0001-0002-0003_0001"
+        with TemporaryDirectory() as tmp:
+            config['DERIVATIVE_ROOT'] = tmp
+            self.assertEqual(build_pyramids(config, workers=1), {"built": 1, "skipped": 0, "failed": 0})
+            storage = MvolLayer4StorageInterface(config)
+            self.assertTrue(storage.get_tif_pyramid(ident).endswith("pyramid/{}.tif".format(ident)))
+            with self.assertLogs("digcollretriever.blueprint.lib", "INFO") as logs:
+                rv = self.response_200(self.app.get(
+                    "/iiif/{}/256,0,256,256/128,/0/default.png".format(quote(ident))))
+            self.assertTrue(any("pyramidal tif" in x for x in logs.output))
+            self.assertEqual(Image.open(BytesIO(rv.data)).size, (128, 128))
+            rv = self.response_200(self.app.get("/{}/tif?cropstartx=0&cropstarty=0&cropendx=64&cropendy=32".format(
+                quote(ident))))
+            with Image.open(storage.get_tif(ident)) as master:
+                self.assertEqual(Image.open(BytesIO(rv.data)).tobytes(),
+                                 master.crop((0, 0, 64, 32)).tobytes())
+
+    def testMetrics(self):
+        config = digcollretriever.blueprint.BLUEPRINT.config
+        config['METRICS_ENABLED'] = True
+        ident = quote("mvol-0001-0002-0003_0001")
+        self.response_200(self.app.get("/{}/jpg?width=100&height=80".format(ident)))
+        self.response_200(self.app.get("/{}/tif".format(ident)))
+        rv = self.response_200(self.app.get("/metrics"))
+        self.assertTrue(rv.headers['Content-Type'].startswith("text/plain; version=0.0.4"))
+        exposition = rv.data.decode()
+        labels = 'storage="MvolLayer4StorageInterface",format="tif"'
+        for stage in ("resolve", "open", "decode", "resize", "encode"):
+            self.assertIn('digcollretriever_stage_duration_seconds_count{{stage="{}",{}}}'.format(stage, labels),
+                          exposition)
+        self.assertIn('digcollretriever_fallbacks_total{{{},omitted="jpg"}}'.format(labels), exposition)
+        self.assertIn('digcollretriever_response_bytes_total{endpoint="digcollretriever.gettif"}', exposition)
+        self.assertIn('digcollretriever_requests_total{endpoint="digcollretriever.getjpg",status="200"}',
+                      exposition)
+
+    def testMetricsDisabled(self):
+        before = self.app.get("/metrics").data
+        self.response_200(self.app.get("/{}/jpg?width=90&height=60".format(quote("mvol-0001-0002-0003_0001"))))
+        self.assertEqual(self.app.get("/metrics").data, before)
+
+    def testStatReportsExistingFormats(self):
+        rj = self.response_200_json(self.app.get("/{}/stat".format(quote("mvol-0001-0002-0003_0001"))))
+        jsonschema.validate(rj, stat_schema)
+        self.assertEqual(rj['formats_available'], ["tif", "limb_ocr"])
+        self.assertIn("/mvol-0001-0002-0003_0001/tif/technical_metadata", rj['contexts_available'])
+        # The page doesn't exist, although its storage interface could provide it
+        rj = self.response_200_json(self.app.get("/{}/stat".format(quote("mvol-0001-0002-0003_0404"))))
+        self.assertEqual((rj['formats_available'], rj['contexts_available']), ([], []))
+
+    def testExistenceCache(self):
+        existence = digcollretriever.blueprint.existence_cache()
+        existence.invalidate()
+        url = "/{}/jpg?width=10&height=10".format(quote("mvol-0001-0002-0003_0404"))
+        rv = self.app.get(url)
+        self.assertEqual(rv.status_code, 404)
+        self.assertEqual(json.loads(rv.data.decode())['error_name'], "SourceNotFoundError")
+        self.assertEqual(self.app.get("/{}/ocr/limb".format(quote("mvol-0001-0002-0003_0404"))).status_code, 404)
+        hits = existence.stats()['hits']
+        self.assertEqual(self.app.get(url).status_code, 404)
+        # jpg (omitted), tif (missing) and pdf (omitted) are remembered
+        self.assertEqual(existence.stats()['hits'], hits + 3)
+
+    def asgi_get(self, application, path, headers=(), delay=0):
+        """
+        Make a GET request of an ASGI application, as a slow client
+        """
+        path, _, query = path.partition("?")
+        scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(),
+                 "headers": [(k.lower().encode(), v.encode()) for k, v in headers]}
+        requested = []
+        done = asyncio.Event()
+        response = {"body": b"", "chunks": 0}
+
+        async def receive():
+            if not requested:
+                requested.append(True)
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = dict((k.decode(), v.decode()) for k, v in message["headers"])
+            else:
+                response["body"] += message.get("body", b"")
+                response["chunks"] += 1
+                if not message.get("more_body"):
+                    done.set()
+                await asyncio.sleep(delay)
+
+        async def get():
+            await application(scope, receive, send)
+            return response
+        return get()
+
+    def testASGI(self):
+        application = ASGIApplication(digcollretriever.app, threads=2, io_threads=2, chunk_size=64 * 1024)
+        native = self.app.get("/{}/tif".format(quote("mvol-0001-0002-0003_0001"))).data
+
+        async def run():
+            tif = await self.asgi_get(application, "/{}/tif".format(quote("mvol-0001-0002-0003_0001")))
+            self.assertEqual(tif["status"], 200)
+            self.assertEqual(tif["body"], native)
+            self.assertGreater(tif["chunks"], 2)
+            ranged = await self.asgi_get(application, "/{}/tif".format(quote("mvol-0001-0002-0003_0001")),
+                                         headers=[("Range", "bytes=10-99")])
+            self.assertEqual((ranged["status"], ranged["body"]), (206, native[10:100]))
+            jpg = await self.asgi_get(application, "/{}/jpg?width=10&height=10".format(
+                quote("mvol-0001-0002-0003_0001")))
+            self.assertEqual(jpg["headers"]["content-type"], "image/jpg")
+            self.assertEqual(Image.open(BytesIO(jpg["body"])).size, (10, 10))
+            missing = await self.asgi_get(application, "/{}/stat".format(quote("nothing-like-an-identifier")))
+            self.assertEqual(missing["status"], 500)
+
+        asyncio.run(run())
+        application.shutdown()
+
+    def testASGIConcurrentSlowDownloads(self):
+        application = ASGIApplication(digcollretriever.app, threads=2, io_threads=2, chunk_size=64 * 1024)
+        native = self.app.get("/{}/tif".format(quote("mvol-0001-0002-0003_0001"))).data
+        url = "/{}/tif".format(quote("mvol-0001-0002-0003_0001"))
+
+        async def run():
+            # Far more concurrent downloads than threads, each slowly consuming its chunks
+            return await asyncio.gather(*(self.asgi_get(application, url, delay=.01) for _ in range(200)))
+
+        for response in asyncio.run(run()):
+            self.assertEqual((response["status"], response["body"]), (200, native))
+        application.shutdown()
+
+    def testASGILifespan(self):
+        application = ASGIApplication(digcollretriever.app)
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        asyncio.run(application({"type": "lifespan"}, receive, send))
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+    def testPdfRasterizerUnavailable(self):
+        digcollretriever.blueprint.BLUEPRINT.config['PDF_RASTERIZER'] = "not-a-rasterizer"
+        rv = self.app.get("/{}/jpg".format(quote("mvol-0001-0002-0003")))
+        self.assertEqual(rv.status_code, 501)
+        self.assertEqual(json.loads(rv.data.decode())['error_name'], "PDFRasterizerUnavailableError")
+
+    def testPdfPages(self):
+        renders = []
+
+        class FakeRasterizer:
+            name = "fake"
+
+            @staticmethod
+            def available():
+                return True
+
+            def page_info(self, path, page):
+                if not 1 <= page <= 3:
+                    raise digcollretriever.blueprint.exceptions.InvalidPageError()
+                return 3, (612, 792)
+
+            def render(self, path, page, dpi):
+                renders.append((page, dpi))
+                return Image.new("RGB", (612 * dpi // 72, 792 * dpi // 72), (page * 60, 0, 0))
+
+        pdf.RASTERIZERS["fake"] = FakeRasterizer
+        self.addCleanup(pdf.RASTERIZERS.pop, "fake")
+        self.assertEqual(pdf.choose_dpi((612, 792), (300, 388)), 72)
+        self.assertEqual(pdf.choose_dpi((612, 792), (1275, 1650)), 150)
+        with TemporaryDirectory() as tmp:
+            digcollretriever.blueprint.BLUEPRINT.config.update(
+                {"PDF_RASTERIZER": "fake", "DERIVATIVE_CACHE_DIR": tmp})
+            issue = quote("mvol-0001-0002-0003")
+            rv = self.response_200(self.app.get("/{}/jpg/thumb?width=100&height=100&page=2".format(issue)))
+            thumb = Image.open(BytesIO(rv.data))
+            # Fit to the page's native (150dpi) dimensions
+            self.assertEqual(thumb.size, (77, 100))
+            self.assertAlmostEqual(thumb.getpixel((38, 50))[0], 120, delta=3)
+            rv = self.response_200(self.app.get("/{}/jpg?width=300&height=388&page=2".format(issue)))
+            self.assertEqual(Image.open(BytesIO(rv.data)).size, (300, 388))
+            # Both were produced from a single rendering of the page
+            self.assertEqual(renders, [(2, 72)])
+            rv = self.response_200(self.app.get("/{}/tif".format(issue)))
+            tif = Image.open(BytesIO(rv.data))
+            self.assertEqual(tif.size, (1275, 1650))
+            self.assertAlmostEqual(tif.getpixel((0, 0))[0], 60, delta=3)
+            self.assertEqual(renders, [(2, 72), (1, 150)])
+            self.assertEqual(self.app.get("/{}/jpg?page=4".format(issue)).status_code, 400)
+            rj = self.response_200_json(self.app.get("/{}/stat".format(issue)))
+            self.assertIn("/{}/jpg".format(issue), rj['contexts_available'])
+
+    def testPdfPageSelection(self):
+        self.assertEqual(pdf.parse_pages("3-5,1", 5), [3, 4, 5, 1])
+        self.assertEqual(pdf.format_pages([1, 2, 3, 5, 7, 8]), "1-3,5,7-8")
+        for spec in ("0", "4-6", "2-1", "a"):
+            with self.assertRaises(digcollretriever.blueprint.exceptions.InvalidPageError):
+                pdf.parse_pages(spec, 5)
+        digcollretriever.blueprint.BLUEPRINT.config['PDF_WRITER'] = "not-a-writer"
+        url = "/{}/pdf".format(quote("mvol-0001-0002-0003"))
+        self.assertEqual(self.app.get(url + "?pages=1").status_code, 501)
+        # The whole pdf doesn't require a writer
+        self.response_200(self.app.get(url))
+
+    def testPdfExtractPages(self):
+        writes = []
+
+        class FakeWriter:
+            name = "fake"
+            can_linearize = True
+
+            @staticmethod
+            def available():
+                return True
+
+            def page_count(self, path):
+                return 5
+
+            def extract(self, path, pages, out, linearize=False):
+                writes.append(pdf.format_pages(pages))
+                with open(out, "wb") as f:
+                    f.write("%PDF-fake {} {}".format(pdf.format_pages(pages), linearize).encode())
+
+            def linearize(self, path, out):
+                writes.append("linearize")
+                with open(out, "wb") as f:
+                    f.write(b"%PDF-fake linearized")
+
+        pdf.WRITERS["fake"] = FakeWriter
+        self.addCleanup(pdf.WRITERS.pop, "fake")
+        url = "/{}/pdf".format(quote("mvol-0001-0002-0003"))
+        native = self.app.get(url).data
+        with TemporaryDirectory() as tmp:
+            digcollretriever.blueprint.BLUEPRINT.config.update(
+                {"PDF_WRITER": "fake", "DERIVATIVE_CACHE_DIR": join(tmp, "cache")})
+            rv = self.response_200(self.app.get(url + "?pages=2-3"))
+            self.assertEqual(rv.data, b"%PDF-fake 2-3 True")
+            self.assertIsNotNone(rv.headers.get("ETag"))
+            rv = self.app.get(url + "?pages=2,3", headers={"Range": "bytes=0-3"})
+            self.assertEqual((rv.status_code, rv.data), (206, b"%PDF"))
+            # Equivalent selections share a cached extraction
+            self.assertEqual(writes, ["2-3"])
+            self.assertEqual(self.app.get(url + "?pages=6").status_code, 400)
+
+            # Linearized on request, and cached, when configured to be
+            self.assertEqual(self.app.get(url).data, native)
+            digcollretriever.blueprint.BLUEPRINT.config['PDF_LINEARIZE'] = True
+            self.assertEqual(self.app.get(url).data, b"%PDF-fake linearized")
+            self.assertEqual(self.app.get(url).data, b"%PDF-fake linearized")
+            self.assertEqual(writes, ["2-3", "linearize"])
+
+            # Pre-built linearized copies are preferred
+            digcollretriever.blueprint.BLUEPRINT.config['DERIVATIVE_ROOT'] = join(tmp, "derivatives")
+            conf = dict(digcollretriever.blueprint.BLUEPRINT.config)
+            self.assertEqual(pdf.linearize_pdfs(conf, FakeWriter()),
+                             {"linearized": 1, "skipped": 0, "failed": 0})
+            self.assertEqual(pdf.linearize_pdfs(conf, FakeWriter()),
+                             {"linearized": 0, "skipped": 1, "failed": 0})
+            self.assertEqual(self.app.get(url).data, b"%PDF-fake linearized")
+            self.assertEqual(writes, ["2-3", "linearize", "linearize"])
+
+    def testPdfExtractPagesCoalesced(self):
+        started = threading.Event()
+
+        class SlowWriter:
+            name = "slow"
+            can_linearize = False
+
+            @staticmethod
+            def available():
+                return True
+
+            def page_count(self, path):
+                return 5
+
+            def extract(self, path, pages, out, linearize=False):
+                started.set()
+                time.sleep(0.3)
+                with open(out, "wb") as f:
+                    f.write(b"%PDF-slow " + pdf.format_pages(pages).encode())
+
+        pdf.WRITERS["slow"] = SlowWriter
+        self.addCleanup(pdf.WRITERS.pop, "slow")
+        # Without a derivative cache the extraction is held in memory, and
+        # shared by the concurrent requests for it
+        digcollretriever.blueprint.BLUEPRINT.config['PDF_WRITER'] = "slow"
+        url = "/{}/pdf?pages=2".format(quote("mvol-0001-0002-0003"))
+        results = []
+
+        def fetch():
+            rv = digcollretriever.app.test_client().get(url)
+            results.append((rv.status_code, rv.data))
+
+        threads = [threading.Thread(target=fetch) for _ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [(200, b"%PDF-slow 2")] * 3)
+
+    def testParseAlto(self):
+        alto = BytesIO(b"""<?xml version="1.0"?>
+<alto xmlns="http://www.loc.gov/standards/alto/ns-v2#"><Layout>
+<Page WIDTH="1000" HEIGHT="2000"><PrintSpace>
+<TextBlock><TextLine>
+<String HPOS="10" VPOS="20" WIDTH="30" HEIGHT="40" CONTENT="Hello"/><SP/>
+<String HPOS="50" VPOS="20" WIDTH="30" HEIGHT="40" CONTENT="won"/><HYP CONTENT="-"/>
+</TextLine><TextLine>
+<String HPOS="10.5" VPOS="70" WIDTH="30" HEIGHT="40" CONTENT="derful"/>
+</TextLine></TextBlock>
+<TextBlock><TextLine><String HPOS="10" VPOS="900" WIDTH="30" HEIGHT="40" CONTENT="World"/></TextLine></TextBlock>
+</PrintSpace></Page></Layout></alto>""")
+        page = parse_alto(alto)
+        self.assertEqual((page['width'], page['height']), (1000, 2000))
+        self.assertEqual(page['text'], "Hello won-\nderful\n\nWorld")
+        self.assertEqual(page['words'], ["Hello", "won", "derful", "World"])
+        self.assertEqual(page['boxes'][2], (10, 70, 30, 40))
+
+    def testOcrEndpoints(self):
+        digcollretriever.blueprint.BLUEPRINT.config['OCR_INDEX'] = ":memory:"
+        digcollretriever.blueprint.lib.ocr._INDEXES.pop(":memory:", None)
+        page = quote("mvol-0001-0002-0003_0001")
+        rv = self.response_200(self.app.get("/{}/ocr/text".format(page)))
+        self.assertTrue(rv.content_type.startswith("text/plain"))
+        self.assertIn("Emily Wiser", rv.data.decode())
+        index = digcollretriever.blueprint.ocr_index()
+        self.assertEqual(index.stats()['misses'], 1)
+        rv = self.app.get("/{}/ocr/text".format(page), headers={"If-None-Match": rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+        rj = self.response_200_json(self.app.get("/{}/ocr/words?region=600,600,400,100".format(page)))
+        self.assertEqual((rj['width'], rj['height']), (3400, 4400))
+        self.assertIn({"text": "Emily", "x": 659, "y": 636, "width": 111, "height": 43}, rj['words'])
+        self.assertNotIn("122", [x['text'] for x in rj['words']])
+        self.assertEqual(self.app.get("/{}/ocr/words?region=1,2".format(page)).status_code, 400)
+
+        issue = quote("mvol-0001-0002-0003")
+        hits = index.stats()['hits']
+        rj = self.response_200_json(self.app.get("/{}/ocr/search?q=wiser".format(issue)))
+        self.assertEqual([x['identifier'] for x in rj['hits']], ["mvol-0001-0002-0003_0001"])
+        self.assertEqual(rj['hits'][0]['words'], [{"text": "Wiser", "box": [786, 638, 113, 32]}])
+        rj = self.response_200_json(self.app.get("/{}/ocr/search?q=wiser+zzyzx".format(issue)))
+        self.assertEqual(rj['hits'], [])
+        # Answered from the index, the unchanged ALTO file is never reparsed
+        self.assertEqual(index.stats()['misses'], 1)
+        # And the issue's pages are only checked for changes once
+        self.assertEqual(index.stats()['hits'], hits + 1)
+        # Pages have no pages to search
+        rv = self.app.get("/{}/ocr/search?q=wiser".format(page))
+        self.assertEqual(rv.status_code, 404)
+        self.assertEqual(json.loads(rv.data.decode())['error_name'], "UnsupportedContextError")
+
+    def testPixelBudget(self):
+        budget = PixelBudget(100, timeout=0.1)
+        with self.assertRaises(ImageTooLargeError):
+            budget.acquire(101)
+        order = []
+        with budget.reserve(60):
+            def job(name, pixels):
+                with budget.reserve(pixels):
+                    order.append(name)
+            # Neither fits until the first reservation is released, and
+            # they're admitted in the order they arrived
+            first = threading.Thread(target=job, args=("first", 50))
+            first.start()
+            time.sleep(.02)
+            second = threading.Thread(target=job, args=("second", 10))
+            second.start()
+            time.sleep(.02)
+            self.assertEqual(order, [])
+            self.assertEqual(budget.stats()['waiting'], 2)
+        first.join()
+        second.join()
+        self.assertEqual(order, ["first", "second"])
+        with budget.reserve(90):
+            with self.assertRaises(ServiceUnavailableError):
+                budget.acquire(20)
+        self.assertEqual(budget.stats()['in_use'], 0)
+
+    def testPixelLimits(self):
+        url = "/{}/jpg".format(quote("mvol-0001-0002-0003_0001"))
+        config = digcollretriever.blueprint.BLUEPRINT.config
+        master = Image.open(BytesIO(self.app.get(url).data))
+        pixels = master.size[0] * master.size[1]
+        config['MAX_OUTPUT_PIXELS'] = pixels
+        self.response_200(self.app.get(url + "?scale=1"))
+        rv = self.app.get(url + "?scale=2")
+        self.assertEqual(rv.status_code, 413)
+        self.assertEqual(json.loads(rv.data.decode())['error_name'], "ImageTooLargeError")
+        self.response_200(self.app.get(url + "/thumb?width=50&height=50"))
+        # Upscaling needs room for the master and the result at once
+        config.update({'MAX_OUTPUT_PIXELS': pixels * 4, 'PIXEL_BUDGET': pixels * 2})
+        self.response_200(self.app.get(url + "?scale=1"))
+        self.assertEqual(self.app.get(url + "?scale=1.5").status_code, 413)
+        config['MAX_IMAGE_PIXELS'] = pixels - 1
+        self.assertEqual(self.app.get(url + "/thumb?width=50&height=50").status_code, 413)
+        budget = self.response_200_json(self.app.get("/stats"))['pixel_budget']
+        self.assertEqual((budget['max_pixels'], budget['in_use']), (pixels * 2, 0))
+
+    def testPixelBudgetReducedDecode(self):
+        # A large jpg is drafted at a fraction of its size for a thumbnail
+        jpg = BytesIO()
+        Image.new("RGB", (4001, 3000), "white").save(jpg, "JPEG")
+        self.assertEqual(decode_size((4001, 3000), (50, 38), "jpg"), (501, 375))
+        self.assertEqual(decode_size((4001, 3000), None, "jpg"), (4001, 3000))
+        self.assertEqual(decode_size((4001, 3000), (50, 38), "tif"), (4001, 3000))
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, "pyramid.tif")
+            write_pyramid(Image.new("RGB", (1001, 700), "white"), path)
+            # The decode size is known without opening the master
+            for size in ((50, 38), (100, 70), (300, 200), (400, 400), (600, 420), (1001, 700)):
+                with Image.open(jpg) as master:
+                    self.assertEqual(decode_size(master.size, size, "jpg"),
+                                     reduced_decode(master, size).size, size)
+                with Image.open(path) as master:
+                    self.assertEqual(decode_size(master.size, size, "tif", pyramid=True),
+                                     reduced_decode(master, size).size, size)
+        config = digcollretriever.blueprint.BLUEPRINT.config
+        ident = quote("mvol-0001-0002-0003_0001")
+        with TemporaryDirectory() as tmp:
+            config['DERIVATIVE_ROOT'] = tmp
+            build_pyramids(config, workers=1)
+            pixels = 640 * 427
+            # Only what will actually be decoded is reserved, here a
+            # reduced resolution subfile of the pyramid
+            config.update({'MAX_IMAGE_PIXELS': pixels * 4, 'PIXEL_BUDGET': pixels // 2})
+            rv = self.response_200(self.app.get("/{}/jpg/thumb?width=50&height=50".format(ident)))
+            self.assertEqual(Image.open(BytesIO(rv.data)).size, (50, 33))
+            self.response_200(self.app.get("/{}/jpg?width=100&height=67".format(ident)))
+            self.response_200(self.app.get("/iiif/{}/full/100,/0/default.jpg".format(ident)))
+            self.assertEqual(self.app.get("/{}/jpg?scale=1".format(ident)).status_code, 413)
+            self.assertEqual(self.app.get("/iiif/{}/full/max/0/default.jpg".format(ident)).status_code, 413)
+
+    def testOutputFormats(self):
+        url = "/{}/jpg".format(quote("mvol-0001-0002-0003_0001"))
+        rv = self.response_200(self.app.get(url + "?width=200&format=webp"))
+        self.assertEqual(rv.headers['Content-Type'], "image/webp")
+        self.assertEqual(Image.open(BytesIO(rv.data)).format, "WEBP")
+        self.assertNotIn("Vary", rv.headers)
+        rv = self.response_200(self.app.get(url + "/thumb?width=50&height=50&format=pjpg"))
+        self.assertEqual(rv.headers['Content-Type'], "image/jpg")
+        self.assertTrue(Image.open(BytesIO(rv.data)).info.get("progressive"))
+        # Each format is a distinct entity
+        self.assertNotEqual(self.app.get(url + "?width=200").headers['ETag'],
+                            self.app.get(url + "?width=200&format=webp").headers['ETag'])
+        rv = self.app.get(url + "?format=bmp")
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(json.loads(rv.data.decode())['error_name'], "InvalidFormatError")
+        self.assertEqual(self.app.get(url + "?format=tif").status_code, 400)
+
+    def testFormatNegotiation(self):
+        url = "/{}/jpg?width=200".format(quote("mvol-0001-0002-0003_0001"))
+        accept = {"Accept": "image/webp,*/*;q=0.8"}
+        # Negotiation is opt in
+        rv = self.response_200(self.app.get(url, headers=accept))
+        self.assertEqual(rv.headers['Content-Type'], "image/jpg")
+        self.assertNotIn("Vary", rv.headers)
+        digcollretriever.blueprint.BLUEPRINT.config['NEGOTIATE_FORMATS'] = True
+        rv = self.response_200(self.app.get(url, headers=accept))
+        self.assertEqual(rv.headers['Content-Type'], "image/webp")
+        self.assertIn("Accept", rv.headers['Vary'])
+        rv = self.response_200(self.app.get(url, headers={"Accept": "image/jpeg,image/jpg"}))
+        self.assertEqual(rv.headers['Content-Type'], "image/jpg")
+        self.assertIn("Accept", rv.headers['Vary'])
+        # Conditional responses vary too
+        rv = self.app.get(url, headers=dict(accept, **{"If-None-Match": rv.headers['ETag']}))
+        self.assertIn("Accept", rv.headers['Vary'])
+        # An explicit format wins, and doesn't vary
+        rv = self.response_200(self.app.get(url + "&format=jpg", headers=accept))
+        self.assertEqual(rv.headers['Content-Type'], "image/jpg")
+        self.assertNotIn("Vary", rv.headers)
+
+    def testTifCompression(self):
+        url = "/{}/tif".format(quote("mvol-0001-0002-0003_0001"))
+        native = self.response_200(self.app.get(url))
+        rv = self.response_200(self.app.get(url + "?compression=lzw"))
+        image = Image.open(BytesIO(rv.data))
+        self.assertEqual(image.info.get("compression"), "tiff_lzw")
+        self.assertEqual(image.size, Image.open(BytesIO(native.data)).size)
+        digcollretriever.blueprint.BLUEPRINT.config['TIFF_COMPRESSION'] = "deflate"
+        rv = self.response_200(self.app.get(url))
+        self.assertEqual(Image.open(BytesIO(rv.data)).info.get("compression"), "tiff_adobe_deflate")
+        self.assertEqual(self.app.get(url + "?compression=jpeg").status_code, 400)
+
+    def testResampling(self):
+        url = "/{}/jpg?width=200".format(quote("mvol-0001-0002-0003_0001"))
+        default = self.response_200(self.app.get(url))
+        rv = self.response_200(self.app.get(url + "&resample=box"))
+        self.assertNotEqual(default.headers['ETag'], rv.headers['ETag'])
+        self.assertEqual(Image.open(BytesIO(rv.data)).size, Image.open(BytesIO(default.data)).size)
+        rv = self.app.get(url + "&resample=sinc")
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(json.loads(rv.data.decode())['error_name'], "InvalidResampleError")
+        # Each endpoint has its own configurable default
+        digcollretriever.blueprint.BLUEPRINT.config['RESAMPLE'] = "box"
+        self.assertEqual(self.app.get(url).headers['ETag'],
+                         self.app.get(url + "&resample=box").headers['ETag'])
+
+    def testReducingGap(self):
+        master = Image.effect_mandelbrot((2000, 1600), (-0.75, -0.1, -0.7, -0.05), 256)
+        reference = master.resize((100, 80), resample=Image.LANCZOS)
+        self.assertEqual(resize(master, (100, 80), {'reducing_gap': None}).tobytes(),
+                         reference.tobytes())
+        reduced = resize(master, (100, 80), {'reducing_gap': 3.0})
+        self.assertNotEqual(reduced.tobytes(), reference.tobytes())
+        diff = ImageStat.Stat(ImageChops.difference(reduced, reference))
+        self.assertLess(diff.rms[0], 2)
+        self.assertEqual(resample_policy(None, "bicubic", "0"), ("bicubic", None))
+
+    def testRemoteFile(self):
+        with TemporaryDirectory() as tmp:
+            mkdir(join(tmp, "bucket"))
+            copyfile(join("sandbox", "test_file.tif"), join(tmp, "bucket", "page one.tif"))
+            server, url = range_server(tmp)
+            try:
+                store = RemoteStore(url, block_size=4096, read_ahead=2)
+                with open(join(tmp, "bucket", "page one.tif"), "rb") as f:
+                    native = f.read()
+                remote = store.open("page one.tif")
+                self.assertEqual(remote.size, len(native))
+                self.assertIsNotNone(remote.signature)
+                # Only the header is read to learn the dimensions
+                with Image.open(remote) as image:
+                    self.assertEqual(image.size, Image.open(join(tmp, "bucket", "page one.tif")).size)
+                self.assertLess(store.bytes_fetched, len(native) / 4)
+                for start, length in ((0, 10), (5000, 9000), (len(native) - 3, 3), (4095, 2)):
+                    remote.seek(start)
+                    self.assertEqual(remote.read(length), native[start:start + length])
+                remote.seek(-1, 2)
+                self.assertEqual(remote.read(10), native[-1:])
+                remote.seek(0)
+                self.assertEqual(remote.read(), native)
+                # Everything is now cached, and connections were reused
+                requests = len(server.requests)
+                remote.seek(0)
+                self.assertEqual(remote.read(), native)
+                self.assertEqual(len(server.requests), requests)
+                self.assertLess(server.connections, requests)
+                with self.assertRaises(SourceNotFoundError):
+                    store.open("missing.tif")
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def testRemoteFileWithoutETag(self):
+        with TemporaryDirectory() as tmp:
+            mkdir(join(tmp, "bucket"))
+            path = join(tmp, "bucket", "page.tif")
+            for validators in (("Last-Modified",), ()):
+                with open(path, "wb") as f:
+                    f.write(b"a" * 10000)
+                utime(path, (1000000000, 1000000000))
+                server, url = range_server(tmp, validators)
+                try:
+                    store = RemoteStore(url, block_size=4096)
+                    self.assertEqual(store.open("page.tif").read(), b"a" * 10000)
+                    # Replaced in place, a new version must not be read
+                    # from blocks of the old one
+                    with open(path, "wb") as f:
+                        f.write(b"b" * 10001)
+                    utime(path, (1000000060, 1000000060))
+                    remote = store.open("page.tif")
+                    self.assertEqual(remote.read(), b"b" * 10001)
+                    if not validators:
+                        self.assertIsNone(remote.version)
+                        self.assertEqual(store.cache.stats()['entries'], 0)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+
+    def testRemoteStorageInterface(self):
+        with TemporaryDirectory() as tmp:
+            mkdir(join(tmp, "bucket"))
+            copyfile(join("sandbox", "mock_oc_root", "data", "ldr_oc_admin", "files",
+                          "Preservation Unit", "mvol", "0001", "0002", "0003", "TIFF",
+                          "mvol-0001-0002-0003_0001.tif"), join(tmp, "bucket", "page1.tif"))
+            server, url = range_server(tmp)
+            try:
+                digcollretriever.blueprint.BLUEPRINT.config.update({
+                    "REMOTE_STORAGE_URL": url, "REMOTE_BLOCK_SIZE": 16384
+                })
+                local = Image.open(join(tmp, "bucket", "page1.tif"))
+                rv = self.response_200(self.app.get("/remotetif-page1/jpg?width=100&height=100"))
+                self.assertEqual(Image.open(BytesIO(rv.data)).size, (100, 100))
+                rj = self.response_200_json(self.app.get("/remotetif-page1/tif/technical_metadata"))
+                self.assertEqual((rj['width'], rj['height']), local.size)
+                # Remote masters have validators like local ones
+                self.assertEqual(self.app.get("/remotetif-page1/jpg?width=100&height=100",
+                                              headers={"If-None-Match": rv.headers['ETag']}).status_code,
+                                 304)
+                rv = self.response_200(self.app.get("/remotetif-page1/tif"))
+                self.assertEqual(Image.open(BytesIO(rv.data)).size, local.size)
+                self.assertEqual(self.app.get("/remotetif-page2/jpg").status_code, 404)
+                stats = self.response_200_json(self.app.get("/stats"))['remote_storage']
+                self.assertGreater(stats[url]['requests'], 0)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def testListChildren(self):
+        conf = digcollretriever.blueprint.BLUEPRINT.config
+        self.assertEqual(MvolLayer1StorageInterface(conf).list_children("mvol-0001"), ["mvol-0001-0002"])
+        self.assertEqual(MvolLayer2StorageInterface(conf).list_children("mvol-0001-0002"),
+                         ["mvol-0001-0002-0003"])
+        self.assertEqual(MvolLayer3StorageInterface(conf).list_children("mvol-0001-0002-0003"),
+                         ["mvol-0001-0002-0003_0001"])
+        with self.assertRaises(SourceNotFoundError):
+            MvolLayer1StorageInterface(conf).list_children("mvol-0009")
+
+    def testDirectoryScanCache(self):
+        scans = DirectoryScanCache(ttl=0)
+        root = join("sandbox", "mock_oc_root")
+        self.assertEqual(scans.scan(root), ("data",))
+        self.assertEqual(scans.scan(root), ("data",))
+        self.assertEqual((scans.hits, scans.misses), (1, 1))
+        self.assertTrue(scans.exists(join(root, "data")))
+        self.assertFalse(scans.exists(join(root, "nope")))
+        self.assertFalse(scans.exists(join(root, "nope", "nope")))
+        with TemporaryDirectory() as tmp:
+            self.assertEqual(scans.scan(tmp), ())
+            open(join(tmp, "new"), "w").close()
+            # Recently modified directories are always rescanned
+            self.assertEqual(scans.scan(tmp), ("new",))
+
+    def testStatDescendants(self):
+        rj = self.response_200_json(self.app.get("/mvol-0001/stat/descendants"))
+        self.assertEqual(rj['total'], 3)
+        self.assertIsNone(rj['next'])
+        self.assertEqual([(x['identifier'], x['parent']) for x in rj['descendants']],
+                         [("mvol-0001-0002", "mvol-0001"), ("mvol-0001-0002-0003", "mvol-0001-0002"),
+                          ("mvol-0001-0002-0003_0001", "mvol-0001-0002-0003")])
+        # The same contexts as /stat reports
+        for x in rj['descendants']:
+            stat = self.response_200_json(self.app.get("/{}/stat".format(x['identifier'])))
+            self.assertEqual(x['contexts_available'], stat['contexts_available'])
+            self.assertEqual(x['formats_available'], stat['formats_available'])
+        self.assertIn("/mvol-0001/stat/descendants",
+                      self.response_200_json(self.app.get("/mvol-0001/stat"))['contexts_available'])
+        # Dimensions are reported once they're in the technical metadata index
+        techmd = self.response_200_json(
+            self.app.get("/mvol-0001-0002-0003_0001/tif/technical_metadata"))
+        rj = self.response_200_json(self.app.get("/mvol-0001-0002-0003/stat/descendants"))
+        self.assertEqual(rj['descendants'][0]['dimensions'],
+                         {"width": techmd['width'], "height": techmd['height']})
+        rj = self.response_200_json(self.app.get("/mvol-0001/stat/descendants?offset=1&limit=1"))
+        self.assertEqual([x['identifier'] for x in rj['descendants']], ["mvol-0001-0002-0003"])
+        rj = self.response_200_json(self.app.get(rj['next']))
+        self.assertEqual([x['identifier'] for x in rj['descendants']], ["mvol-0001-0002-0003_0001"])
+        self.assertIsNone(rj['next'])
+        self.assertEqual(self.app.get("/mvol-0009/stat/descendants").status_code, 404)
+
+    def testPollingWatcher(self):
+        with TemporaryDirectory() as tmp:
+            makedirs(join(tmp, "a", "DERIVATIVES"))
+            open(join(tmp, "a", "old"), "w").close()
+            watcher = watch.PollingWatcher([tmp], interval=0, batch_size=1, pause=0)
+            # The first pass only records what exists, a batch at a time
+            self.assertEqual(watcher.poll(), [])
+            self.assertEqual(watcher.poll(), [])
+            self.assertEqual(watcher.passes, 1)
+            open(join(tmp, "a", "new"), "w").close()
+            open(join(tmp, "a", "DERIVATIVES", "ignored"), "w").close()
+            open(join(tmp, "a", ".tmp-ignored"), "w").close()
+            utime(join(tmp, "a", "old"), ns=(1, 1))
+            events = []
+            while watcher.passes < 2:
+                events.extend(watcher.poll())
+            self.assertEqual(sorted(events), [(watch.CHANGED, join(tmp, "a", "new")),
+                                              (watch.CHANGED, join(tmp, "a", "old"))])
+            remove(join(tmp, "a", "old"))
+            events = []
+            while watcher.passes < 3:
+                events.extend(watcher.poll())
+            self.assertEqual(events, [(watch.REMOVED, join(tmp, "a", "old"))])
+
+    def testInotifyWatcher(self):
+        with TemporaryDirectory() as tmp:
+            try:
+                watcher = watch.open_watcher([tmp], backend="inotify")
+            except OSError:
+                self.skipTest("inotify is unavailable")
+            try:
+                mkdir(join(tmp, "a"))
+                with open(join(tmp, "a", "new"), "w") as f:
+                    f.write("x")
+                events = []
+                deadline = time.monotonic() + 5
+                while (watch.CHANGED, join(tmp, "a", "new")) not in events and time.monotonic() < deadline:
+                    events.extend(watcher.poll(0.1))
+                self.assertIn((watch.CHANGED, join(tmp, "a")), events)
+                self.assertIn((watch.CHANGED, join(tmp, "a", "new")), events)
+                remove(join(tmp, "a", "new"))
+                events = []
+                while not events and time.monotonic() < deadline:
+                    events.extend(watcher.poll(0.1))
+                self.assertEqual(events, [(watch.REMOVED, join(tmp, "a", "new"))])
+            finally:
+                watcher.close()
+
+    def testWatchIdentifiers(self):
+        conf = {"MVOL_ROOT": "/m", "FLAT_TIF_DIR_ROOT": "/t", "FLAT_JPG_DIR_ROOT": "/j/"}
+        page = "mvol-0001-0002-0003_0001"
+        self.assertEqual(watch.identifiers_for(conf, "/m/mvol/0001/0002/0003/TIFF/{}.tif".format(page)),
+                         [page])
+        self.assertEqual(watch.identifiers_for(conf, "/m/mvol/0001/0002/0003/ALTO/{}.xml".format(page)),
+                         [page])
+        self.assertEqual(watch.identifiers_for(conf, "/m/mvol/0001/0002/0003/mvol-0001-0002-0003.pdf"),
+                         ["mvol-0001-0002-0003"])
+        self.assertEqual(watch.identifiers_for(
+            conf, "/m/mvol/0001/0002/0003/DERIVATIVES/thumb/{}.jpg".format(page)), [])
+        self.assertEqual(watch.identifiers_for(conf, "/t/abc.tif"), ["flattifdir-abc"])
+        self.assertEqual(watch.identifiers_for(conf, "/j/abc.jpg"),
+                         ["flatjpgdir-abc", "flatjpgdirnobadtifs-abc"])
+        self.assertEqual(watch.identifiers_for(conf, "/t/abc.jpg"), [])
+
+    def testWatchInvalidation(self):
+        config = digcollretriever.blueprint.BLUEPRINT.config
+        ident = "mvol-0001-0002-0003_0001"
+        with TemporaryDirectory() as tmp:
+            config['DERIVATIVE_ROOT'] = join(tmp, "derivatives")
+            storage_instance = MvolLayer4StorageInterface(config)
+            master = storage_instance.get_tif(ident)
+            cache = DerivativeCache(join(tmp, "cache"), 1024)
+            cache.put(DerivativeCache.make_key(ident, {}, "jpg", (1, 2)), b"123456")
+            techmd = TechmdIndex(":memory:")
+            techmd.get(master)
+            existence = ExistenceCache(60)
+            self.assertTrue(existence.exists(storage_instance, ident, "tif"))
+            warmup = watch.WarmupQueue(config, delay=0)
+            handler = watch.Invalidator(config, derivative_cache=cache, techmd=techmd,
+                                        existence=existence, warmup=warmup)
+            handler(watch.CHANGED, master)
+            self.assertEqual(cache.stats()['entries'], 0)
+            self.assertEqual(techmd.stats()['entries'], 0)
+            self.assertEqual(existence.stats()['entries'], 0)
+            # The page's standard derivatives are built in the background
+            self.assertTrue(warmup.join(30))
+            self.assertEqual(warmup.stats()['built'], 1)
+            for name, _ in storage_instance.DERIVATIVE_SIZES:
+                self.assertTrue(isfile(storage_instance.derivative_path(ident, name)))
+            warmup.stop()
+            handler(watch.RESCAN, None)
+            self.assertEqual(handler.stats(), {"changed": 1, "removed": 0, "rescan": 1})
+
+    def testWatchStats(self):
+        config = digcollretriever.blueprint.BLUEPRINT.config
+        config['WATCH'] = True
+        config['WATCH_BACKEND'] = "poll"
+        rj = self.response_200_json(self.app.get("/stats"))
+        self.assertEqual(rj['watch']['backend'], "poll")
+        self.assertIs(digcollretriever.blueprint.watcher(), digcollretriever.blueprint.watcher())
+        digcollretriever.blueprint.watcher().stop()
+
+    def testWatchWarmupElection(self):
+        import fcntl
+        config = digcollretriever.blueprint.BLUEPRINT.config
+        with TemporaryDirectory() as tmp:
+            config.update({'WATCH': True, 'WATCH_BACKEND': "poll", 'WATCH_WARMUP': True,
+                           'DERIVATIVE_ROOT': join(tmp, "derivatives"), 'FLAT_TIF_DIR_ROOT': tmp})
+            path = watch.warmup_lock_path(config)
+            self.assertEqual(path, join(tmp, "derivatives", watch.WARMUP_LOCK))
+            makedirs(dirname(path))
+            # Another process is warming up, so this one only invalidates
+            with open(path, "a") as other:
+                fcntl.flock(other, fcntl.LOCK_EX)
+                self.assertFalse(watch.claim_warmup(path))
+                watcher = digcollretriever.blueprint.watcher()
+                self.assertNotIn("warmup", watcher.stats())
+                watcher.stop()
+            self.assertTrue(watch.claim_warmup(path))
+            self.assertTrue(watch.claim_warmup(path))
+            config['FLAT_JPG_DIR_ROOT'] = tmp
+            watcher = digcollretriever.blueprint.watcher()
+            self.assertIn("warmup", watcher.stats())
+            watcher.stop()
+
 
 if __name__ == "__main__":
     unittest.main()